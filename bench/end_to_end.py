@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------
+# bench/end_to_end.py
+#
+# end-to-end benchmark against the IMAP server stand-in
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""Benchmark whole imap-archiver runs against the IMAP server stand-in of bench/imap_server.py.
+
+The synthetic account is served on a local port and each of
+
+    - scan:         scan all mailboxes
+    - scan-years:   scan all mailboxes and count the mails per year
+    - download:     download all mails into a temporary folder
+    - move:         move the mails older than --year to Archive
+    - clean:        delete the empty mailboxes
+
+runs in-process on a fresh copy of the account. Reported are the wall time, the mails per
+second, the round trips (commands sent) and the bytes sent and received by imap-archiver.
+
+Usage:
+
+    python3 bench/end_to_end.py [--mails N] [--latency 0.02] [--jobs 4] [--async] [--json FILE]
+
+See --help for the options of the account and of the server (extensions, latencies).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import imap_server                                                                  # noqa: E402
+from imaparchiver import command_line                                               # noqa: E402
+
+
+OPERATIONS = ('scan', 'scan-years', 'download', 'move', 'clean')
+
+
+def arguments(operation: str, connect: str, folder: str, args: argparse.Namespace) -> List[str]:
+    """Get the command line of an operation.
+
+    :param operation:   the operation (see OPERATIONS)
+    :param connect:     the connection details
+    :param folder:      the folder to download to
+    :param args:        the parsed command line of the benchmark
+    :return:            the command line of imap-archiver
+    """
+    cli = ['--no-color']
+    if args.no_compress:
+        cli.append('--no-compress')
+    if args.pipeline_depth is not None:
+        cli += ['--pipeline-depth', str(args.pipeline_depth)]
+    jobs = ['--jobs', str(args.jobs)]
+    use_async = ['--async'] if args.use_async else []
+    if operation == 'scan':
+        return cli + ['scan'] + jobs + use_async + [connect]
+    if operation == 'scan-years':
+        return cli + ['scan', '--years'] + jobs + use_async + [connect]
+    if operation == 'download':
+        return cli + ['download'] + jobs + use_async + [connect, 'INBOX', folder]
+    if operation == 'move':
+        return cli + ['move', '--year', str(args.year)] + jobs + use_async + [connect, 'INBOX', 'Archive']
+    return cli + ['clean'] + jobs + [connect, 'INBOX']
+
+
+def run(operation: str, server: imap_server.Server, args: argparse.Namespace) -> Dict[str, float]:
+    """Run a single operation on a fresh copy of the account.
+
+    :param operation:   the operation (see OPERATIONS)
+    :param server:      the server, running
+    :param args:        the parsed command line of the benchmark
+    :return:            the results
+    """
+    host, port = server.address
+    connect = f'{server.user}:{server.password}@{host}:{port}'
+    folder = tempfile.mkdtemp(prefix='imap-archiver-bench-')
+    server.account.reset()
+    server.reset_stats()
+    output = io.StringIO()
+    try:
+        start = time.monotonic()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            command_line.cli.main(arguments(operation, connect, folder, args), prog_name='imap-archiver',
+                                  standalone_mode=False)
+        seconds = time.monotonic() - start
+    except Exception:
+        sys.stderr.write(output.getvalue())
+        raise
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    stats = server.stats
+    return {'operation': operation, 'seconds': seconds, 'mails_per_second': args.mails / seconds,
+            'round_trips': stats.round_trips,
+            # the server counts the bytes on its side, the client's are the other way round
+            'bytes_sent': stats.bytes_received, 'bytes_received': stats.bytes_sent,
+            'connections': stats.connections,
+            'commands': dict(stats.commands)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark imap-archiver against the IMAP server stand-in.')
+    imap_server.account_arguments(parser)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of connections')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='use the asyncio engine')
+    parser.add_argument('--no-compress', action='store_true', help='do not use COMPRESS=DEFLATE')
+    parser.add_argument('--pipeline-depth', type=int, default=None, help='number of commands in flight')
+    parser.add_argument('--year', type=int, default=2015, help='move the mails sent before this year')
+    parser.add_argument('--operation', action='append', choices=OPERATIONS, default=[],
+                        help='run this operation only (may be repeated)')
+    parser.add_argument('--json', default=None, metavar='FILE', help='write the results to FILE')
+    args = parser.parse_args()
+
+    account = imap_server.account_from_arguments(args)
+    results = []
+    with imap_server.server_from_arguments(args, account) as server:
+        print(f'{args.mails} mails in {args.mailboxes} mailboxes, jobs: {args.jobs}, '
+              f'engine: {"async" if args.use_async else "threads"}, '
+              f'extensions: {" ".join(server.capabilities)}')
+        print('%-12s %9s %10s %11s %12s %14s' % ('operation', 'seconds', 'mails/s', 'round trips',
+                                                 'bytes sent', 'bytes received'))
+        for operation in args.operation or OPERATIONS:
+            r = run(operation, server, args)
+            results.append(r)
+            print('%-12s %9.3f %10.0f %11d %12d %14d' % (operation, r['seconds'], r['mails_per_second'],
+                                                         r['round_trips'], r['bytes_sent'], r['bytes_received']))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------
+# bench/imap_server.py
+#
+# a deterministic IMAP4rev1 server stand-in
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""A deterministic IMAP4rev1 server stand-in with a synthetic mailbox tree.
+
+The Account generates a mailbox tree from a seed: the number of mailboxes and mails, the size
+of the headers and bodies, the dates of the mails and their flags are all configurable. The
+mails themselves are generated on demand from their key, so even large accounts take a few
+dozen bytes per mail only.
+
+The Server speaks just enough IMAP4rev1 for imap-archiver, plus the extensions MOVE, UIDPLUS,
+CONDSTORE, ESEARCH, LIST-STATUS and COMPRESS=DEFLATE, each of which may be switched off. It
+runs in a thread of the calling process:
+
+>>> with Server(Account(mails=10000), latency=0.01) as server:
+...     host, port = server.address
+...     ...
+...     print(server.stats.commands['UID FETCH'], server.stats.bytes_sent)
+
+A latency is injected per command: the response to a command is not sent before the latency
+has passed since the command was received. This is how a round trip to a remote server
+behaves, so pipelined commands wait for the latency once, not once per command.
+
+Client literals are not supported, as imap-archiver does not send any.
+
+Run this as a script to serve an account on a local port for manual tests.
+"""
+
+import argparse
+import collections
+import datetime
+import email.utils
+import random
+import re
+import select
+import socketserver
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+# all the extensions the server supports
+EXTENSIONS = ('MOVE', 'UIDPLUS', 'UNSELECT', 'CONDSTORE', 'ESEARCH', 'LIST-STATUS', 'COMPRESS')
+
+# responses are sent in chunks of this size at most
+_SEND_CHUNK = 1 << 20
+
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+_WORDS = ('Archive', 'Customers', 'Family', 'Lists', 'Notifications', 'Projects', 'Receipts', 'Travel')
+
+_PATTERN_FETCH_SECTION = re.compile(r'(?P<name>BODY(?:\.PEEK)?)\[(?P<section>[^\]]*)\]$', re.IGNORECASE)
+_PATTERN_HEADER_FIELDS = re.compile(r'HEADER\.FIELDS \((?P<fields>[^)]*)\)$', re.IGNORECASE)
+_PATTERN_SEARCH_DATE = re.compile(r'(?P<day>\d{1,2})-(?P<month>[A-Za-z]{3})-(?P<year>\d{4})$')
+
+
+class Mail(object):
+
+    """A single mail of a mailbox. The mail itself is generated by the Account from its key."""
+
+    __slots__ = ('uid', 'key', 'flags', 'modseq', 'sent', 'received')
+
+    def __init__(self, uid: int, key: int, flags: Set[str], modseq: int, sent: Optional[int], received: int):
+        """Constructor.
+
+        :param uid:         the UID
+        :param key:         the key the mail is generated from
+        :param flags:       the flags, e.g. {'\\Seen'}
+        :param modseq:      the MODSEQ of the last change
+        :param sent:        the date of the Date header (seconds since the epoch, None: no Date header)
+        :param received:    the INTERNALDATE (seconds since the epoch)
+        """
+        self.uid = uid
+        self.key = key
+        self.flags = flags
+        self.modseq = modseq
+        self.sent = sent
+        self.received = received
+
+
+class Mailbox(object):
+
+    """A single mailbox of an Account."""
+
+    def __init__(self, name: str, uid_validity: int):
+        """Constructor.
+
+        :param name:            the name of the mailbox
+        :param uid_validity:    the UIDVALIDITY
+        """
+        self.name = name
+        self.uid_validity = uid_validity
+        self.uid_next = 1
+        self.highest_modseq = 1
+        self.mails = []                 # type: List[Mail]
+
+    def add(self, mail: Mail) -> Mail:
+        """Add a mail as a new one, with the next UID.
+
+        :param mail:    the mail
+        :return:        the mail added (a copy with the new UID)
+        """
+        self.highest_modseq += 1
+        added = Mail(self.uid_next, mail.key, set(mail.flags), self.highest_modseq, mail.sent, mail.received)
+        self.uid_next += 1
+        self.mails.append(added)
+        return added
+
+    def expunge(self, uids: Optional[Set[int]] = None) -> List[int]:
+        """Remove the mails flagged \\Deleted.
+
+        :param uids:    remove mails of these UIDs only (None: all)
+        :return:        the sequence numbers of the removed mails, as reported one after the other
+        """
+        expunged = []
+        kept = []
+        for i, m in enumerate(self.mails):
+            if '\\Deleted' in m.flags and (uids is None or m.uid in uids):
+                expunged.append(i + 1 - len(expunged))
+            else:
+                kept.append(m)
+        if expunged:
+            self.mails = kept
+            self.highest_modseq += 1
+        return expunged
+
+    def status(self, item: str) -> Optional[int]:
+        """Get a STATUS data item.
+
+        :param item:    the item, e.g. 'MESSAGES'
+        :return:        the value (None if the item is unknown)
+        """
+        if item == 'MESSAGES':
+            return len(self.mails)
+        if item == 'UNSEEN':
+            return sum(1 for m in self.mails if '\\Seen' not in m.flags)
+        if item == 'RECENT':
+            return 0
+        if item == 'UIDNEXT':
+            return self.uid_next
+        if item == 'UIDVALIDITY':
+            return self.uid_validity
+        if item == 'HIGHESTMODSEQ':
+            return self.highest_modseq
+        return None
+
+    def touch(self, mail: Mail) -> None:
+        """Note a change of a mail.
+
+        :param mail:    the mail changed
+        """
+        self.highest_modseq += 1
+        mail.modseq = self.highest_modseq
+
+
+class Account(object):
+
+    """A synthetic IMAP4 account, generated deterministically from a seed.
+
+    The mailboxes are INBOX and a tree of folders below it. The mails are spread unevenly over
+    the mailboxes, but some leaf mailboxes are left empty, so there is something to clean.
+    """
+
+    delimiter = '.'
+
+    def __init__(self,
+                 mails: int = 10000,
+                 mailboxes: int = 20,
+                 depth: int = 3,
+                 header_size: int = 2000,
+                 body_size: int = 4000,
+                 years: Tuple[int, int] = (2010, 2020),
+                 distribution: str = 'uniform',
+                 seen: float = 0.9,
+                 deleted: float = 0.0,
+                 undated: float = 0.0,
+                 empty: float = 0.1,
+                 seed: int = 42):
+        """Constructor.
+
+        :param mails:           number of mails
+        :param mailboxes:       number of mailboxes (including INBOX)
+        :param depth:           maximum depth of the mailbox tree below INBOX
+        :param header_size:     mean size of the header of a mail (bytes)
+        :param body_size:       mean size of the body of a mail (bytes)
+        :param years:           first and last year the mails are sent in
+        :param distribution:    the distribution of the dates: 'uniform' or 'recent' (most mails are recent)
+        :param seen:            share of the mails flagged \\Seen
+        :param deleted:         share of the mails flagged \\Deleted
+        :param undated:         share of the mails without a Date header
+        :param empty:           share of the mailboxes without any mail
+        :param seed:            the seed of the generator
+        """
+        if distribution not in ('uniform', 'recent'):
+            raise ValueError('Unknown date distribution: ' + distribution)
+        self.mail_count = mails
+        self.mailbox_count = max(mailboxes, 1)
+        self.depth = depth
+        self.header_size = header_size
+        self.body_size = body_size
+        self.years = years
+        self.distribution = distribution
+        self.seen = seen
+        self.deleted = deleted
+        self.undated = undated
+        self.empty = empty
+        self.seed = seed
+        self.lock = threading.RLock()
+        self.mailboxes = {}             # type: Dict[str, Mailbox]
+        self.subscribed = set()         # type: Set[str]
+        self._uid_validity = 0
+        self.reset()
+
+    def create(self, name: str) -> Mailbox:
+        """Create a mailbox.
+
+        :param name:    the name of the mailbox
+        :return:        the mailbox created
+        """
+        self._uid_validity += 1
+        mb = Mailbox(name, self._uid_validity)
+        self.mailboxes[name] = mb
+        return mb
+
+    def _date(self, rnd: random.Random) -> int:
+        """Draw the date a mail is sent.
+
+        :param rnd:     the random generator
+        :return:        the date (seconds since the epoch)
+        """
+        first = int(datetime.datetime(self.years[0], 1, 1, tzinfo=datetime.timezone.utc).timestamp())
+        last = int(datetime.datetime(self.years[1] + 1, 1, 1, tzinfo=datetime.timezone.utc).timestamp()) - 1
+        if self.distribution == 'recent':
+            return max(first, last - int(rnd.expovariate(4 / (last - first))))
+        return rnd.randint(first, last)
+
+    def _names(self, rnd: random.Random) -> List[str]:
+        """Draw the names of the mailboxes.
+
+        :param rnd:     the random generator
+        :return:        the names, parents before their children
+        """
+        names = ['INBOX']
+        for i in range(1, self.mailbox_count):
+            parents = [n for n in names if n.count(self.delimiter) < self.depth]
+            word = _WORDS[i % len(_WORDS)]
+            name = f'{word} {i}' if i % 5 == 0 else f'{word}{i}'
+            names.append(rnd.choice(parents) + self.delimiter + name)
+        return names
+
+    def message(self, mail: Mail) -> bytes:
+        """Generate a mail.
+
+        :param mail:    the mail
+        :return:        the mail (header and body)
+        """
+        rnd = random.Random(mail.key)
+        header = [f'Return-Path: <sender{mail.key % 977}@example.com>',
+                  f'Received: from relay{mail.key % 7}.example.com by mx.example.com; {_format_date(mail.received)}',
+                  f'From: Sender {mail.key % 977} <sender{mail.key % 977}@example.com>',
+                  'To: Bench <bench@example.com>',
+                  f'Subject: Synthetic mail {mail.key}',
+                  f'Message-ID: <{mail.key}.{self.seed}@bench.example.com>']
+        if mail.sent is not None:
+            header.append(f'Date: {_format_date(mail.sent)}')
+        header = '\r\n'.join(header) + '\r\n'
+        padding = int(self.header_size * rnd.uniform(0.5, 1.5)) - len(header)
+        while padding > 0:
+            line = 'X-Padding: ' + 'x' * min(max(padding - 13, 1), 900) + '\r\n'
+            header += line
+            padding -= len(line)
+        body_size = int(self.body_size * rnd.uniform(0.5, 1.5))
+        body = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit.\r\n' * (body_size // 58 + 1))[:body_size]
+        return (header + '\r\n' + body).encode()
+
+    def reset(self) -> None:
+        """Generate the account (again) from the seed, dropping any change."""
+        with self.lock:
+            rnd = random.Random(self.seed)
+            self.mailboxes = {}
+            self._uid_validity = 1000
+            names = self._names(rnd)
+            for name in names:
+                self.create(name)
+            self.subscribed = set(names)
+
+            leaves = [n for n in names if not any(c.startswith(n + self.delimiter) for c in names) and n != 'INBOX']
+            empty = set(rnd.sample(leaves, min(len(leaves), int(len(names) * self.empty))))
+            filled = [self.mailboxes[n] for n in names if n not in empty]
+            weights = [1 / (i + 1) for i in range(len(filled))]
+            for key in range(1, self.mail_count + 1):
+                mb = rnd.choices(filled, weights)[0]
+                sent = self._date(rnd)
+                flags = set()
+                if rnd.random() < self.seen:
+                    flags.add('\\Seen')
+                if rnd.random() < self.deleted:
+                    flags.add('\\Deleted')
+                if rnd.random() < self.undated:
+                    sent_header = None
+                else:
+                    sent_header = sent
+                mb.add(Mail(0, key, flags, 0, sent_header, sent + rnd.randint(1, 600)))
+
+
+class Stats(object):
+
+    """What the server has been asked for: the commands and the bytes on the wire."""
+
+    def __init__(self):
+        """Constructor."""
+        self.lock = threading.Lock()
+        self.commands = collections.Counter()       # type: Dict[str, int]
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.connections = 0
+
+    @property
+    def round_trips(self) -> int:
+        """The number of commands run."""
+        return sum(self.commands.values())
+
+    def as_dict(self) -> dict:
+        """Get the stats as plain dictionary (e.g. for JSON).
+
+        :return:    the stats
+        """
+        return {'commands': dict(self.commands), 'round_trips': self.round_trips, 'connections': self.connections,
+                'bytes_received': self.bytes_received, 'bytes_sent': self.bytes_sent}
+
+
+def _format_date(t: int) -> str:
+    """Format a date for a Date header.
+
+    :param t:   the date (seconds since the epoch)
+    :return:    the date, e.g. 'Mon, 03 Feb 2014 10:11:12 +0000'
+    """
+    return email.utils.formatdate(t)
+
+
+def _format_internal_date(t: int) -> str:
+    """Format a date as INTERNALDATE.
+
+    :param t:   the date (seconds since the epoch)
+    :return:    the date, e.g. '03-Feb-2014 10:11:12 +0000'
+    """
+    d = time.gmtime(t)
+    return '%02d-%s-%d %02d:%02d:%02d +0000' % (d.tm_mday, _MONTHS[d.tm_mon - 1], d.tm_year,
+                                                 d.tm_hour, d.tm_min, d.tm_sec)
+
+
+def _header_fields(header: bytes, fields: Iterable[str], exclude: bool = False) -> bytes:
+    """Pick some fields of a header.
+
+    :param header:      the header
+    :param fields:      the names of the fields
+    :param exclude:     pick all fields but the ones given
+    :return:            the fields picked (terminated by an empty line)
+    """
+    fields = {f.lower().encode() for f in fields}
+    picked = []
+    for line in header.split(b'\r\n'):
+        if line[:1] in (b' ', b'\t') and picked and picked[-1] is not None:
+            picked[-1] += b'\r\n' + line
+            continue
+        name = line.split(b':', 1)[0].strip().lower()
+        picked.append(line if (name in fields) != exclude and line else None)
+    return b''.join(p + b'\r\n' for p in picked if p is not None) + b'\r\n'
+
+
+def _quote(s: str) -> str:
+    """Quote a string (e.g. a mailbox name) if need be.
+
+    :param s:   the string
+    :return:    the string as atom or quoted string
+    """
+    if s and re.fullmatch(r'[A-Za-z0-9._\-/&+]+', s):
+        return s
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _search_day(date: str) -> datetime.date:
+    """Parse the date of a SEARCH key.
+
+    :param date:    the date, e.g. '1-Feb-2014'
+    :return:        the date
+    """
+    m = _PATTERN_SEARCH_DATE.match(date)
+    if m is None:
+        raise ValueError('Malformed date: ' + date)
+    return datetime.date(int(m.group('year')), _MONTHS.index(m.group('month').capitalize()) + 1, int(m.group('day')))
+
+
+def _day(t: int) -> datetime.date:
+    """Get the day of a date.
+
+    :param t:   the date (seconds since the epoch)
+    :return:    the day (UTC)
+    """
+    return datetime.datetime.fromtimestamp(t, datetime.timezone.utc).date()
+
+
+def tokenize(line: str) -> list:
+    """Split a command line into tokens.
+
+    Quoted strings are unquoted, parenthesized lists become lists. An atom may hold a section
+    in brackets with spaces in it, e.g. BODY.PEEK[HEADER.FIELDS (DATE)].
+
+    :param line:    the command line (without CRLF)
+    :return:        the tokens
+    """
+    stack = [[]]
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c == ' ':
+            i += 1
+        elif c == '(':
+            stack.append([])
+            i += 1
+        elif c == ')':
+            if len(stack) == 1:
+                raise ValueError('Unbalanced parentheses')
+            inner = stack.pop()
+            stack[-1].append(inner)
+            i += 1
+        elif c == '"':
+            j = i + 1
+            s = []
+            while j < len(line) and line[j] != '"':
+                if line[j] == '\\':
+                    j += 1
+                s.append(line[j])
+                j += 1
+            stack[-1].append(''.join(s))
+            i = j + 1
+        else:
+            j = i
+            depth = 0
+            while j < len(line) and (depth > 0 or line[j] not in ' ()'):
+                if line[j] == '[':
+                    depth += 1
+                elif line[j] == ']':
+                    depth -= 1
+                j += 1
+            stack[-1].append(line[i:j])
+            i = j
+    if len(stack) != 1:
+        raise ValueError('Unbalanced parentheses')
+    return stack[0]
+
+
+def _uid_set(sequence_set: str, mb: Mailbox) -> Set[int]:
+    """Get the UIDs of a UID sequence set present in a mailbox.
+
+    :param sequence_set:    the sequence set, e.g. '1:5,7,10:*'
+    :param mb:              the mailbox
+    :return:                the UIDs of the mails in the mailbox within the set
+    """
+    uid_max = mb.mails[-1].uid if mb.mails else 0
+    ranges = []
+    for part in sequence_set.split(','):
+        first, _, last = part.partition(':')
+        first = uid_max if first == '*' else int(first)
+        last = first if not last else (uid_max if last == '*' else int(last))
+        ranges.append((min(first, last), max(first, last)))
+    return {m.uid for m in mb.mails if any(first <= m.uid <= last for first, last in ranges)}
+
+
+def _render_set(uids: Iterable[int]) -> str:
+    """Render UIDs as sequence set.
+
+    :param uids:    the UIDs
+    :return:        the sequence set
+    """
+    parts = []
+    for uid in sorted(uids):
+        if parts and parts[-1][1] + 1 == uid:
+            parts[-1][1] = uid
+        else:
+            parts.append([uid, uid])
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in parts)
+
+
+def _compare(day: datetime.date, key: str, target: datetime.date) -> bool:
+    """Compare a day by a SEARCH date key.
+
+    :param day:     the day of the mail
+    :param key:     the key: SENTSINCE, SENTBEFORE or SENTON
+    :param target:  the day of the key
+    :return:        the day matches
+    """
+    if key == 'SENTSINCE':
+        return day >= target
+    if key == 'SENTBEFORE':
+        return day < target
+    return day == target
+
+
+def _list_pattern(reference: str, pattern: str, delimiter: str) -> 're.Pattern':
+    """Get the regular expression matching the mailbox names of a LIST command.
+
+    :param reference:   the reference name
+    :param pattern:     the mailbox name with wildcards
+    :param delimiter:   the hierarchy delimiter
+    :return:            the regular expression
+    """
+    regex = ''
+    for c in reference + pattern:
+        if c == '*':
+            regex += '.*'
+        elif c == '%':
+            regex += '[^' + re.escape(delimiter) + ']*'
+        else:
+            regex += re.escape(c)
+    return re.compile(regex)
+
+
+def _seq(mb: Mailbox, m: Mail) -> int:
+    """Get the sequence number of a mail.
+
+    :param mb:  the mailbox
+    :param m:   the mail
+    :return:    the sequence number
+    """
+    lo, hi = 0, len(mb.mails)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if mb.mails[mid].uid < m.uid:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo + 1
+
+
+class _Error(Exception):
+
+    """A command failed: the tagged response is NO or BAD."""
+
+    def __init__(self, status: str, text: str):
+        """Constructor.
+
+        :param status:  NO or BAD
+        :param text:    the text of the tagged response
+        """
+        super().__init__(text)
+        self.status = status
+        self.text = text
+
+
+class _Session(socketserver.BaseRequestHandler):
+
+    """A single client connection.
+
+    The commands are handled by the _cmd_* methods (e.g. _cmd_uid_fetch for UID FETCH). These
+    add the untagged responses and return the response code of the tagged OK (if any). A NO
+    or BAD is raised as _Error.
+    """
+
+    def setup(self) -> None:
+        self._buffer = b''
+        self._lines = collections.deque()
+        self._inflater = None
+        self._deflater = None
+        self._out = []
+        self._tag = None
+        self._authenticated = False
+        self._selected = None           # type: Optional[Mailbox]
+        self._readonly = False
+        with self.server.stats.lock:
+            self.server.stats.connections += 1
+
+    def handle(self) -> None:
+        self._send(f'* OK [CAPABILITY {self._capabilities()}] IMAP4rev1 stand-in ready\r\n'.encode())
+        while True:
+            arrival, line = self._next_line()
+            if line is None:
+                return
+            try:
+                tokens = tokenize(line)
+            except ValueError:
+                tokens = []
+            verb = tokens[1].upper() if len(tokens) > 1 and isinstance(tokens[1], str) else ''
+            if verb == 'UID' and len(tokens) > 2 and isinstance(tokens[2], str):
+                verb = 'UID ' + tokens[2].upper()
+            self._wait(arrival + self.server.latency_of(verb))
+            with self.server.stats.lock:
+                self.server.stats.commands[verb or 'INVALID'] += 1
+            if not self._execute(tokens, verb):
+                return
+
+    def _capabilities(self) -> str:
+        """The capabilities to announce.
+
+        :return:    the capabilities, separated by spaces
+        """
+        caps = ['IMAP4rev1']
+        if not self._authenticated:
+            caps.append('AUTH=PLAIN')
+        for ext in self.server.capabilities:
+            caps.append('COMPRESS=DEFLATE' if ext == 'COMPRESS' else ext)
+        return ' '.join(caps)
+
+    def _execute(self, tokens: list, verb: str) -> bool:
+        """Run a command and send the responses.
+
+        :param tokens:  the tokens of the command line
+        :param verb:    the command, e.g. 'UID FETCH'
+        :return:        go on with the session
+        """
+        if len(tokens) < 2 or not isinstance(tokens[0], str):
+            self._send(b'* BAD Malformed command\r\n')
+            return True
+        tag = self._tag = tokens[0]
+        handler = getattr(self, '_cmd_' + verb.lower().replace(' ', '_'), None)
+        status, text = 'OK', f'{verb} completed'
+        try:
+            if handler is None:
+                raise _Error('BAD', f'Unknown command {verb}')
+            if not self._authenticated and verb not in ('CAPABILITY', 'LOGIN', 'LOGOUT', 'NOOP'):
+                raise _Error('BAD', 'Not authenticated')
+            args = tokens[3:] if verb.startswith('UID ') else tokens[2:]
+            with self.server.account.lock:
+                code = handler(*args)
+            if code:
+                text = f'[{code}] {text}'
+        except _Error as e:
+            status, text = e.status, e.text
+        except (IndexError, TypeError, ValueError) as e:
+            status, text = 'BAD', f'Invalid arguments: {e}'
+        self._out.append(f'{tag} {status} {text}\r\n'.encode())
+        data, self._out = b''.join(self._out), []
+        for i in range(0, len(data), _SEND_CHUNK):
+            self._send(data[i:i + _SEND_CHUNK])
+        if verb == 'COMPRESS' and status == 'OK':
+            self._inflater = zlib.decompressobj(-15)
+            self._deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        return verb != 'LOGOUT'
+
+    def _fill(self, timeout: Optional[float]) -> bool:
+        """Receive whatever the client sent, noting the time each line arrived.
+
+        :param timeout:     the time to wait for data at most (None: block)
+        :return:            False if the client closed the connection
+        """
+        if timeout is not None:
+            readable, _, _ = select.select([self.request], [], [], max(timeout, 0))
+            if not readable:
+                return True
+        try:
+            data = self.request.recv(1 << 16)
+        except OSError:
+            return False
+        if not data:
+            return False
+        with self.server.stats.lock:
+            self.server.stats.bytes_received += len(data)
+        if self._inflater is not None:
+            data = self._inflater.decompress(data)
+        self._buffer += data
+        arrival = time.monotonic()
+        while b'\r\n' in self._buffer:
+            line, self._buffer = self._buffer.split(b'\r\n', 1)
+            self._lines.append((arrival, line.decode('utf-8', 'replace')))
+        return True
+
+    def _next_line(self) -> Tuple[float, Optional[str]]:
+        """Get the next command line.
+
+        :return:    the time the line arrived, the line (None if the client closed the connection)
+        """
+        while not self._lines:
+            if not self._fill(None):
+                return 0, None
+        return self._lines.popleft()
+
+    def _send(self, data: bytes) -> None:
+        """Send data to the client.
+
+        :param data:    the data
+        """
+        if self._deflater is not None:
+            data = self._deflater.compress(data) + self._deflater.flush(zlib.Z_SYNC_FLUSH)
+        try:
+            self.request.sendall(data)
+        except OSError:
+            return
+        with self.server.stats.lock:
+            self.server.stats.bytes_sent += len(data)
+
+    def _untagged(self, response: str) -> None:
+        """Add an untagged response.
+
+        :param response:    the response (without '* ' and CRLF)
+        """
+        self._out.append(b'* ' + response.encode() + b'\r\n')
+
+    def _wait(self, due: float) -> None:
+        """Wait until a time, receiving whatever the client sends meanwhile.
+
+        :param due:     the time to wait for (as time.monotonic)
+        """
+        now = time.monotonic()
+        while now < due:
+            if not self._fill(due - now):
+                return
+            now = time.monotonic()
+
+    # ---- helpers of the commands
+
+    def _fetch(self, mb: Mailbox, m: Mail, items: List[str], modseq: bool) -> bytes:
+        """Render the FETCH response of a single mail.
+
+        :param mb:      the mailbox
+        :param m:       the mail
+        :param items:   the data items asked for
+        :param modseq:  add the MODSEQ of the mail
+        :return:        the response
+        """
+        parts = [f'UID {m.uid}'.encode()]
+        message = None
+        seen = False
+        for item in items:
+            name = item.upper()
+            if name in ('UID', 'MODSEQ'):
+                modseq = modseq or name == 'MODSEQ'
+            elif name == 'FLAGS':
+                parts.append(f'FLAGS ({" ".join(sorted(m.flags))})'.encode())
+            elif name == 'INTERNALDATE':
+                parts.append(f'INTERNALDATE "{_format_internal_date(m.received)}"'.encode())
+            elif name == 'RFC822.SIZE':
+                message = message or self.server.account.message(m)
+                parts.append(f'RFC822.SIZE {len(message)}'.encode())
+            else:
+                s = _PATTERN_FETCH_SECTION.match(item)
+                if s is None:
+                    raise _Error('BAD', f'Unknown FETCH item {item}')
+                message = message or self.server.account.message(m)
+                header, _, body = message.partition(b'\r\n\r\n')
+                section = s.group('section')
+                fields = _PATTERN_HEADER_FIELDS.match(section)
+                if section == '':
+                    literal = message
+                elif section.upper() == 'HEADER':
+                    literal = header + b'\r\n\r\n'
+                elif section.upper() == 'TEXT':
+                    literal = body
+                elif fields is not None:
+                    literal = _header_fields(header, fields.group('fields').split())
+                else:
+                    raise _Error('BAD', f'Unknown section {section}')
+                parts.append(f'BODY[{section}] {{{len(literal)}}}\r\n'.encode() + literal)
+                seen = seen or s.group('name').upper() == 'BODY'
+        if seen and not self._readonly and '\\Seen' not in m.flags:
+            m.flags.add('\\Seen')
+            mb.touch(m)
+            parts.insert(1, f'FLAGS ({" ".join(sorted(m.flags))})'.encode())
+        if modseq:
+            parts.append(f'MODSEQ ({m.modseq})'.encode())
+        return f'* {_seq(mb, m)} FETCH ('.encode() + b' '.join(parts) + b')\r\n'
+
+    def _list_flags(self, name: str) -> str:
+        """The flags of a mailbox in a LIST response.
+
+        :param name:    the name of the mailbox
+        :return:        the flags
+        """
+        prefix = name + self.server.account.delimiter
+        if any(n.startswith(prefix) for n in self.server.account.mailboxes):
+            return '\\HasChildren'
+        return '\\HasNoChildren'
+
+    def _mailbox(self, name: str) -> Mailbox:
+        """Get a mailbox by name.
+
+        :param name:    the name of the mailbox
+        :return:        the mailbox
+        """
+        mb = self.server.account.mailboxes.get('INBOX' if name.upper() == 'INBOX' else name)
+        if mb is None:
+            raise _Error('NO', f'[TRYCREATE] No such mailbox: {name}')
+        return mb
+
+    def _search(self, mb: Mailbox, keys: list) -> List[Mail]:
+        """Get the mails matching SEARCH keys.
+
+        :param mb:      the mailbox
+        :param keys:    the search keys (all of them have to match)
+        :return:        the mails matching
+        """
+        mails = mb.mails
+        keys = list(keys)
+        while keys:
+            key = keys.pop(0)
+            if isinstance(key, list):
+                matching = {m.uid for m in self._search(mb, key)}
+                mails = [m for m in mails if m.uid in matching]
+                continue
+            key = key.upper()
+            if key == 'ALL':
+                continue
+            elif key in ('SEEN', 'DELETED', 'FLAGGED', 'ANSWERED', 'DRAFT'):
+                mails = [m for m in mails if '\\' + key.capitalize() in m.flags]
+            elif key in ('UNSEEN', 'UNDELETED', 'UNFLAGGED', 'UNANSWERED', 'UNDRAFT'):
+                mails = [m for m in mails if '\\' + key[2:].capitalize() not in m.flags]
+            elif key in ('SENTSINCE', 'SENTBEFORE', 'SENTON'):
+                day = _search_day(keys.pop(0))
+                mails = [m for m in mails if m.sent is not None and _compare(_day(m.sent), key, day)]
+            elif key in ('SINCE', 'BEFORE', 'ON'):
+                day = _search_day(keys.pop(0))
+                mails = [m for m in mails if _compare(_day(m.received), 'SENT' + key, day)]
+            elif key == 'UID':
+                uids = _uid_set(keys.pop(0), mb)
+                mails = [m for m in mails if m.uid in uids]
+            elif key == 'MODSEQ' and 'CONDSTORE' in self.server.capabilities:
+                modseq = int(keys.pop(0))
+                mails = [m for m in mails if m.modseq >= modseq]
+            elif key == 'NOT':
+                excluded = {m.uid for m in self._search(mb, [keys.pop(0)])}
+                mails = [m for m in mails if m.uid not in excluded]
+            else:
+                raise _Error('BAD', f'Unknown search key {key}')
+        return mails
+
+    def _selected_mailbox(self, write: bool = False) -> Mailbox:
+        """Get the mailbox selected.
+
+        :param write:   the mailbox is about to be changed
+        :return:        the mailbox selected
+        """
+        if self._selected is None or self.server.account.mailboxes.get(self._selected.name) is not self._selected:
+            raise _Error('BAD', 'No mailbox selected')
+        if write and self._readonly:
+            raise _Error('NO', 'Mailbox is read-only')
+        return self._selected
+
+    def _transfer(self, sequence_set: str, destination: str, move: bool) -> Optional[str]:
+        """Copy or move mails to another mailbox.
+
+        :param sequence_set:    the UIDs of the mails
+        :param destination:     the name of the destination mailbox
+        :param move:            remove the mails from the mailbox selected
+        :return:                the COPYUID response code (if UIDPLUS is supported)
+        """
+        mb = self._selected_mailbox(write=move)
+        target = self._mailbox(destination)
+        uids = _uid_set(sequence_set, mb)
+        source, copied = [], []
+        for m in mb.mails:
+            if m.uid in uids:
+                copy = target.add(m)
+                source.append(m.uid)
+                copied.append(copy.uid)
+        code = None
+        if source and 'UIDPLUS' in self.server.capabilities:
+            code = f'COPYUID {target.uid_validity} {_render_set(source)} {_render_set(copied)}'
+        if move:
+            for m in mb.mails:
+                if m.uid in uids:
+                    m.flags.add('\\Deleted')
+            for seq in mb.expunge(uids):
+                self._untagged(f'{seq} EXPUNGE')
+            if code is not None:
+                self._untagged(f'OK [{code}] Moved')
+                code = None
+        return code
+
+    # ---- the commands
+
+    def _cmd_capability(self) -> None:
+        self._untagged('CAPABILITY ' + self._capabilities())
+
+    def _cmd_close(self) -> None:
+        mb = self._selected_mailbox()
+        if not self._readonly:
+            mb.expunge()
+        self._selected = None
+
+    def _cmd_compress(self, mechanism: str) -> None:
+        if 'COMPRESS' not in self.server.capabilities or mechanism.upper() != 'DEFLATE':
+            raise _Error('BAD', 'Compression not supported')
+        if self._deflater is not None:
+            raise _Error('NO', '[COMPRESSIONACTIVE] Compression already active')
+
+    def _cmd_create(self, name: str) -> None:
+        name = name.rstrip(self.server.account.delimiter)
+        if name in self.server.account.mailboxes or name.upper() == 'INBOX':
+            raise _Error('NO', '[ALREADYEXISTS] Mailbox exists')
+        self.server.account.create(name)
+
+    def _cmd_delete(self, name: str) -> None:
+        if name.upper() == 'INBOX':
+            raise _Error('NO', 'INBOX cannot be deleted')
+        mb = self._mailbox(name)
+        del self.server.account.mailboxes[mb.name]
+        self.server.account.subscribed.discard(mb.name)
+
+    def _cmd_examine(self, name: str) -> str:
+        return self._select(name, True)
+
+    def _cmd_expunge(self) -> None:
+        mb = self._selected_mailbox(write=True)
+        for seq in mb.expunge():
+            self._untagged(f'{seq} EXPUNGE')
+
+    def _cmd_list(self, reference: str, pattern: str, *options) -> None:
+        status_items = None
+        if len(options) == 2 and options[0].upper() == 'RETURN' and 'LIST-STATUS' in self.server.capabilities:
+            if len(options[1]) == 2 and str(options[1][0]).upper() == 'STATUS':
+                status_items = [i.upper() for i in options[1][1]]
+        elif options:
+            raise _Error('BAD', 'Unknown LIST options')
+        self._list('LIST', reference, pattern, self.server.account.mailboxes, status_items)
+
+    def _list(self, command: str, reference: str, pattern: str, names: Iterable[str],
+              status_items: Optional[List[str]] = None) -> None:
+        """Add the responses to a LIST or LSUB.
+
+        :param command:         LIST or LSUB
+        :param reference:       the reference name
+        :param pattern:         the mailbox name with wildcards
+        :param names:           the names of the mailboxes to match
+        :param status_items:    the STATUS items to return along (LIST-STATUS)
+        """
+        delimiter = self.server.account.delimiter
+        regex = _list_pattern(reference, pattern, delimiter)
+        for name in sorted(names):
+            if regex.fullmatch(name) is None and not (name == 'INBOX' and regex.fullmatch('inbox')):
+                continue
+            self._untagged(f'{command} ({self._list_flags(name)}) "{delimiter}" {_quote(name)}')
+            if status_items:
+                self._status(self.server.account.mailboxes[name], status_items)
+
+    def _cmd_login(self, user: str, password: str) -> str:
+        if (user, password) != (self.server.user, self.server.password):
+            raise _Error('NO', '[AUTHENTICATIONFAILED] Invalid credentials')
+        self._authenticated = True
+        return 'CAPABILITY ' + self._capabilities()
+
+    def _cmd_logout(self) -> None:
+        self._untagged('BYE Logging out')
+
+    def _cmd_lsub(self, reference: str, pattern: str) -> None:
+        self._list('LSUB', reference, pattern, self.server.account.subscribed & set(self.server.account.mailboxes))
+
+    def _cmd_noop(self) -> None:
+        pass
+
+    def _cmd_select(self, name: str) -> str:
+        return self._select(name, False)
+
+    def _select(self, name: str, readonly: bool) -> str:
+        """Select a mailbox.
+
+        :param name:        the name of the mailbox
+        :param readonly:    EXAMINE instead of SELECT
+        :return:            the response code
+        """
+        self._selected = None
+        mb = self._mailbox(name)
+        self._untagged('FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+        self._untagged(f'{len(mb.mails)} EXISTS')
+        self._untagged('0 RECENT')
+        self._untagged(f'OK [UIDVALIDITY {mb.uid_validity}] UIDs valid')
+        self._untagged(f'OK [UIDNEXT {mb.uid_next}] Predicted next UID')
+        if 'CONDSTORE' in self.server.capabilities:
+            self._untagged(f'OK [HIGHESTMODSEQ {mb.highest_modseq}] Highest')
+        self._selected = mb
+        self._readonly = readonly
+        return 'READ-ONLY' if readonly else 'READ-WRITE'
+
+    def _cmd_status(self, name: str, items: list) -> None:
+        self._status(self._mailbox(name), [i.upper() for i in items])
+
+    def _status(self, mb: Mailbox, items: List[str]) -> None:
+        """Add a STATUS response.
+
+        :param mb:      the mailbox
+        :param items:   the status items
+        """
+        values = []
+        for item in items:
+            value = mb.status(item) if item != 'HIGHESTMODSEQ' or 'CONDSTORE' in self.server.capabilities else None
+            if value is None:
+                raise _Error('BAD', f'Unknown STATUS item {item}')
+            values.append(f'{item} {value}')
+        self._untagged(f'STATUS {_quote(mb.name)} ({" ".join(values)})')
+
+    def _cmd_subscribe(self, name: str) -> None:
+        self.server.account.subscribed.add(self._mailbox(name).name)
+
+    def _cmd_uid_copy(self, sequence_set: str, destination: str) -> Optional[str]:
+        return self._transfer(sequence_set, destination, False)
+
+    def _cmd_uid_expunge(self, sequence_set: str) -> None:
+        if 'UIDPLUS' not in self.server.capabilities:
+            raise _Error('BAD', 'UID EXPUNGE not supported')
+        mb = self._selected_mailbox(write=True)
+        for seq in mb.expunge(_uid_set(sequence_set, mb)):
+            self._untagged(f'{seq} EXPUNGE')
+
+    def _cmd_uid_fetch(self, sequence_set: str, items, modifiers: list = None) -> None:
+        mb = self._selected_mailbox()
+        items = items if isinstance(items, list) else [items]
+        changed_since = None
+        if modifiers is not None:
+            if 'CONDSTORE' not in self.server.capabilities or len(modifiers) != 2 or \
+                    modifiers[0].upper() != 'CHANGEDSINCE':
+                raise _Error('BAD', 'Unknown FETCH modifier')
+            changed_since = int(modifiers[1])
+        uids = _uid_set(sequence_set, mb)
+        for m in mb.mails:
+            if m.uid in uids and (changed_since is None or m.modseq > changed_since):
+                self._out.append(self._fetch(mb, m, items, changed_since is not None))
+
+    def _cmd_uid_move(self, sequence_set: str, destination: str) -> None:
+        if 'MOVE' not in self.server.capabilities:
+            raise _Error('BAD', 'MOVE not supported')
+        self._transfer(sequence_set, destination, True)
+
+    def _cmd_uid_search(self, *keys) -> None:
+        mb = self._selected_mailbox()
+        keys = list(keys)
+        count = False
+        if keys and str(keys[0]).upper() == 'RETURN':
+            if 'ESEARCH' not in self.server.capabilities:
+                raise _Error('BAD', 'ESEARCH not supported')
+            options = [o.upper() for o in keys[1]]
+            if options not in ([], ['ALL'], ['COUNT']):
+                raise _Error('BAD', 'Unsupported SEARCH return options')
+            count = options == ['COUNT']
+            keys = keys[2:]
+        if keys and str(keys[0]).upper() == 'CHARSET':
+            keys = keys[2:]
+        mails = self._search(mb, keys)
+        if count:
+            self._untagged(f'ESEARCH (TAG "{self._tag}") UID COUNT {len(mails)}')
+        else:
+            self._untagged('SEARCH' + ''.join(f' {m.uid}' for m in mails))
+
+    def _cmd_uid_store(self, sequence_set: str, operation: str, flags) -> None:
+        mb = self._selected_mailbox(write=True)
+        flags = set(flags if isinstance(flags, list) else [flags])
+        operation = operation.upper()
+        silent = operation.endswith('.SILENT')
+        operation = operation.replace('.SILENT', '')
+        if operation not in ('FLAGS', '+FLAGS', '-FLAGS'):
+            raise _Error('BAD', f'Unknown STORE operation {operation}')
+        uids = _uid_set(sequence_set, mb)
+        for m in mb.mails:
+            if m.uid not in uids:
+                continue
+            if operation == 'FLAGS':
+                m.flags = set(flags)
+            elif operation == '+FLAGS':
+                m.flags |= flags
+            else:
+                m.flags -= flags
+            mb.touch(m)
+            if not silent:
+                self._out.append(self._fetch(mb, m, ['FLAGS'], 'CONDSTORE' in self.server.capabilities))
+
+    def _cmd_unselect(self) -> None:
+        if 'UNSELECT' not in self.server.capabilities:
+            raise _Error('BAD', 'Unknown command UNSELECT')
+        self._selected_mailbox()
+        self._selected = None
+
+    def _cmd_unsubscribe(self, name: str) -> None:
+        self.server.account.subscribed.discard(name)
+
+
+class Server(socketserver.ThreadingTCPServer):
+
+    """The IMAP4rev1 stand-in serving an Account on a local port, in a thread of its own.
+
+    Several connections are served at once (each by a thread), one command at a time per
+    account.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, account: Account, capabilities: Iterable[str] = EXTENSIONS, latency: float = 0.0,
+                 latencies: Dict[str, float] = None, user: str = 'bench', password: str = 'bench',
+                 host: str = '127.0.0.1', port: int = 0):
+        """Constructor.
+
+        :param account:         the account to serve
+        :param capabilities:    the extensions to support (see EXTENSIONS)
+        :param latency:         the latency of a command (seconds)
+        :param latencies:       the latency per command, e.g. {'UID FETCH': 0.1} (seconds)
+        :param user:            the user to accept
+        :param password:        the password of the user
+        :param host:            the address to listen on
+        :param port:            the port to listen on (0: any port free)
+        """
+        unknown = set(capabilities) - set(EXTENSIONS)
+        if unknown:
+            raise ValueError('Unknown extensions: ' + ', '.join(sorted(unknown)))
+        super().__init__((host, port), _Session)
+        self.account = account
+        self.capabilities = [c for c in EXTENSIONS if c in capabilities]
+        self.latency = latency
+        self.latencies = dict(latencies or {})
+        self.user = user
+        self.password = password
+        self.stats = Stats()
+        self._thread = None
+
+    def __enter__(self) -> 'Server':
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        """The host and port the server listens on."""
+        return self.server_address[:2]
+
+    def latency_of(self, command: str) -> float:
+        """Get the latency of a command.
+
+        :param command:     the command, e.g. 'UID FETCH'
+        :return:            the latency (seconds)
+        """
+        return self.latencies.get(command, self.latency)
+
+    def reset_stats(self) -> None:
+        """Start counting anew."""
+        self.stats = Stats()
+
+    def start(self) -> None:
+        """Serve in a thread of its own."""
+        self._thread = threading.Thread(target=self.serve_forever, name='imap-server', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def account_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options of the synthetic account and the server to a command line parser.
+
+    :param parser:  the parser
+    """
+    parser.add_argument('--mails', type=int, default=10000, help='number of mails')
+    parser.add_argument('--mailboxes', type=int, default=20, help='number of mailboxes')
+    parser.add_argument('--depth', type=int, default=3, help='maximum depth of the mailbox tree')
+    parser.add_argument('--header-size', type=int, default=2000, help='mean size of a header (bytes)')
+    parser.add_argument('--body-size', type=int, default=4000, help='mean size of a body (bytes)')
+    parser.add_argument('--years', type=int, nargs=2, default=(2010, 2020), metavar=('FIRST', 'LAST'),
+                        help='years the mails are sent in')
+    parser.add_argument('--distribution', choices=('uniform', 'recent'), default='uniform',
+                        help='distribution of the dates of the mails')
+    parser.add_argument('--seen', type=float, default=0.9, help='share of the mails seen')
+    parser.add_argument('--deleted', type=float, default=0.0, help='share of the mails flagged deleted')
+    parser.add_argument('--undated', type=float, default=0.0, help='share of the mails without Date header')
+    parser.add_argument('--empty', type=float, default=0.1, help='share of the mailboxes without mails')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the generator')
+    parser.add_argument('--without', action='append', default=[], choices=EXTENSIONS,
+                        help='do not support an extension (may be repeated)')
+    parser.add_argument('--latency', action='append', default=[], metavar='[COMMAND=]SECONDS',
+                        help="latency of all commands or of a single one, e.g. 0.02 or 'UID FETCH=0.1' "
+                             '(may be repeated)')
+
+
+def account_from_arguments(args: argparse.Namespace) -> Account:
+    """Create the account as given on the command line (see account_arguments).
+
+    :param args:    the parsed command line
+    :return:        the account
+    """
+    return Account(mails=args.mails, mailboxes=args.mailboxes, depth=args.depth, header_size=args.header_size,
+                   body_size=args.body_size, years=tuple(args.years), distribution=args.distribution,
+                   seen=args.seen, deleted=args.deleted, undated=args.undated, empty=args.empty, seed=args.seed)
+
+
+def server_from_arguments(args: argparse.Namespace, account: Account, port: int = 0) -> Server:
+    """Create the server as given on the command line (see account_arguments).
+
+    :param args:        the parsed command line
+    :param account:     the account to serve
+    :param port:        the port to listen on
+    :return:            the server (not started yet)
+    """
+    latency, latencies = 0.0, {}
+    for spec in args.latency:
+        command, _, seconds = spec.rpartition('=')
+        if command:
+            latencies[command.upper()] = float(seconds)
+        else:
+            latency = float(seconds)
+    capabilities = [c for c in EXTENSIONS if c not in args.without]
+    return Server(account, capabilities, latency, latencies, port=port)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve a synthetic IMAP4 account on a local port.')
+    account_arguments(parser)
+    parser.add_argument('--port', type=int, default=1143, help='port to listen on')
+    args = parser.parse_args()
+
+    server = server_from_arguments(args, account_from_arguments(args), args.port)
+    host, port = server.address
+    print(f'Serving {args.mails} mails in {args.mailboxes} mailboxes on {host}:{port} '
+          f'(user {server.user}, password {server.password}, extensions: {" ".join(server.capabilities)})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
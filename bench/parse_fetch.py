@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------
+# bench/parse_fetch.py
+#
+# benchmark of the FETCH response parser
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""Benchmark the FETCH response parser against the former ways of dating mails.
+
+The response to a FETCH of UID, INTERNALDATE and a header of each mail is generated just like
+imaplib hands it over and parsed by
+
+    - str:      the very first approach: decode each prefix, split the header into lines,
+                str() the Date line and hand it over to email.utils.parsedate
+    - regex:    the regular expressions on bytes used before imaparchiver.fetch
+    - fetch:    imaparchiver.fetch.parse_fetch
+
+All of them must agree on the dates. The CPU time is reported per 100k headers.
+
+Usage:
+
+    python3 bench/parse_fetch.py [MAILS] [--header fields|full]
+"""
+
+import argparse
+import email.utils
+import os
+import random
+import re
+import sys
+import time
+from typing import Dict, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from imaparchiver import fetch                                                      # noqa: E402
+
+
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def generate(count: int, full: bool, seed: int = 42) -> list:
+    """Generate the response to a FETCH of UID, INTERNALDATE and a header per mail.
+
+    :param count:   number of mails
+    :param full:    generate whole headers (BODY[HEADER]) instead of the Date field only
+    :param seed:    seed of the random generator
+    :return:        the response as handed over by imaplib
+    """
+    rnd = random.Random(seed)
+    fetch_data = []
+    for i in range(1, count + 1):
+        t = time.gmtime(rnd.randint(946684800, 1577836800))
+        date = '%s, %d %s %d %02d:%02d:%02d %+05d' % (_DAYS[t.tm_wday], t.tm_mday, _MONTHS[t.tm_mon - 1], t.tm_year,
+                                                      t.tm_hour, t.tm_min, t.tm_sec, rnd.choice((0, 100, -500, 200)))
+        if rnd.random() < 0.05:
+            date = date.replace(' %d ' % t.tm_year, ' %d\r\n ' % t.tm_year)
+        internal_date = '%02d-%s-%d %02d:%02d:%02d +0000' % (t.tm_mday, _MONTHS[t.tm_mon - 1], t.tm_year,
+                                                             t.tm_hour, t.tm_min, t.tm_sec)
+        header = f'Date: {date}\r\n'
+        item = 'BODY[HEADER.FIELDS (DATE)]'
+        if full:
+            item = 'BODY[HEADER]'
+            header = ''.join(f'Received: from relay{j}.example.com (relay{j}.example.com [10.0.0.{j}])\r\n'
+                             f'\tby mx{j}.example.com (Postfix) with ESMTPS id {rnd.getrandbits(40):X}\r\n'
+                             f'\tfor <archive@example.com>; {date}\r\n'
+                             for j in range(rnd.randint(3, 8)))
+            header += ('DKIM-Signature: v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.com; s=mail;\r\n'
+                       '\th=from:to:subject:date:message-id:mime-version;\r\n'
+                       f'\tbh={rnd.getrandbits(256):x};\r\n'
+                       f'\tb={rnd.getrandbits(512):x}\r\n\t{rnd.getrandbits(512):x}\r\n'
+                       'Authentication-Results: mx.example.com; dkim=pass header.d=example.com;\r\n'
+                       '\tspf=pass smtp.mailfrom=example.com\r\n'
+                       f'From: Sender {i} <sender{i}@example.com>\r\nTo: <archive@example.com>\r\n'
+                       f'Subject: Message number {i}\r\nDate: {date}\r\n'
+                       f'Message-ID: <{rnd.getrandbits(64):x}@example.com>\r\n'
+                       'MIME-Version: 1.0\r\nContent-Type: text/plain; charset=utf-8\r\n'
+                       'Content-Transfer-Encoding: quoted-printable\r\nX-Mailer: bench\r\n')
+        literal = (header + '\r\n').encode()
+        prefix = f'{i} (UID {i + 1000} INTERNALDATE "{internal_date}" {item} {{{len(literal)}}}'.encode()
+        fetch_data.append((prefix, literal))
+        fetch_data.append(b')')
+    return fetch_data
+
+
+def parse_fetch(fetch_data: list) -> Dict[int, Optional[tuple]]:
+    """Date mails by imaparchiver.fetch.
+
+    :param fetch_data:  the response to the FETCH
+    :return:            the header date per mail id
+    """
+    return {m.uid: m.header_date for m in fetch.parse_fetch(fetch_data)}
+
+
+_PATTERN_DATE_FIELD = re.compile(rb'^date:[ \t]*(?P<date>.*?)(?:\r?\n(?![ \t])|\Z)',
+                                 re.IGNORECASE | re.MULTILINE | re.DOTALL)
+_PATTERN_FETCH_START = re.compile(rb'^\d+ \(')
+_PATTERN_FETCH_UID = re.compile(rb'[( ]UID (?P<uid>\d+)')
+_PATTERN_INTERNALDATE = re.compile(rb'INTERNALDATE "(?P<day> ?\d+)-(?P<month>[A-Za-z]{3})-(?P<year>\d{4}) '
+                                   rb'(?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d) [-+]\d{4}"')
+
+
+def parse_regex(fetch_data: list) -> Dict[int, Optional[tuple]]:
+    """Date mails by the regular expressions on bytes used before imaparchiver.fetch.
+
+    :param fetch_data:  the response to the FETCH
+    :return:            the header date per mail id
+    """
+    mails = []
+    for d in fetch_data:
+        prefix = d[0] if isinstance(d, tuple) else d
+        if _PATTERN_FETCH_START.match(prefix) is not None:
+            mails.append([None, []])
+        m = _PATTERN_FETCH_UID.search(prefix)
+        if m is not None:
+            mails[-1][0] = int(m.group('uid'))
+        mails[-1][1].append(d)
+
+    dates = {}
+    for mail_id, mail_data in mails:
+        header_date = None
+        for d in mail_data:
+            prefix = d[0] if isinstance(d, tuple) else d
+            _PATTERN_INTERNALDATE.search(prefix)
+            if isinstance(d, tuple):
+                m = _PATTERN_DATE_FIELD.search(d[1])
+                if m is not None:
+                    date = m.group('date').replace(b'\r\n', b'').replace(b'\n', b'').decode('ascii', 'replace')
+                    header_date = email.utils.parsedate(date)
+        dates[mail_id] = header_date
+    return dates
+
+
+def parse_str(fetch_data: list) -> Dict[int, Optional[tuple]]:
+    """Date mails the very first way: str() of each Date line. Folded Date fields are not understood.
+
+    :param fetch_data:  the response to the FETCH
+    :return:            the header date per mail id (the sequence number, actually)
+    """
+    dates = {}
+    pattern_mail_id = re.compile('(?P<msgid>.*?) .*')
+    for h in fetch_data:
+        if isinstance(h, tuple):
+            mail_id = pattern_mail_id.match(h[0].decode()).groups()[0]
+            for mh in h[1].split(b'\r\n'):
+                if mh.startswith(b'Date:'):
+                    dates[mail_id] = email.utils.parsedate(str(mh)[8:])
+    return dates
+
+
+def run(name: str, parse, fetch_data: list, headers: int) -> float:
+    """Run a single parser and report its CPU time.
+
+    :param name:        name of the parser
+    :param parse:       the parser
+    :param fetch_data:  the response to the FETCH
+    :param headers:     number of headers in the response
+    :return:            CPU time per 100k headers (seconds)
+    """
+    fetch._parse_day.cache_clear()
+    start = time.process_time()
+    parse(fetch_data)
+    cpu = (time.process_time() - start) * 100000 / headers
+    print('%-8s %8.3f s CPU per 100k headers' % (name, cpu))
+    return cpu
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the FETCH response parser.')
+    parser.add_argument('mails', type=int, nargs='?', default=100000, help='number of mails')
+    parser.add_argument('--header', choices=('fields', 'full'), default='fields',
+                        help='fetch the Date header field only (fields) or the whole header (full)')
+    args = parser.parse_args()
+
+    fetch_data = generate(args.mails, args.header == 'full')
+    expected = parse_fetch(fetch_data)
+    if parse_regex(fetch_data) != expected:
+        sys.exit('parse_fetch and the regular expressions disagree')
+    for d, m in zip(expected.values(), (email.utils.parsedate(d[1].decode()[6:].replace('\r\n', ''))
+                                        for d in fetch_data if isinstance(d, tuple) and args.header == 'fields')):
+        if d != m:
+            sys.exit(f'parse_date and email.utils.parsedate disagree: {d} != {m}')
+
+    print(f'{args.mails} mails, header: {args.header}')
+    cpu_str = run('str', parse_str, fetch_data, args.mails)
+    cpu_regex = run('regex', parse_regex, fetch_data, args.mails)
+    cpu_fetch = run('fetch', parse_fetch, fetch_data, args.mails)
+    print('speedup  %8.1fx over str, %.1fx over regex' % (cpu_str / cpu_fetch, cpu_regex / cpu_fetch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1113 @@
+# ------------------------------------------------------------
+# imaparchiver/aio.py
+#
+# the asyncio engine
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module contains the asyncio engine.
+
+The Connection, Mailbox and ConnectionPool in here are the counterparts of the blocking ones
+but speak IMAP4 on asyncio streams themselves. So a single event loop drives any number of
+connections - to a single account or to several accounts at once:
+
+>>> async def main():
+...     pools = [aio.ConnectionPool(host, 0, user, password, 20) for user, password in accounts]
+...     await asyncio.gather(*(aio.scan(pool, 'INBOX') for pool in pools))
+...     await asyncio.gather(*(pool.close() for pool in pools))
+
+The responses are handed over in the very same format imaplib does, hence the response
+parsers of the blocking engine apply. Which mailboxes are worked on and which mails are old
+is decided by the policy module for both engines, the work on each mailbox is done by the
+operations module (see run_steps).
+"""
+
+import asyncio
+import base64
+import collections
+import functools
+import hmac
+import imaplib
+import inspect
+import re
+import ssl
+import sys
+import time
+import weakref
+from typing import AsyncIterator, BinaryIO, Callable, Deque, Dict, Generator, Iterable, List, Optional, Set, Tuple
+
+from . import color
+from . import connection
+from . import mailbox
+from .batch import response_size
+from .changes import MailboxChanges
+from .compress import DeflateStreamReader, DeflateStreamWriter
+from .config import Config
+from .idset import IdSet
+from .index import Index
+from .mailbox import (
+    bisect_years,
+    check_response,
+    date_fetch_parts,
+    dates_from_fetch,
+    inspect_criteria,
+    merge_years,
+    parse_esearch_count,
+    parse_status,
+    undated_mails,
+    year_search_criteria,
+    year_span,
+    years_from_dates
+)
+from .operations import download_mailbox, move_mailbox, print_scan_header, scan_mailbox, scan_status_items
+from .policy import select_mailboxes
+from .pool import collect_output, redirect_output, replay_output
+from .stats import Recorder
+from .steps import each
+
+
+# a single response line may hold a SEARCH result of millions of mail ids
+_LINE_LIMIT = 1 << 28
+
+# literals streamed to a file are read in chunks of this size
+_CHUNK_SIZE = 1 << 16
+
+_PATTERN_LITERAL = re.compile(rb'\{(?P<size>\d+)\}$')
+_PATTERN_RESPONSE_CODE = re.compile(rb'\[(?P<type>[A-Z-]+)( (?P<data>.*))?\]')
+_PATTERN_TAGGED = re.compile(rb'(?P<tag>[A-Za-z0-9]+) (?P<type>[A-Z]+)( (?P<data>.*))?')
+_PATTERN_UNTAGGED = re.compile(rb'\* (?P<type>[A-Z-]+)( (?P<data>.*))?')
+_PATTERN_UNTAGGED_STATUS = re.compile(rb'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?')
+
+
+def _quote(arg: str) -> str:
+    """Quote a string argument of an IMAP4 command.
+
+    :param arg:     the argument
+    :return:        the argument as quoted string
+    """
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class Connection(connection.Connection):
+
+    """An IMAP4 connection driven by asyncio streams.
+
+    All methods talking to the server are coroutines here. Use Connection.open() to get a
+    connected and authenticated instance.
+    """
+
+    # mailbox creation is serialized among all connections of an event loop
+    _create_mailbox_locks = weakref.WeakKeyDictionary()     # type: weakref.WeakKeyDictionary
+
+    def __init__(self):
+        """Constructor."""
+        self._connection = None
+        self._capabilities = []
+        self._reader = None
+        self._writer = None
+        self._tag_number = 0
+        self._tagged_responses = {}
+        self._continuation = None
+        self.untagged_responses = {}
+        self.selected = None            # type: Optional[Tuple[str, bool]]
+        self._recorder = None           # type: Optional[Recorder]
+        self._account = None            # type: Optional[Tuple[str, int, str]]
+        self._hierarchies = {}          # type: connection.Hierarchies
+
+    def __del__(self):
+        """Destructor: a LOGOUT needs the event loop, so the transport is closed only (see close)."""
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+
+    async def close(self) -> None:
+        """Log out and close the connection (see Connection.close: no CLOSE, but UNSELECT)."""
+        if self._writer is None:
+            return
+        try:
+            if self.selected is not None and not self.selected[1] and 'UNSELECT' in self._capabilities:
+                await self.command('UNSELECT')
+            self.selected = None
+            await self.command('LOGOUT')
+        except Exception:
+            pass
+        self._writer.close()
+        self._writer = None
+
+    async def command(self, name: str, *args) -> Tuple[str, List]:
+        """Run an IMAP4 command and wait for its completion.
+
+        The untagged responses are kept in untagged_responses (by type) just like imaplib does.
+
+        :param name:    the IMAP4 command
+        :param args:    the command arguments
+        :return:        return code, data of the tagged response
+        """
+        tag = await self._command(name, *args)
+        return await self._command_complete(name, tag)
+
+    async def _command(self, name: str, *args) -> str:
+        """Send an IMAP4 command without waiting for its completion.
+
+        :param name:    the IMAP4 command
+        :param args:    the command arguments
+        :return:        the tag of the command
+        """
+        if self._writer is None:
+            raise RuntimeError('No connection to IMAP4 server.')
+        for typ in ('OK', 'NO', 'BAD'):
+            self.untagged_responses.pop(typ, None)
+
+        self._tag_number += 1
+        tag = f'A{self._tag_number}'
+        self._tagged_responses[tag] = None
+        line = ' '.join([tag, name] + [str(a) for a in args]).encode() + b'\r\n'
+        if self._recorder is not None:
+            self._recorder.start(name, args)
+            self._recorder.sent(len(line))
+            self._recorder.started(tag.encode())
+        self._writer.write(line)
+        await self._writer.drain()
+        return tag
+
+    async def _command_complete(self, name: str, tag: str) -> Tuple[str, List]:
+        """Wait for the completion of a command sent before.
+
+        :param name:    the IMAP4 command
+        :param tag:     the tag of the command
+        :return:        return code, data of the tagged response
+        """
+        while self._tagged_responses.get(tag) is None:
+            await self._get_response()
+            if 'BYE' in self.untagged_responses and name != 'LOGOUT':
+                raise imaplib.IMAP4.abort(str(self.untagged_responses.pop('BYE')[-1]))
+        res, data = self._tagged_responses.pop(tag)
+        if res == 'BAD':
+            raise imaplib.IMAP4.error(f'{name} command error: {res} {data}')
+        return res, data
+
+    async def _compress(self) -> None:
+        """Switch on COMPRESS=DEFLATE (see Connection._compress)."""
+        if Config().no_compress is True or 'COMPRESS=DEFLATE' not in self.capabilities:
+            return
+        try:
+            res, data = await self.command('COMPRESS', 'DEFLATE')
+        except imaplib.IMAP4.error:
+            res = 'BAD'
+        if res != 'OK':
+            sys.stderr.write(color.error('failed to switch to COMPRESS=DEFLATE, going on uncompressed.\n'))
+            return
+        self._reader = DeflateStreamReader(self._reader, _LINE_LIMIT)
+        self._writer = DeflateStreamWriter(self._writer)
+        if Config().verbose is True:
+            sys.stderr.write(color.success('Switched to COMPRESS=DEFLATE.\n'))
+
+    async def create_mailbox(self, path: str, delimiter: str) -> None:
+        """Create a mailbox folder (recursively) on the server.
+
+        Just like Connection.create_mailbox the creation is serialized among all connections
+        running on the same event loop.
+
+        :param str path:        the mailbox folder name as understood by the IMAP4 server.
+        :param str delimiter:   path delimier used
+        """
+        if self._writer is None:
+            raise RuntimeError('No connection to IMAP4 server.')
+
+        if len(path) == 0:
+            return
+
+        lock = Connection._create_mailbox_locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+        async with lock:
+            await self._create_mailbox(path, delimiter)
+
+    async def _create_mailbox(self, path: str, delimiter: str) -> None:
+        """Create a mailbox folder (recursively) on the server without any locking (see Connection._create_mailbox).
+
+        :param str path:        the mailbox folder name as understood by the IMAP4 server.
+        :param str delimiter:   path delimier used
+        """
+        path_stripped = mailbox.Mailbox.strip_path(path)
+        existing, subscribed = await self._hierarchy(path_stripped.split(delimiter)[0])
+        mb = ''
+        for path_particle in path_stripped.split(delimiter):
+
+            if len(mb) > 0:
+                mb = mb + delimiter
+            mb = mb + path_particle
+
+            mb_quoted = mb
+            if ' ' in mb:
+                mb_quoted = '"' + mb + '"'
+
+            if mb not in existing:
+                res, data = await self.command('CREATE', mb_quoted)
+                if res != 'OK' and not await self._create_failed_as_existing(data, mb_quoted):
+                    raise RuntimeError(f'Failed to create mailbox {mb}: {data}')
+                existing.add(mb)
+            if mb not in subscribed:
+                await self.command('SUBSCRIBE', mb_quoted)
+                subscribed.add(mb)
+
+    async def _create_failed_as_existing(self, data: List, mb_quoted: str) -> bool:
+        """Check if a failed CREATE is due to the mailbox being there already.
+
+        See Connection._create_failed_as_existing.
+
+        :param data:        the data of the tagged NO response to CREATE
+        :param mb_quoted:   the mailbox as sent with CREATE
+        :return:            True, if the mailbox exists
+        """
+        if Connection._already_exists(data):
+            return True
+        res, data = await self.command('LIST', '""', mb_quoted)
+        return res == 'OK' and len(self.untagged_responses.pop('LIST', [])) > 0
+
+    async def establish(self, host: str, port: int) -> None:
+        """Establishes a connection to the IMAP4 server.
+
+        :param host:    the IMAP4 server host
+        :param port:    the port to connect to
+        """
+        if Config().verbose is True:
+            sys.stderr.write('Connecting... ')
+
+        port = self._fix_port(port)
+
+        try:
+            ssl_context = ssl.create_default_context() if Config().ssl is True else None
+            self._reader, self._writer = await asyncio.open_connection(host, port, ssl=ssl_context,
+                                                                       limit=_LINE_LIMIT)
+            if Config().stats is not None or Config().trace is not None:
+                self._recorder = Recorder(self, Config().stats, Config().trace)
+            while 'OK' not in self.untagged_responses and 'PREAUTH' not in self.untagged_responses:
+                await self._get_response()
+                if 'BYE' in self.untagged_responses:
+                    raise imaplib.IMAP4.abort(str(self.untagged_responses['BYE'][-1]))
+
+        except Exception as e:
+            sys.stderr.write(color.error(f'failed to connect {host}:{port}\n' + str(e)) + '\n')
+            self._writer = None
+            sys.exit(1)
+
+        if Config().verbose is True:
+            sys.stdout.write(color.success('connected.\n') + 'Checking capabilities...')
+
+        if not await self._read_capabilities():
+            sys.stderr.write(color.error('failed to check capabilities of remote host.\n'))
+            sys.exit(1)
+        if Config().verbose is True:
+            sys.stderr.write(color.success('done.\n'))
+        self._dump_capabilities()
+
+        if 'STARTTLS' in self.capabilities and Config().ssl is False:
+            res, data = await self.command('STARTTLS')
+            if res != 'OK' or not hasattr(self._writer, 'start_tls'):
+                sys.stderr.write(color.error('failed to switch to STARTTLS.\n'))
+                sys.exit(1)
+            await self._writer.start_tls(ssl.create_default_context(), server_hostname=host)
+            await self._read_capabilities()
+            if Config().verbose is True:
+                sys.stderr.write(color.success('Switched to STARTTLS.\n'))
+
+    async def expunge(self) -> Tuple[str, List]:
+        """Permanently remove all mails marked as deleted in the selected mailbox.
+
+        :return:    return code, expunged message numbers
+        """
+        res, data = await self.command('EXPUNGE')
+        return res, self.untagged_responses.pop('EXPUNGE', [None])
+
+    async def fetch_stream(self, sequence_set: str, message_parts: str,
+                           literal_file: Callable[[bytes], Optional[BinaryIO]]) -> AsyncIterator[List]:
+        """Run an UID FETCH and hand over the response mail by mail, while it is received.
+
+        See Connection.fetch_stream.
+
+        :param sequence_set:    the mail ids
+        :param message_parts:   the message parts to fetch
+        :param literal_file:    gives the file to write a literal to (or None to keep it in memory)
+        :return:                an async iterator over the data of each mail
+        """
+        tag = await self._command('UID', 'FETCH', sequence_set, message_parts)
+        while self._tagged_responses.get(tag) is None:
+            await self._get_response(literal_file)
+            if 'BYE' in self.untagged_responses:
+                raise imaplib.IMAP4.abort(str(self.untagged_responses.pop('BYE')[-1]))
+            if 'FETCH' in self.untagged_responses:
+                yield self.untagged_responses.pop('FETCH')
+        res, data = await self._command_complete('UID', tag)
+        if res != 'OK':
+            raise RuntimeError('Server error on fetching mails. Returned: ' + str(res))
+
+    async def _get_response(self, literal_file: Callable[[bytes], Optional[BinaryIO]] = None) -> None:
+        """Read a single response of the server (including its literals) and keep it.
+
+        :param literal_file:    gives the file to write a FETCH literal to (see fetch_stream)
+        """
+        line = await self._readline()
+        if line.startswith(b'+'):
+            self._continuation = line[2:]
+            return
+
+        m = _PATTERN_UNTAGGED_STATUS.fullmatch(line) or _PATTERN_UNTAGGED.fullmatch(line)
+        tag = None
+        if m is None:
+            m = _PATTERN_TAGGED.fullmatch(line)
+            if m is None or m.group('tag').decode() not in self._tagged_responses:
+                raise imaplib.IMAP4.abort(f'unexpected response: {line!r}')
+            tag = m.group('tag').decode()
+
+        typ = m.group('type').decode()
+        data = m.group('data') or b''
+        if 'data2' in m.groupdict() and m.group('data2') is not None:
+            data = data + b' ' + m.group('data2')
+
+        if tag is not None:
+            self._tagged_responses[tag] = (typ, [data])
+            if self._recorder is not None:
+                self._recorder.completed(tag.encode(), typ)
+        else:
+            files = []
+            try:
+                while _PATTERN_LITERAL.search(data) is not None:
+                    size = int(_PATTERN_LITERAL.search(data).group('size'))
+                    f = literal_file(data) if literal_file is not None and typ == 'FETCH' else None
+                    if self._recorder is not None:
+                        self._recorder.received(size)
+                    if f is None:
+                        literal = await self._reader.readexactly(size)
+                    else:
+                        files.append(f)
+                        while size > 0:
+                            chunk = await self._reader.readexactly(min(size, _CHUNK_SIZE))
+                            f.write(chunk)
+                            size -= len(chunk)
+                        literal = f
+                    self.untagged_responses.setdefault(typ, []).append((data, literal))
+                    data = await self._readline()
+            except BaseException:
+                connection.discard_files(files)
+                raise
+            self.untagged_responses.setdefault(typ, []).append(data)
+
+        if typ in ('OK', 'NO', 'BAD'):
+            m = _PATTERN_RESPONSE_CODE.match(data)
+            if m is not None:
+                self.untagged_responses.setdefault(m.group('type').decode(), []).append(m.group('data'))
+
+    async def _hierarchy(self, root: str) -> Tuple[Set[str], Set[str]]:
+        """Get the folders existing and the folders subscribed below a root folder (see Connection._hierarchy).
+
+        :param root:    the root folder, e.g. 'Archive'
+        :return:        the names of the folders existing, the names of the folders subscribed
+        """
+        key = self._account + (root,)
+        if key not in self._hierarchies:
+            pattern = '"' + root + '*"'
+            hierarchy = []
+            for command in ('LIST', 'LSUB'):
+                res, data = await self.command(command, '""', pattern)
+                mailbox_list = self.untagged_responses.pop(command, [])
+                hierarchy.append({Mailbox(self, m.decode()).name for m in mailbox_list if res == 'OK' and m})
+            self._hierarchies[key] = tuple(hierarchy)
+        return self._hierarchies[key]
+
+    async def login(self, username: str, password: str) -> None:
+        """Run user authentication against a mail server.
+
+        :param username:    the user account used to log in
+        :param password:    the user's password for log in
+        """
+        if self._writer is None:
+            raise RuntimeError('No connection to IMAP4 server.')
+
+        if Config().verbose is True:
+            sys.stderr.write('Logging in... ')
+
+        auth_methods = self._pick_auth_methods()
+        try:
+
+            if 'CRAM-MD5' in auth_methods:
+                res, data = await self._login_cram_md5(username, password)
+            elif 'PLAIN' in auth_methods:
+                res, data = await self.command('LOGIN', _quote(username), _quote(password))
+            else:
+                sys.stderr.write(color.error('sorry: no AUTH method available I can deal with. =(\n'))
+                sys.exit(1)
+            if res != 'OK':
+                raise imaplib.IMAP4.error(str(data[-1]))
+
+        except imaplib.IMAP4.error as e:
+            sys.stderr.write(color.error('failed to login.\n' + str(e)) + '\n')
+            sys.exit(1)
+
+        if Config().verbose is True:
+            sys.stderr.write(color.success('done.\n'))
+            sys.stderr.write(color.success(f'User {username} logged in.\n'))
+
+        # servers may advertise more capabilities (e.g. MOVE) once the user is authenticated
+        if await self._read_capabilities():
+            self._dump_capabilities()
+        await self._compress()
+
+    async def _login_cram_md5(self, username: str, password: str) -> Tuple[str, List]:
+        """Authenticate by CRAM-MD5.
+
+        :param username:    the user account used to log in
+        :param password:    the user's password for log in
+        :return:            return code, data of the tagged response
+        """
+        self._continuation = None
+        tag = await self._command('AUTHENTICATE', 'CRAM-MD5')
+        while self._continuation is None and self._tagged_responses.get(tag) is None:
+            await self._get_response()
+        if self._continuation is not None:
+            challenge = base64.b64decode(self._continuation)
+            digest = hmac.HMAC(password.encode(), challenge, 'md5').hexdigest()
+            response = base64.b64encode(f'{username} {digest}'.encode()) + b'\r\n'
+            if self._recorder is not None:
+                self._recorder.sent(len(response))
+            self._writer.write(response)
+            await self._writer.drain()
+        return await self._command_complete('AUTHENTICATE', tag)
+
+    async def mailboxes(self, root: str = 'INBOX', status: Tuple[str, ...] = None) -> Dict[str, 'Mailbox']:
+        """Load all mailboxes from the server.
+
+        See Connection.mailboxes.
+
+        :param root:    top root mailbox
+        :param status:  status items to get along with the list (e.g. ('MESSAGES', 'UNSEEN'))
+        """
+        if status and 'LIST-STATUS' in self.capabilities:
+            status_items = ' '.join(status)
+            res, data = await self.command('LIST', root or '""', '*', f'RETURN (STATUS ({status_items}))')
+        else:
+            res, data = await self.command('LIST', root or '""', '*')
+        if res != 'OK':
+            raise RuntimeError('Server error on listing mailboxes. Returned: ' + str(res))
+        mailbox_list = self.untagged_responses.pop('LIST', [])
+        status_list = self.untagged_responses.pop('STATUS', [])
+
+        mbs = {}
+        for m in mailbox_list:
+            if m is not None:
+                mb = Mailbox(self, m.decode())
+                mbs[mb.name] = mb
+
+        for s in status_list:
+            if isinstance(s, bytes):
+                name, items = parse_status(s)
+                if name in mbs:
+                    mbs[name]._status.update(items)
+
+        return mbs
+
+    @classmethod
+    async def open(cls, host: str, port: int, username: str, password: str,
+                   hierarchies: connection.Hierarchies = None) -> 'Connection':
+        """Connect and log in.
+
+        :param host:            the host to connect
+        :param port:            the host's port number (if 0 then the default will be used)
+        :param username:        user account for login
+        :param password:        user password for login
+        :param hierarchies:     the folders known per account and root folder, shared with other
+                                connections (see Connection._hierarchy)
+        :return:                the connection
+        """
+        con = cls()
+        con._account = (host, port, username)
+        if hierarchies is not None:
+            con._hierarchies = hierarchies
+        await con.establish(host, port)
+        await con.login(username, password)
+        return con
+
+    async def pipeline(self, commands: List[Tuple[str, ...]]) -> List[Tuple[str, List]]:
+        """Run several UID commands with up to Config().pipeline_depth commands in flight.
+
+        See Connection.pipeline.
+
+        :param commands:    the commands as (command, sequence set, further arguments...)
+        :return:            return code and data per command
+        """
+        depth = max(Config().pipeline_depth, 1)
+        if depth == 1 or len(commands) < 2:
+            return [await self.uid(*c) for c in commands]
+
+        mail_ids = [IdSet.parse(c[1]) for c in commands]
+        data = [[] for c in commands]
+        results = [None] * len(commands)
+        in_flight = collections.deque()
+        for i, c in enumerate(commands):
+            if len(in_flight) == depth:
+                await self._pipeline_complete(commands, mail_ids, data, results, in_flight)
+            in_flight.append((i, await self._command('UID', *c)))
+        while len(in_flight) > 0:
+            await self._pipeline_complete(commands, mail_ids, data, results, in_flight)
+
+        return results
+
+    def _pipeline_abort(self) -> None:
+        """Close a connection lost amid pipelined commands (see Connection._pipeline_abort)."""
+        self.selected = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _pipeline_complete(self, commands: List[Tuple[str, ...]], mail_ids: List[IdSet], data: List[List],
+                                 results: List[Tuple[str, List]], in_flight: Deque[Tuple[int, str]]) -> None:
+        """Wait for the completion of the oldest pipelined command in flight and collect its responses.
+
+        :param commands:    all the pipelined commands
+        :param mail_ids:    the mail ids per command
+        :param data:        the untagged data collected so far per command
+        :param results:     return code and data per command
+        :param in_flight:   index and tag of the commands in flight, oldest first
+        """
+        i, tag = in_flight.popleft()
+        try:
+            res, tagged_data = await self._command_complete('UID', tag)
+        except (imaplib.IMAP4.abort, OSError):
+            self._pipeline_abort()
+            raise
+        except imaplib.IMAP4.error:
+            await self._pipeline_drain(in_flight)
+            raise
+        self._pipeline_collect(self.untagged_responses, commands, mail_ids, data, results,
+                               [i] + [j for j, t in in_flight], res, tagged_data)
+
+    async def _pipeline_drain(self, in_flight: Deque[Tuple[int, str]]) -> None:
+        """Wait for the completion of all the pipelined commands in flight and drop their responses.
+
+        :param in_flight:   index and tag of the commands in flight, oldest first
+        """
+        while len(in_flight) > 0:
+            i, tag = in_flight.popleft()
+            try:
+                await self._command_complete('UID', tag)
+            except (imaplib.IMAP4.abort, OSError):
+                self._pipeline_abort()
+                raise
+            except imaplib.IMAP4.error:
+                pass
+        for name in ('FETCH', 'SEARCH', 'SORT', 'THREAD'):
+            self.untagged_responses.pop(name, None)
+
+    async def _read_capabilities(self) -> bool:
+        """Ask the server for its capabilities.
+
+        :return:    True if the server told its capabilities
+        """
+        res, data = await self.command('CAPABILITY')
+        caps = self.untagged_responses.pop('CAPABILITY', [])
+        if res != 'OK' or len(caps) == 0 or caps[-1] is None:
+            return False
+        self._capabilities = caps[-1].decode().split()
+        return True
+
+    async def _readline(self) -> bytes:
+        """Read a single line from the server.
+
+        :return:    the line without the trailing CRLF
+        """
+        line = await self._reader.readline()
+        if not line:
+            raise imaplib.IMAP4.abort('socket error: EOF')
+        if self._recorder is not None:
+            self._recorder.received(len(line))
+        return line.rstrip(b'\r\n')
+
+    async def uid(self, command: str, *args) -> Tuple[str, List]:
+        """Run an UID command.
+
+        :param command:     the IMAP4 command to prefix with UID
+        :param args:        the command arguments
+        :return:            return code, untagged data just like imaplib.IMAP4.uid()
+        """
+        res, data = await self.command('UID', command, *args)
+        if res == 'NO':
+            return res, data
+        name = command if command in ('SEARCH', 'SORT', 'THREAD') else 'FETCH'
+        return res, self.untagged_responses.pop(name, [None])
+
+
+class Mailbox(mailbox.Mailbox):
+
+    """A single mailbox found on the IMAP4 server, operated on by an asyncio connection.
+
+    All methods talking to the server are coroutines here.
+    """
+
+    async def copy(self, mail_ids: Iterable[str], destination: str = None) -> None:
+        """Copy mails from the current mailbox to a destination mailbox.
+
+        :param mail_ids:        mail ids to copy
+        :param destination:     name of destination mailbox
+        """
+        mail_ids = IdSet(mail_ids)
+        if len(mail_ids) == 0 or len(destination) == 0:
+            return
+        await self._select()
+        res, data = await self._uid('COPY', mail_ids, self.quote_path(destination))
+        check_response(res, f'copying mails from {self.name} to {destination}')
+
+    async def count(self, *criteria) -> int:
+        """Count the mails matching some search criteria.
+
+        :param criteria:    IMAP4 search criteria
+        :return:            number of mails matching the criteria
+        """
+        if 'ESEARCH' not in self._connection.capabilities:
+            res, [mail_ids] = await self.search(*criteria)
+            check_response(res, f'searching {self.name}')
+            return len(IdSet.parse(mail_ids))
+
+        await self._select(readonly=True)
+        res, data = await self._connection.command('UID', 'SEARCH', 'RETURN (COUNT)', *criteria)
+        check_response(res, f'searching {self.name}')
+        return parse_esearch_count(self._connection.untagged_responses.pop('ESEARCH', []))
+
+    async def dates(self, mail_ids: Iterable[int]) -> Dict[int, tuple]:
+        """Fetch the dates of mails.
+
+        :param mail_ids:    the mail ids to get the dates for
+        :return:            the date (as returned by email.utils.parsedate) per mail id
+        """
+        await self._select(readonly=True)
+        res, fetch_data = await self._uid('FETCH', IdSet(mail_ids), date_fetch_parts())
+        check_response(res, f'fetching mail dates in {self.name}')
+        return dates_from_fetch(fetch_data)
+
+    async def expunge(self, mail_ids: Iterable[str] = None) -> None:
+        """Permanently delete marked mails in current mailbox.
+
+        :param mail_ids:    mail ids to remove (if the server supports UIDPLUS)
+        """
+        await self._select()
+        if mail_ids is not None and 'UIDPLUS' in self._connection.capabilities:
+            mail_ids = IdSet(mail_ids)
+            if len(mail_ids) > 0:
+                await self._uid('EXPUNGE', mail_ids)
+        else:
+            await self._connection.expunge()
+
+    async def fetch(self, ids, message_parts) -> (str, List[str]):
+        """Get some content from the IMAP4 server within this mailbox.
+
+        :param ids:                 the mail ids requested (a sequence set or some mail ids)
+        :param str message_parts:   content requested
+        :return:                    return code, list[content]
+        """
+        await self._select(readonly=True)
+        if isinstance(ids, str):
+            return await self._connection.uid('FETCH', ids, message_parts)
+        return await self._uid('FETCH', IdSet(ids), message_parts)
+
+    async def fetch_stream(self, mail_ids: Iterable[int], message_parts: str,
+                           literal_file: Callable[[bytes], Optional[BinaryIO]],
+                           batch_fetched: Callable[[IdSet], None] = None) -> AsyncIterator[List]:
+        """Fetch mails and hand over the response mail by mail, while it is received.
+
+        The mails are fetched in batches sized by a Batcher (see Mailbox.fetch_stream).
+
+        :param mail_ids:        the mail ids requested
+        :param message_parts:   content requested
+        :param literal_file:    gives the file to write a literal to (or None to keep it in memory)
+        :param batch_fetched:   called with the mail ids of each batch once all its mails have been
+                                handed over
+        :return:                an async iterator over the data of each mail
+        """
+        await self._select(readonly=True)
+        batcher = self._batcher('FETCH')
+        for batch in batcher.batches(IdSet(mail_ids)):
+            start, size = time.monotonic(), 0
+            for sequence_set in self._sequence_sets('FETCH', batch, message_parts):
+                async for mail_data in self._connection.fetch_stream(sequence_set, message_parts, literal_file):
+                    size += response_size(mail_data)
+                    yield mail_data
+            batcher.record(len(batch), size, time.monotonic() - start)
+            if batch_fetched is not None:
+                batch_fetched(batch)
+
+    async def inspect(self, *criteria) -> (IdSet, IdSet, IdSet, Dict[int, IdSet]):
+        """Inspect the current mailbox.
+
+        :param criteria:    inspect the mails matching these search criteria only, e.g. ('MODSEQ', '1234')
+        :return:            all mail ids, seen mail ids, deleted mail ids, seen mails per year
+        """
+        mails_all, mails_seen, mails_deleted = [IdSet.parse((await self.search(*c))[1][0])
+                                                for c in inspect_criteria(criteria)]
+
+        mails_per_year = {}
+        if len(mails_seen) > 0:
+            mails_per_year = await self._years_from_search(*year_span(), *criteria)
+            merge_years(mails_per_year, await self._years_from_fetch(undated_mails(mails_seen, mails_per_year)))
+
+        return mails_all, mails_seen, mails_deleted, mails_per_year
+
+    async def move(self, mail_ids: Iterable[str], destination: str) -> IdSet:
+        """Move mails from the current mailbox to a destination mailbox.
+
+        :param mail_ids:        mail ids to move
+        :param destination:     name of destination mailbox
+        :return:                mail ids still to expunge
+        """
+        mail_ids = IdSet(mail_ids)
+        how = self._move_command(mail_ids, destination)
+        if how == 'MOVE':
+            await self._select()
+            res, data = await self._uid('MOVE', mail_ids, self.quote_path(destination))
+            check_response(res, f'moving mails from {self.name} to {destination}')
+        elif how == 'COPY':
+            await self.copy(mail_ids, destination)
+            await self.store(mail_ids, '+FLAGS', r'(\Deleted)')
+        return mail_ids if how == 'COPY' else IdSet()
+
+    async def search(self, *criteria) -> (str, List[bytes]):
+        """Search inside the selected mailbox.
+
+        :param criteria:    IMAP4 search criteria
+        :return:            result string, mail ids matching the criteria
+        """
+        await self._select(readonly=True)
+        return await self._connection.uid('SEARCH', *criteria)
+
+    async def select(self, readonly: bool = False) -> int:
+        """Selects this mailbox for the next IMAP operation.
+
+        The UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ the server reports on selecting are
+        remembered as status items (see status).
+
+        :param readonly:    select the mailbox read-only (EXAMINE)
+        :return:            the number of mails in this mailbox
+        """
+        if not self._connection:
+            raise RuntimeError('No connection.')
+        self._connection.untagged_responses = {}
+        self._connection.selected = None
+        res, data = await self._connection.command('EXAMINE' if readonly else 'SELECT', self.path)
+        check_response(res, f'selecting {self.name}')
+        self._connection.selected = (self.path, readonly)
+        self._status_from_select(self._connection.untagged_responses)
+        return int(self._connection.untagged_responses.get('EXISTS', [b'0'])[-1])
+
+    async def _select(self, readonly: bool = False) -> None:
+        """Select this mailbox unless it is selected already (see Mailbox._select).
+
+        :param readonly:    the mailbox is used read-only
+        """
+        selected = self._connection.selected if self._connection else None
+        if selected is not None and selected[0] == self.path and (readonly or not selected[1]):
+            return
+        await self.select(readonly)
+
+    async def status(self, *items, refresh: bool = False) -> Dict[str, int]:
+        """Get status items of this mailbox, e.g. status('MESSAGES', 'UNSEEN').
+
+        :param items:       the status data items
+        :param refresh:     ask the server in any case
+        :return:            the value of each status item
+        """
+        items = [i.upper() for i in items]
+        if refresh or not all(i in self._status for i in items):
+            res, data = await self._connection.command('STATUS', self.path, '(' + ' '.join(items) + ')')
+            self._status_from_response(res, self._connection.untagged_responses.pop('STATUS', []))
+        return {i: self._status[i] for i in items if i in self._status}
+
+    async def store(self, mail_ids: Iterable[str], operation: str, flags: str) -> None:
+        """Modify mail flags inside this mailbox.
+
+        :param mail_ids:    mail ids to modify
+        :param operation:   IMAP4 operation
+        :param flags:       IMAP4 flags to apply
+        """
+        await self._select()
+        await self._uid('STORE', IdSet(mail_ids), operation, flags)
+
+    async def _uid(self, command: str, mail_ids: IdSet, *args) -> (str, List):
+        """Run an UID command on some mails, batched, split and pipelined like Mailbox._uid.
+
+        :param command:     the IMAP4 command to prefix with UID
+        :param mail_ids:    the mail ids the command applies to
+        :param args:        further command arguments
+        :return:            the first failed (or last) return code, the collected responses
+        """
+        rounds = self._uid_rounds(command, mail_ids, *args)
+        try:
+            commands = next(rounds)
+            while True:
+                commands = rounds.send(await self._connection.pipeline(commands))
+        except StopIteration as done:
+            return done.value
+
+    async def _years_from_fetch(self, mail_ids: IdSet) -> Dict[int, IdSet]:
+        """Get the years of mails by fetching their dates.
+
+        :param mail_ids:    the mail ids to examine
+        :return:            the mail ids per year
+        """
+        return years_from_dates(mail_ids, await self.dates(mail_ids), self.name)
+
+    async def _years_from_search(self, year_from: int, year_to: int, *criteria) -> Dict[int, IdSet]:
+        """Get the years of the seen mails by asking the server (see Mailbox._years_from_search).
+
+        :param year_from:   first year to search (inclusive)
+        :param year_to:     last year to search (exclusive)
+        :param criteria:    further search criteria
+        :return:            the mail ids per year
+        """
+        try:
+            res, data = await self.search(*year_search_criteria(year_from, year_to), *criteria)
+        except imaplib.IMAP4.error:
+            res, data = 'NO', []
+        mails_per_year, year_middle = bisect_years(year_from, year_to, res, data)
+        if year_middle is not None:
+            mails_per_year = await self._years_from_search(year_from, year_middle, *criteria)
+            mails_per_year.update(await self._years_from_search(year_middle, year_to, *criteria))
+        return mails_per_year
+
+
+class ConnectionPool(object):
+
+    """A pool of asyncio connections to the very same IMAP4 account.
+
+    This is the counterpart of pool.ConnectionPool: the tasks are coroutines run on up to
+    size connections concurrently, their output is replayed in the order of the items.
+    """
+
+    def __init__(self, host: str, port: int, username: str, password: str, size: int = 1):
+        """Constructor.
+
+        :param host:        the host to connect
+        :param port:        the host's port number (if 0 then the default will be used)
+        :param username:    user account for login
+        :param password:    user password for login
+        :param size:        maximum number of connections
+        """
+        self._host = host
+        self._port = port
+        self._username = username
+        self._password = password
+        self._size = max(size, 1)
+        self._connections = []          # type: List[Connection]
+        self._connecting = 0
+        self._idle = None               # type: Optional[asyncio.Queue]
+        self._closing = set()           # type: Set[asyncio.Future]
+        self._hierarchies = {}          # shared by the connections (see Connection._hierarchy)
+
+    async def acquire(self) -> Connection:
+        """Get an idle connection, connect and log in a new one if there is none.
+
+        The connection has to be handed back by release().
+
+        :return:    a connection for exclusive use
+        """
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        if not self._idle.empty() or self._connecting + len(self._connections) >= self._size:
+            return await self._idle.get()
+
+        self._connecting += 1
+        try:
+            con = await Connection.open(self._host, self._port, self._username, self._password, self._hierarchies)
+        finally:
+            self._connecting -= 1
+        self._connections.append(con)
+        return con
+
+    async def close(self) -> None:
+        """Log out all connections.
+
+        The idle connections are logged out right away, the ones still in use as soon as
+        they are released.
+        """
+        self._connections = []
+        while self._idle is not None and not self._idle.empty():
+            await self._idle.get_nowait().close()
+        if len(self._closing) > 0:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    async def map(self, task: Callable, items: Iterable) -> None:
+        """Run the coroutine task(connection, item) for all items.
+
+        An exception raised by a task (including SystemExit) is re-raised after the output of
+        all the preceding tasks and of the failed one has been replayed.
+
+        :param task:    the coroutine function to run
+        :param items:   the items to run the task for
+        """
+        with redirect_output():
+            tasks = [asyncio.ensure_future(self._run(task, item)) for item in items]
+            try:
+                for t in tasks:
+                    output, exception = await t
+                    replay_output(output)
+                    if exception is not None:
+                        raise exception
+            finally:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def release(self, con: Connection) -> None:
+        """Hand back a connection acquired before.
+
+        :param con:     the connection
+        """
+        if con in self._connections:
+            if con._writer is not None:
+                self._idle.put_nowait(con)
+                return
+            # lost (see Connection._pipeline_abort), a new connection may take its place
+            self._connections.remove(con)
+
+        # the pool has been closed meanwhile or the connection is lost
+        closing = asyncio.ensure_future(con.close())
+        self._closing.add(closing)
+        closing.add_done_callback(self._closing.discard)
+
+    async def _run(self, task: Callable, item: object) -> Tuple[List, Optional[BaseException]]:
+        """Run a single task and collect its output.
+
+        :param task:    the coroutine function to run
+        :param item:    the item to run the task for
+        :return:        the output collected as (stream, text) pairs, the exception raised (if any)
+        """
+        exception = None
+        con = None
+        with collect_output() as output:
+            try:
+                con = await self.acquire()
+                await task(con, item)
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                exception = e
+            finally:
+                if con is not None:
+                    self.release(con)
+        return output, exception
+
+
+async def download(pool: ConnectionPool, mailbox_name: str, folder: str, full: bool = False) -> None:
+    """Download the messages of a mailbox and its children (see the download command).
+
+    :param pool:            the connections to use
+    :param mailbox_name:    the mailbox to start downloading
+    :param folder:          the local target folder
+    :param full:            download all messages regardless of the download state
+    """
+    con = await pool.acquire()
+    mbs = await con.mailboxes(mailbox_name)
+    pool.release(con)
+    await pool.map(functools.partial(_operation, download_mailbox, folder, full), select_mailboxes(mbs))
+
+
+async def move(pool: ConnectionPool, mailbox_from: str, mailbox_to: str, year: int, omit: Iterable[str] = (),
+               state: str = None, operation: str = 'move', index: Index = None) -> None:
+    """Move old mails to the archive mailbox (see the move command).
+
+    :param pool:            the connections to use
+    :param mailbox_from:    the mailbox to start moving from
+    :param mailbox_to:      the mailbox to move to
+    :param year:            mails sent before 1st January of this year are old
+    :param omit:            names of mailboxes to ignore
+    :param state:           the file holding the status of the mailboxes (see MailboxChanges)
+    :param operation:       the operation the status is recorded for
+    :param index:           the index to inspect the mailboxes by (if any)
+    """
+    con = await pool.acquire()
+    changes = MailboxChanges(state, operation, con.capabilities)
+    mbs = await con.mailboxes(mailbox_from, changes.status_items)
+    pool.release(con)
+    try:
+        await pool.map(functools.partial(_operation, move_mailbox, mailbox_to, year, changes, index),
+                       select_mailboxes(mbs, omit))
+    finally:
+        changes.save()
+
+
+async def _operation(operation: Callable[..., Generator], *args) -> None:
+    """Run an operation on a single mailbox on an asyncio connection (see the operations module).
+
+    :param operation:   the operation, e.g. operations.move_mailbox
+    :param args:        the arguments of the operation, the connection and the mailbox last
+    """
+    await run_steps(operation(*args))
+
+
+def run(operation: Callable, host: str, port: int, username: str, password: str, *args) -> None:
+    """Run an operation (download, move or scan) on Config().jobs connections in a new event loop.
+
+    :param operation:   the operation
+    :param host:        the host to connect
+    :param port:        the host's port number (if 0 then the default will be used)
+    :param username:    user account for login
+    :param password:    user password for login
+    :param args:        further arguments of the operation
+    """
+    async def main():
+        pool = ConnectionPool(host, port, username, password, Config().jobs)
+        try:
+            await operation(pool, *args)
+        finally:
+            await pool.close()
+
+    asyncio.run(main())
+
+
+async def run_steps(steps: Generator) -> object:
+    """Run the steps of an operation, awaiting the calls yielded (see steps.run).
+
+    :param steps:   the generator of the operation
+    :return:        the value returned by the generator
+    """
+    result, error = None, None
+    try:
+        while True:
+            try:
+                call = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            result, error = None, None
+            try:
+                if call[0] is each:
+                    async for item in call[1]:
+                        call[2](item)
+                else:
+                    result = call[0](*call[1:])
+                    if inspect.isawaitable(result):
+                        result = await result
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
+
+
+async def scan(pool: ConnectionPool, mailbox_name: str = '', years: bool = False, index: Index = None) -> None:
+    """Print the mail counts of a mailbox and its children (see the scan command).
+
+    :param pool:            the connections to use
+    :param mailbox_name:    the mailbox to start scanning
+    :param years:           examine each mail and print the number of seen mails per year
+    :param index:           the index to count the mails by (if any)
+    """
+    con = await pool.acquire()
+    status = scan_status_items(con.capabilities)
+    if years or index is not None:
+        mbs = await con.mailboxes(mailbox.Mailbox.strip_path(mailbox_name or ''))
+    else:
+        mbs = await con.mailboxes(mailbox.Mailbox.strip_path(mailbox_name or ''), status)
+    pool.release(con)
+
+    if len(mbs) > 0:
+        print_scan_header(index)
+    await pool.map(functools.partial(_operation, scan_mailbox, years, status, index), select_mailboxes(mbs))
@@ -0,0 +1,562 @@
+# ------------------------------------------------------------
+# imaparchiver/archive.py
+#
+# write downloaded mails to mbox, tar and Maildir containers
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module writes the mails downloaded into containers (see download --format).
+
+mbox and tar files are written per mailbox, e.g. 'INBOX/Sent/mails.mbox.zst', or per mailbox
+and year, e.g. 'INBOX/Sent/mails-2019.mbox.zst'. Mails are streamed into them through a
+buffered writer, so there is no file (and no open, write and close) per mail. Later
+downloads append to the containers there already.
+
+A container is written in frames of FRAME_SIZE bytes of mails (a mail is never split), each
+compressed on its own if asked for. Concatenated gzip members and zstd frames make a valid
+gzip or zstd stream, so the usual tools read a container as a whole. Next to each container
+an offset index (e.g. 'mails.mbox.zst.index.jsonl') holds a JSON line per mail:
+
+    {"uidvalidity": 1561975200, "uid": 17, "message_id": "<1234@example.com>",
+     "date": 1561975200.0, "frame": 1048917, "frame_size": 301722, "offset": 20731, "size": 2317}
+
+'frame' and 'frame_size' locate the frame in the container, 'offset' and 'size' the mail in
+the decompressed frame. So a single mail is extracted by a seek and the decompression of a
+single frame (see extract). A frame is listed in the index once it is written completely:
+before appending, anything past the last frame listed (the end of a tar archive, a frame cut
+short by an interrupted download) is cut off.
+
+Maildir folders hold a file per mail as usual, compressed one by one if asked for (as read
+by e.g. the zlib plugin of Dovecot).
+
+zstd compression needs the zstandard package.
+"""
+
+import json
+import os
+import re
+import socket
+import tarfile
+import tempfile
+import time
+import uuid
+import zlib
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+from .fetch import parse_fetch
+from .mailbox import dates_from_fetch
+
+
+# the compressions supported and the suffixes of the files compressed
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+# bytes of mails per frame of a container
+FRAME_SIZE = 1 << 20
+
+# suffix of the offset index next to a container
+INDEX_SUFFIX = '.index.jsonl'
+
+# bytes of a mail body kept in memory before it is spooled to a temporary file
+SPOOL_SIZE = 1 << 20
+
+_BUFFER_SIZE = 1 << 20
+_CHUNK_SIZE = 1 << 16
+_MAILDIR_FLAGS = {'\\Draft': 'D', '\\Flagged': 'F', '\\Answered': 'R', '\\Seen': 'S', '\\Deleted': 'T'}
+_PATTERN_BODY = re.compile(rb'BODY\[\]( <\d+>)? \{\d+\}$')
+_PATTERN_FROM = re.compile(rb'>*From ')
+_PATTERN_MAILDIR_KEY = re.compile(r'\d+\.(?P<key>U[^.I]*I\d+)\.')
+_PATTERN_QUOTED_FROM = re.compile(rb'^>(>*From )', re.MULTILINE)
+_TAR_BLOCK = 512
+
+
+def check_compression(compression: Optional[str]) -> None:
+    """Check a compression is available.
+
+    :param compression:     'gzip', 'zstd' or None
+    """
+    if compression == 'zstd':
+        _zstandard()
+
+
+def _compressor(compression: Optional[str]) -> Optional[object]:
+    """Get a compressor starting a new gzip member or zstd frame.
+
+    :param compression:     'gzip', 'zstd' or None
+    :return:                the compressor (None for no compression), with compress and flush
+    """
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compression == 'zstd':
+        return _zstandard().ZstdCompressor().compressobj()
+    return None
+
+
+def _decompress(compression: Optional[str], data: bytes) -> bytes:
+    """Decompress a single gzip member or zstd frame.
+
+    :param compression:     'gzip', 'zstd' or None
+    :param data:            the member or frame
+    :return:                the data decompressed
+    """
+    if compression == 'gzip':
+        return zlib.decompressobj(31).decompress(data)
+    if compression == 'zstd':
+        return _zstandard().ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def extract(path: str, uid: int, uid_validity: Optional[int] = None) -> bytes:
+    """Extract a single mail of an mbox or tar container by its offset index.
+
+    Mails of an mbox container are unquoted, but keep the line endings of the mbox.
+
+    :param path:            path of the container
+    :param uid:             the UID of the mail
+    :param uid_validity:    the UIDVALIDITY of the mail (None: the mail with the UID listed last)
+    :return:                the mail
+    """
+    entry = None
+    with open(path + INDEX_SUFFIX) as f:
+        for line in f:
+            e = json.loads(line)
+            if e['uid'] == uid and (uid_validity is None or e['uidvalidity'] == uid_validity):
+                entry = e
+    if entry is None:
+        raise RuntimeError(f"No mail with UID {uid} in the index of '{path}'.")
+
+    compression = next((c for c, suffix in COMPRESSIONS.items() if path.endswith(suffix)), None)
+    with open(path, 'rb') as f:
+        if compression is None:
+            f.seek(entry['frame'] + entry['offset'])
+            mail = f.read(entry['size'])
+        else:
+            f.seek(entry['frame'])
+            mail = _decompress(compression, f.read(entry['frame_size']))
+            mail = mail[entry['offset']:entry['offset'] + entry['size']]
+    if '.mbox' in os.path.basename(path):
+        mail = _PATTERN_QUOTED_FROM.sub(rb'\1', mail)
+    return mail
+
+
+def _mail_body(mail_data: list) -> Optional[BinaryIO]:
+    """Get the file a mail body was streamed to.
+
+    :param mail_data:   the data of the mail as handed over by Mailbox.fetch_stream
+    :return:            the file of the body (None if there is none)
+    """
+    return next((d[1] for d in mail_data if isinstance(d, tuple) and not isinstance(d[1], bytes)), None)
+
+
+def _mbox_body(body: BinaryIO) -> Iterator[bytes]:
+    """Read a mail body quoted for an mbox (mboxrd).
+
+    CRLF line endings are turned into LF and a '>' is put in front of lines starting with
+    any number of '>' and 'From '. The body ends with a line ending.
+
+    :param body:    the body
+    :return:        an iterator over chunks of the body quoted
+    """
+    chunk = []
+    size = 0
+    line = b'\n'
+    for line in body:
+        if line.endswith(b'\r\n'):
+            line = line[:-2] + b'\n'
+        if _PATTERN_FROM.match(line) is not None:
+            line = b'>' + line
+        chunk.append(line)
+        size += len(line)
+        if size >= _CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if not line.endswith(b'\n'):
+        chunk.append(b'\n')
+    yield b''.join(chunk)
+
+
+def _read_chunks(body: BinaryIO) -> Iterator[bytes]:
+    """Read a mail body in chunks.
+
+    :param body:    the body
+    :return:        an iterator over the chunks
+    """
+    chunk = body.read(_CHUNK_SIZE)
+    while chunk:
+        yield chunk
+        chunk = body.read(_CHUNK_SIZE)
+
+
+def _zstandard() -> object:
+    """Import the zstandard package.
+
+    :return:    the zstandard module
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstd compression needs the zstandard package: pip install zstandard')
+    return zstandard
+
+
+class Container(object):
+
+    """A container file (mbox or tar) appended to frame by frame, with its offset index.
+
+    Example:
+
+    >>> container = Container('INBOX/mails.mbox.zst', 'zstd')
+    >>> uids = container.add(b'From MAILER-DAEMON ...\\n', chunks, b'\\n', {'uidvalidity': 1, 'uid': 17})
+    >>> uids += container.close()
+    """
+
+    def __init__(self, path: str, compression: Optional[str] = None, trailer: bytes = b''):
+        """Constructor.
+
+        :param path:            path of the container
+        :param compression:     'gzip', 'zstd' or None
+        :param trailer:         written after the last frame and cut off before appending (e.g. end of a tar)
+        """
+        self.path = path
+        self._compression = compression
+        self._trailer = trailer
+        self._compressor = None
+        self._frame = None              # type: Optional[int]
+        self._frame_bytes = 0
+        self._entries = []              # type: List[dict]
+        self.listed = set()
+
+        index_path = path + INDEX_SUFFIX
+        end = 0
+        try:
+            with open(index_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        end = max(end, entry['frame'] + entry['frame_size'])
+                        self.listed.add((entry['uidvalidity'], entry['uid']))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                raise RuntimeError(f"Container '{path}' has no offset index, not appending to it.")
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._index = open(index_path, 'a')
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'wb', buffering=_BUFFER_SIZE)
+        self._file.truncate(end)
+        self._file.seek(end)
+
+    def add(self, head: bytes, chunks: Iterable[bytes], tail: bytes, entry: dict) -> List[int]:
+        """Append a mail.
+
+        :param head:        written in front of the mail (e.g. the From line of an mbox)
+        :param chunks:      the mail
+        :param tail:        written after the mail (e.g. padding)
+        :param entry:       the fields of the mail in the index
+        :return:            the UIDs of the mails written completely (once a frame is full)
+        """
+        if self._frame is None:
+            self._frame = self._file.tell()
+            self._frame_bytes = 0
+            self._compressor = _compressor(self._compression)
+        self._write(head)
+        offset = self._frame_bytes
+        for chunk in chunks:
+            self._write(chunk)
+        self._entries.append(dict(entry, offset=offset, size=self._frame_bytes - offset))
+        self.listed.add((entry['uidvalidity'], entry['uid']))
+        self._write(tail)
+        if self._frame_bytes >= FRAME_SIZE:
+            return self._end_frame()
+        return []
+
+    def close(self) -> List[int]:
+        """Write the last frame and the trailer and close the container.
+
+        :return:    the UIDs of the mails written completely
+        """
+        if self._file is None:
+            return []
+        uids = self._end_frame()
+        if self._trailer:
+            compressor = _compressor(self._compression)
+            if compressor is None:
+                self._file.write(self._trailer)
+            else:
+                self._file.write(compressor.compress(self._trailer) + compressor.flush())
+        self._file.close()
+        self._index.close()
+        self._file = None
+        return uids
+
+    def _end_frame(self) -> List[int]:
+        """Finish the current frame and list its mails in the index.
+
+        :return:    the UIDs of the mails of the frame
+        """
+        if self._frame is None:
+            return []
+        if self._compressor is not None:
+            self._file.write(self._compressor.flush())
+        self._file.flush()
+        frame_size = self._file.tell() - self._frame
+        for e in self._entries:
+            self._index.write(json.dumps({'uidvalidity': e['uidvalidity'], 'uid': e['uid'],
+                                          'message_id': e['message_id'], 'date': e['date'],
+                                          'frame': self._frame, 'frame_size': frame_size,
+                                          'offset': e['offset'], 'size': e['size']}) + '\n')
+        self._index.flush()
+        uids = [e['uid'] for e in self._entries]
+        self._frame = None
+        self._compressor = None
+        self._entries = []
+        return uids
+
+    def _write(self, data: bytes) -> None:
+        """Write to the current frame.
+
+        :param data:    the data to write
+        """
+        self._frame_bytes += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._file.write(data)
+
+
+class ContainerStore(object):
+
+    """Writes the mails of a mailbox to mbox or tar containers (the mbox and tar formats).
+
+    Each mail body is kept in memory (or spooled to a temporary file if big) until the mail
+    is complete and then appended to the container of the mailbox, or of the mailbox and the
+    year of the mail. Mails are reported stored once their frame is written completely. A mail
+    listed in the index of its container already (--full) is not written again.
+    """
+
+    def __init__(self, mail_folder: str, uid_validity: Optional[int], container_format: str,
+                 compression: Optional[str] = None, per_year: bool = False):
+        """Constructor.
+
+        :param mail_folder:         the folder of the mailbox holding the containers
+        :param uid_validity:        the current UIDVALIDITY of the mailbox (None if unknown)
+        :param container_format:    'mbox' or 'tar'
+        :param compression:         'gzip', 'zstd' or None
+        :param per_year:            a container per year instead of a single one
+        """
+        self._folder = mail_folder
+        self._uid_validity = uid_validity
+        self._format = container_format
+        self._compression = compression
+        self._per_year = per_year
+        self._containers = {}
+        self._stored = []               # type: List[int]
+
+    def close(self) -> List[int]:
+        """Done with the mailbox: write the last frames and close the containers.
+
+        :return:    the mail ids (UIDs) stored since asked last
+        """
+        for container in self._containers.values():
+            self._stored += container.close()
+        return self.stored()
+
+    def _container(self, t: Optional[tuple]) -> Container:
+        """Get the container of a mail, opened on first use.
+
+        :param t:   the date of the mail (as returned by email.utils.parsedate, None if unknown)
+        :return:    the container
+        """
+        year = t[0] if self._per_year and t is not None else None
+        container = self._containers.get(year)
+        if container is None:
+            name = 'mails' + ('' if year is None else f'-{year}') + '.' + self._format
+            trailer = b'\0' * (2 * _TAR_BLOCK) if self._format == 'tar' else b''
+            container = Container(os.path.join(self._folder, name + COMPRESSIONS.get(self._compression, '')),
+                                  self._compression, trailer)
+            self._containers[year] = container
+        return container
+
+    def literal_file(self, prefix: bytes) -> Optional[BinaryIO]:
+        """Get a file to stream a mail body to (the literal_file for Mailbox.fetch_stream).
+
+        :param prefix:  the response part in front of the literal
+        :return:        the file for a body, None for any other literal
+        """
+        if _PATTERN_BODY.search(prefix) is None:
+            return None
+        return tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+
+    def save(self, mail_data: list) -> Tuple[Optional[int], Optional[str], bool]:
+        """Append a mail to its container.
+
+        :param mail_data:   the data of the mail as handed over by Mailbox.fetch_stream
+        :return:            mail id, path of the container (None if there is no body),
+                            whether the mail was written (False: in the container already)
+        """
+        body = _mail_body(mail_data)
+        mail = next(parse_fetch(mail_data), None)
+        mail_id = None if mail is None else mail.uid
+        if body is None or mail_id is None:
+            if body is not None:
+                body.close()
+            return mail_id, None, False
+
+        try:
+            t = dates_from_fetch(mail_data).get(mail_id)
+            seconds = None if t is None else time.mktime(t)
+            entry = {'uidvalidity': self._uid_validity, 'uid': mail_id, 'message_id': mail.message_id,
+                     'date': seconds}
+            container = self._container(t)
+            if (self._uid_validity, mail_id) in container.listed:
+                self._stored.append(mail_id)
+                return mail_id, container.path, False
+            size = body.tell()
+            body.seek(0)
+            if self._format == 'tar':
+                info = tarfile.TarInfo(f'{self._uid_validity}.{mail_id}.eml')
+                info.size = size
+                info.mtime = max(int(time.time() if seconds is None else seconds), 0)
+                info.mode = 0o644
+                head = info.tobuf(tarfile.USTAR_FORMAT, 'utf-8', 'surrogateescape')
+                stored = container.add(head, _read_chunks(body), b'\0' * (-size % _TAR_BLOCK), entry)
+            else:
+                date = time.asctime(time.localtime(time.time() if seconds is None else seconds))
+                stored = container.add(f'From MAILER-DAEMON {date}\n'.encode(), _mbox_body(body), b'\n', entry)
+        finally:
+            body.close()
+        self._stored += stored
+        return mail_id, container.path, True
+
+    def stored(self) -> List[int]:
+        """Get the mails written completely since asked last.
+
+        :return:    the mail ids (UIDs)
+        """
+        stored, self._stored = self._stored, []
+        return stored
+
+
+class MaildirStore(object):
+
+    """Writes the mails of a mailbox to a Maildir (the maildir format).
+
+    Each mail is streamed to the tmp folder of the Maildir and moved to cur once complete,
+    named after its date, UIDVALIDITY and UID, with its flags as info, e.g.
+    '1561975200.U1561975200I17.host:2,S'. A mail found in the Maildir already (--full) is not
+    written again, whichever host wrote it: mails are recognized by UIDVALIDITY and UID only.
+    """
+
+    def __init__(self, mail_folder: str, uid_validity: Optional[int], compression: Optional[str] = None):
+        """Constructor.
+
+        :param mail_folder:     the Maildir
+        :param uid_validity:    the current UIDVALIDITY of the mailbox (None if unknown)
+        :param compression:     'gzip', 'zstd' or None: compress each mail file
+        """
+        self._folder = mail_folder
+        self._uid_validity = uid_validity
+        self._compression = compression
+        self._host = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+        self._stored = []               # type: List[int]
+        self._known = {}
+        for sub in ('cur', 'new', 'tmp'):
+            os.makedirs(os.path.join(mail_folder, sub), exist_ok=True)
+        for sub in ('cur', 'new'):
+            for name in os.listdir(os.path.join(mail_folder, sub)):
+                m = _PATTERN_MAILDIR_KEY.match(name)
+                if m is not None:
+                    self._known[m.group('key')] = os.path.join(mail_folder, sub, name)
+
+    def close(self) -> List[int]:
+        """Done with the mailbox.
+
+        :return:    the mail ids (UIDs) stored since asked last
+        """
+        return self.stored()
+
+    def literal_file(self, prefix: bytes) -> Optional[BinaryIO]:
+        """Get a temporary file to stream a mail body to (the literal_file for Mailbox.fetch_stream).
+
+        :param prefix:  the response part in front of the literal
+        :return:        the file for a body, None for any other literal
+        """
+        if _PATTERN_BODY.search(prefix) is None:
+            return None
+        f = open(os.path.join(self._folder, 'tmp', f'.{uuid.uuid4().hex}.part'), 'xb')
+        return f if self._compression is None else _CompressedFile(f, self._compression)
+
+    def save(self, mail_data: list) -> Tuple[Optional[int], Optional[str], bool]:
+        """Move a mail just streamed to the tmp folder to the cur folder.
+
+        :param mail_data:   the data of the mail as handed over by Mailbox.fetch_stream
+        :return:            mail id, path of the mail file (None if there is no body),
+                            whether the mail file was written (False: in the Maildir already)
+        """
+        body = _mail_body(mail_data)
+        if body is not None:
+            body.close()
+        mail = next(parse_fetch(mail_data), None)
+        mail_id = None if mail is None else mail.uid
+        if body is None or mail_id is None:
+            if body is not None:
+                os.remove(body.name)
+            return mail_id, None, False
+
+        key = f'U{self._uid_validity}I{mail_id}'
+        if key in self._known:
+            os.remove(body.name)
+            self._stored.append(mail_id)
+            return mail_id, self._known[key], False
+
+        t = dates_from_fetch(mail_data).get(mail_id)
+        seconds = time.time() if t is None else time.mktime(t)
+        flags = set((mail.flags or '').split())
+        info = ''.join(sorted(f for flag, f in _MAILDIR_FLAGS.items() if flag in flags))
+        path = os.path.join(self._folder, 'cur', f'{int(seconds)}.{key}.{self._host}:2,{info}')
+        os.utime(body.name, (seconds, seconds))
+        os.replace(body.name, path)
+        self._known[key] = path
+        self._stored.append(mail_id)
+        return mail_id, path, True
+
+    def stored(self) -> List[int]:
+        """Get the mails written since asked last.
+
+        :return:    the mail ids (UIDs)
+        """
+        stored, self._stored = self._stored, []
+        return stored
+
+
+class _CompressedFile(object):
+
+    """A file compressing the data written to it."""
+
+    def __init__(self, f: BinaryIO, compression: str):
+        """Constructor.
+
+        :param f:               the file to write to
+        :param compression:     'gzip' or 'zstd'
+        """
+        self._file = f
+        self._compressor = _compressor(compression)
+        self.name = f.name
+
+    def close(self) -> None:
+        """Finish the compression and close the file."""
+        if not self._file.closed:
+            self._file.write(self._compressor.flush())
+            self._file.close()
+
+    def write(self, data: bytes) -> int:
+        """Write to the file.
+
+        :param data:    the data to write
+        :return:        the number of bytes taken
+        """
+        self._file.write(self._compressor.compress(data))
+        return len(data)
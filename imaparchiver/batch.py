@@ -0,0 +1,151 @@
+# ------------------------------------------------------------
+# imaparchiver/batch.py
+#
+# adaptive batches of mails
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module splits the mails a command applies to into batches of adaptive size.
+
+A fixed number of mails per command is either too small (a few hundred tiny notifications
+per round trip) or too large (a few hundred huge headers or bodies in memory at once, and a
+server taking minutes to answer). The Batcher measures the bytes received and the time taken
+per mail and sizes the next batch to meet both Config().batch_bytes and Config().batch_latency.
+"""
+
+import itertools
+import re
+import sys
+from typing import Iterator, List
+
+from .config import Config
+from .idset import IdSet
+from .units import format_size
+
+
+# number of mails of the very first batch
+START_SIZE = 50
+
+# bounds of the number of mails per batch
+MIN_SIZE = 1
+MAX_SIZE = 20000
+
+# a batch grows by this factor at most, so a few cheap mails do not lead to a huge batch
+MAX_GROWTH = 2
+
+# weight of the latest batch in the cost per mail
+SMOOTHING = 0.5
+
+_PATTERN_LITERAL = re.compile(rb'\{(?P<size>\d+)\}$')
+
+
+def response_size(data: list) -> int:
+    """Get the number of bytes of a response as handed over by imaplib.
+
+    Literals written to a file (see Connection.fetch_stream) are counted by the size
+    announced in their prefix.
+
+    :param data:    the response data, bytes and (prefix, literal) tuples
+    :return:        the number of bytes
+    """
+    size = 0
+    for d in data:
+        if isinstance(d, tuple):
+            size += len(d[0])
+            if isinstance(d[1], bytes):
+                size += len(d[1])
+            else:
+                m = _PATTERN_LITERAL.search(d[0])
+                size += int(m.group('size')) if m is not None else 0
+        elif isinstance(d, bytes):
+            size += len(d)
+    return size
+
+
+class Batcher(object):
+
+    """Hands out the mails a command applies to in batches of adaptive size.
+
+    After each batch (or each round of pipelined batches) the caller records the number of
+    mails, the bytes received and the time taken. The cost per mail is smoothed over the
+    batches and the next batch is sized so that neither the byte budget nor the latency
+    target per command is exceeded.
+
+    Example:
+
+    >>> batcher = Batcher('FETCH INBOX')
+    >>> for batch in batcher.batches(mail_ids):
+    ...     start = time.monotonic()
+    ...     res, data = mb.fetch(batch, '(BODY.PEEK[HEADER])')
+    ...     batcher.record(len(batch), response_size(data), time.monotonic() - start)
+    """
+
+    def __init__(self, name: str, size: int = START_SIZE):
+        """Constructor.
+
+        :param name:    what the batches are for, shown in verbose mode (e.g. 'UID FETCH in INBOX')
+        :param size:    number of mails of the first batch
+        """
+        self._name = name
+        self.size = min(max(size, MIN_SIZE), MAX_SIZE)
+        self._bytes_per_mail = None
+        self._seconds_per_mail = None
+
+    def batches(self, mail_ids: IdSet) -> Iterator[IdSet]:
+        """Split mails into batches, each of the size current when it is handed out.
+
+        :param mail_ids:    the mail ids
+        :return:            an iterator over the batches
+        """
+        return mail_ids.batches(lambda: self.size)
+
+    def record(self, mails: int, size: int, seconds: float, commands: int = 1) -> None:
+        """Record the cost of the batches just completed and size the next batch accordingly.
+
+        :param mails:       number of mails of the batches
+        :param size:        number of bytes received for the batches
+        :param seconds:     time taken by the batches
+        :param commands:    number of commands the batches were sent as (pipelined)
+        """
+        if mails <= 0:
+            return
+        bytes_per_mail = size / mails
+        seconds_per_mail = seconds / mails
+        if self._bytes_per_mail is None:
+            self._bytes_per_mail, self._seconds_per_mail = bytes_per_mail, seconds_per_mail
+        else:
+            self._bytes_per_mail += SMOOTHING * (bytes_per_mail - self._bytes_per_mail)
+            self._seconds_per_mail += SMOOTHING * (seconds_per_mail - self._seconds_per_mail)
+
+        size_next = MAX_SIZE
+        if self._bytes_per_mail > 0:
+            size_next = min(size_next, int(Config().batch_bytes / self._bytes_per_mail))
+        if self._seconds_per_mail > 0:
+            size_next = min(size_next, int(Config().batch_latency / self._seconds_per_mail))
+        size_next = min(max(size_next, MIN_SIZE), self.size * MAX_GROWTH)
+
+        if size_next != self.size and Config().verbose is True:
+            sys.stderr.write(f'{self._name}: batch size {self.size} -> {size_next} mails '
+                             f'({format_size(size // max(commands, 1))}, {seconds / max(commands, 1):.2f} s '
+                             f'per command)\n')
+        self.size = size_next
+
+    def rounds(self, mail_ids: IdSet, depth: int) -> Iterator[List[IdSet]]:
+        """Split mails into rounds of up to depth batches to be pipelined.
+
+        All the batches of a round are of the same size. Record the cost of each round before
+        asking for the next one.
+
+        :param mail_ids:    the mail ids
+        :param depth:       maximum number of batches per round
+        :return:            an iterator over the rounds
+        """
+        batches = self.batches(mail_ids)
+        while True:
+            batch_round = list(itertools.islice(batches, max(depth, 1)))
+            if len(batch_round) == 0:
+                return
+            yield batch_round
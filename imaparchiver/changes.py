@@ -0,0 +1,143 @@
+# ------------------------------------------------------------
+# imaparchiver/changes.py
+#
+# detect mailboxes changed since the last run
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module keeps track of the mailboxes changed between two runs.
+
+Servers supporting CONDSTORE (RFC 7162) assign a modification sequence number (MODSEQ) to
+every change of a mail, including changes of its flags. The highest of these numbers of a
+mailbox (HIGHESTMODSEQ) is delivered along with its UIDVALIDITY, UIDNEXT and number of mails
+by a STATUS command or, for all the mailboxes at once, by LIST-STATUS. If none of them has
+changed since the last run, there is nothing new to do in this mailbox.
+"""
+
+import json
+import os
+import threading
+import uuid
+from typing import Dict, Iterable, Optional, Tuple
+
+from .config import Config
+
+
+# the status items recorded for each mailbox
+STATUS_ITEMS = ('UIDVALIDITY', 'UIDNEXT', 'MESSAGES', 'HIGHESTMODSEQ')
+
+
+class MailboxChanges(object):
+
+    """The status of the mailboxes as recorded by the last run of an operation.
+
+    The status is kept in a local JSON file per operation (e.g. moving mails of an account to
+    a certain archive mailbox), as a mailbox unchanged since the last move may still have to
+    be cleaned. Without CONDSTORE the changes of the flags of the mails cannot be detected, so
+    then every mailbox is considered changed.
+    """
+
+    def __init__(self, path: Optional[str], operation: str, capabilities: Iterable[str]):
+        """Constructor.
+
+        :param path:            the file holding the status of the mailboxes (None: no file)
+        :param operation:       the operation the status is recorded for
+        :param capabilities:    the capabilities of the server
+        """
+        self._path = path
+        self._operation = operation
+        self._lock = threading.Lock()
+        self._states = {}               # type: Dict[str, Dict[str, Dict[str, int]]]
+        self.enabled = path is not None and 'CONDSTORE' in capabilities
+        if self.enabled:
+            self._states = self._load()
+
+    def forget(self, name: str) -> None:
+        """Drop the status recorded for a mailbox (e.g. because it has been deleted).
+
+        :param name:    the name of the mailbox
+        """
+        with self._lock:
+            self._states.get(self._operation, {}).pop(name, None)
+
+    def _load(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """Read the file holding the status of the mailboxes.
+
+        :return:    the status of the mailboxes per operation (empty if there is none)
+        """
+        try:
+            with open(self._path) as f:
+                states = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return states if isinstance(states, dict) else {}
+
+    def modseq(self, name: str, status: Dict[str, int]) -> Optional[int]:
+        """Get the HIGHESTMODSEQ recorded for a mailbox.
+
+        Mails with a higher MODSEQ have been added or changed since the last run. Mails
+        expunged since are gone anyway.
+
+        :param name:    the name of the mailbox
+        :param status:  the current status of the mailbox (see status_items)
+        :return:        the HIGHESTMODSEQ recorded (None if all mails have to be examined)
+        """
+        recorded = self._recorded(name)
+        if not recorded.get('HIGHESTMODSEQ') or recorded.get('UIDVALIDITY') != status.get('UIDVALIDITY'):
+            return None
+        return recorded['HIGHESTMODSEQ']
+
+    def record(self, name: str, status: Dict[str, int]) -> None:
+        """Record the status of a mailbox the operation is done with.
+
+        This is the status taken before the operation started: mails changed by the
+        operation itself are examined once again by the next run.
+
+        :param name:    the name of the mailbox
+        :param status:  the status of the mailbox (see status_items)
+        """
+        if not self.enabled or not status.get('HIGHESTMODSEQ'):
+            return
+        with self._lock:
+            self._states.setdefault(self._operation, {})[name] = dict(status)
+
+    def _recorded(self, name: str) -> Dict[str, int]:
+        """Get the status recorded for a mailbox.
+
+        :param name:    the name of the mailbox
+        :return:        the status recorded (empty if there is none)
+        """
+        with self._lock:
+            recorded = self._states.get(self._operation, {}).get(name)
+        return recorded if isinstance(recorded, dict) else {}
+
+    def save(self) -> None:
+        """Write the file holding the status of the mailboxes. Nothing is written on a dry run."""
+        if not self.enabled or Config().dry_run:
+            return
+        folder = os.path.dirname(os.path.abspath(self._path))
+        part = os.path.join(folder, f'.{uuid.uuid4().hex}.part')
+        with self._lock:
+            with open(part, 'w') as f:
+                json.dump(self._states, f, indent=1, sort_keys=True)
+        os.replace(part, self._path)
+
+    @property
+    def status_items(self) -> Tuple[str, ...]:
+        """The status items to get for each mailbox (none if changes are not tracked)."""
+        return STATUS_ITEMS if self.enabled else ()
+
+    def unchanged(self, name: str, status: Dict[str, int]) -> bool:
+        """Check if a mailbox is unchanged since the last run.
+
+        :param name:    the name of the mailbox
+        :param status:  the current status of the mailbox (see status_items)
+        :return:        True, if the mailbox has not changed
+        """
+        if not self.enabled or not status.get('HIGHESTMODSEQ'):
+            return False
+        recorded = self._recorded(name)
+        return all(recorded.get(i) == status.get(i) for i in STATUS_ITEMS)
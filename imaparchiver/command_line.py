@@ -11,45 +11,151 @@
 """This module provides all command line stuff and figures."""
 
 import click
-import datetime
-import email.utils
+import functools
+import json
 import os
 import sys
-import time
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Set
 
+from . import aio
 from . import color
+from . import steps
+from .archive import check_compression, extract as extract_mail
+from .changes import MailboxChanges
 from .config import Config
 from .connection import Connection
+from .index import Index
 from .mailbox import Mailbox
+from .operations import download_mailbox, move_mailbox, print_scan_header, scan_mailbox, scan_status_items
+from .policy import mailbox_children, mailbox_levels, max_year, select_mailboxes
+from .pool import ConnectionPool
+from .profiling import Profiler
+from .stats import Stats
+from .tracing import Trace, analyze, load, print_analysis
 
 
 @click.group(invoke_without_command=True)
+@click.option('--batch-bytes', type=int, default=4 << 20,
+              help='Bytes to receive per IMAP4 command at most. Mails are fetched in batches sized to this.')
+@click.option('--batch-latency', type=float, default=2.0,
+              help='Seconds an IMAP4 command should take at most. Mails are fetched in batches sized to this.')
 @click.option('-d', '--dry-run', is_flag=True, default=False,
               help='Dry run: do not actually make any steps but act as if.')
+@click.option('--max-line-length', type=int, default=8192,
+              help='Maximum length of IMAP4 command lines. Longer commands are split.')
 @click.option('--no-color', is_flag=True, default=False, help='Turn off color output.')
+@click.option('--no-compress', is_flag=True, default=False,
+              help='Do not use COMPRESS=DEFLATE even if the server supports it.')
+@click.option('--pipeline-depth', type=int, default=8,
+              help='Maximum number of IMAP4 commands in flight at once. 1 turns pipelining off.')
+@click.option('--profile', 'profile_path', type=click.Path(dir_okay=False), default=None,
+              help='Profile the command, write a pstats dump to this file and print the hot spots.')
+@click.option('--profile-mode', type=click.Choice(['cprofile', 'sample']), default='cprofile',
+              help='Profile deterministically (cprofile) or by sampling the stacks (sample, less overhead).')
+@click.option('--stats', 'print_stats', is_flag=True, default=False,
+              help='Print the number, bytes and latency of the IMAP4 commands per command and mailbox at the end.')
+@click.option('--stats-json', type=click.Path(dir_okay=False), default=None,
+              help='Write the figures of --stats to this JSON file.')
+@click.option('--trace', 'trace_path', type=click.Path(dir_okay=False), default=None,
+              help='Write a line of JSON per IMAP4 command to this file (see analyze-trace).')
 @click.option('-V', '--verbose', is_flag=True, default=False, help='Be verbose.')
 @click.option('-v', '--version', is_flag=True, default=False, help='Show version information and exit.')
 @click.pass_context
 def cli(ctx: click.Context,
+        batch_bytes: int = 4 << 20,
+        batch_latency: float = 2.0,
         dry_run: bool = False,
+        max_line_length: int = 8192,
         no_color: bool = False,
+        no_compress: bool = False,
+        pipeline_depth: int = 8,
+        profile_path: str = None,
+        profile_mode: str = 'cprofile',
+        print_stats: bool = False,
+        stats_json: str = None,
+        trace_path: str = None,
         verbose: bool = False,
         version: bool = False) -> None:
+    Config().batch_bytes = batch_bytes
+    Config().batch_latency = batch_latency
     Config().dry_run = dry_run
+    Config().max_line_length = max_line_length
     Config().no_color = no_color
+    Config().no_compress = no_compress
+    Config().pipeline_depth = pipeline_depth
     Config().verbose = verbose
+    Config().stats = None
+    Config().trace = None
     if version:
         show_version()
         ctx.exit(0)
     if ctx.invoked_subcommand is None:
         ctx.fail('Missing command.')
+    if profile_path is not None:
+        profiler = Profiler(profile_path, profile_mode)
+        ctx.call_on_close(functools.partial(_report_profile, profiler))
+        profiler.start()
+    if print_stats or stats_json is not None:
+        Config().stats = Stats()
+        ctx.call_on_close(functools.partial(_report_stats, print_stats, stats_json))
+    if trace_path is not None:
+        Config().trace = Trace(trace_path)
+        ctx.call_on_close(Config().trace.close)
+
+
+def _report_profile(profiler: Profiler) -> None:
+    """Stop profiling, write the pstats dump and print the hot spots (see --profile).
+
+    :param profiler:    the profiler running
+    """
+    profiler.stop()
+    profiler.print_report(sys.stderr)
+
+
+def _report_stats(print_stats: bool, stats_json: Optional[str]) -> None:
+    """Report the figures of the IMAP4 commands run (see --stats and --stats-json).
+
+    :param print_stats:     print a summary to stderr
+    :param stats_json:      path of the JSON file to write (None: none)
+    """
+    if print_stats:
+        Config().stats.print_summary(sys.stderr)
+    if stats_json is not None:
+        Config().stats.write_json(stats_json)
+
+
+@cli.command('analyze-trace')
+@click.option('--json', 'json_path', type=click.Path(dir_okay=False), default=None,
+              help='Write the analysis to this JSON file, too.')
+@click.argument('TRACE', required=True, nargs=1, type=click.Path(exists=True, dir_okay=False))
+def analyze_trace(json_path: str = None, trace: str = None) -> None:
+    """Analyze a trace written by --trace.
+
+    \b
+    The critical path of the run is reconstructed: the connection completing
+    last, split into the time waiting for the server and the time in between
+    commands. Redundant SELECTs and runs of serial round trips (which could
+    have been pipelined) are listed.
+
+    TRACE is the JSON Lines file written by --trace.
+    """
+    analysis = analyze(load(trace))
+    print_analysis(analysis, sys.stdout)
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump(analysis, f, indent=2)
 
 
 @cli.command()
 @click.option('--ssl', is_flag=True, default=False, help='Connect via SSL (e.g. for MS Exchange).')
+@click.option('-j', '--jobs', type=int, default=1,
+              help='Number of mailboxes to work on in parallel, each with a connection of its own.')
+@click.option('--state', type=click.Path(dir_okay=False), default=None,
+              help='File to keep the status of the mailboxes in. Mailboxes unchanged since the last run '
+                   'are skipped (needs CONDSTORE).')
 @click.argument('CONNECT', required=True, nargs=1)
 @click.argument('MAILBOX', required=True, nargs=1)
-def clean(ssl: bool = False, connect: str = None, mailbox: str = None) -> None:
+def clean(ssl: bool = False, jobs: int = 1, state: str = None, connect: str = None, mailbox: str = None) -> None:
     """Delete empty mailboxes with no mail or child mailbox.
 
     \b
@@ -60,28 +166,106 @@ def clean(ssl: bool = False, connect: str = None, mailbox: str = None) -> None:
     MAILBOX is the mailbox to start cleaning
     """
     Config().ssl = ssl
+    Config().jobs = jobs
     host, port, username, password = Connection.parse(connect)
-    con = Connection(host, port, username, password)
-
-    mbs = con.mailboxes(mailbox)
-    for mb in sorted(mbs):
-
-        mbs[mb].expunge()
-        mail_count = mbs[mb].select()
-        if mail_count == 0 and not mbs[mb].children:
-            if Config().verbose is True:
-                mb_output = color.mailbox(mb)
-                sys.stderr.write(f'Mailbox: {mb_output} - removing (no mails, no children)\n')
-            if Config().dry_run is False:
-                mbs[mb].delete()
+    pool = ConnectionPool(host, port, username, password, Config().jobs)
+    try:
+        con = pool.acquire()
+        changes = MailboxChanges(state, f'clean {username}@{host}:{port}', con.capabilities)
+        status = ('MESSAGES',) + tuple(i for i in changes.status_items if i != 'MESSAGES')
+        if 'IMAP4rev2' in con.capabilities:
+            status = status + ('DELETED',)
+        mbs = select_mailboxes(con.mailboxes(mailbox, status))
+        con.status(mbs, status)
+        pool.release(con)
+
+        children = mailbox_children(mbs)
+        deleted = set()
+        try:
+            for level in mailbox_levels(mbs):
+                pool.map(functools.partial(_clean_mailbox, changes, children, deleted), level)
+        finally:
+            changes.save()
+    finally:
+        pool.close()
+
+
+def _clean_mailbox(changes: MailboxChanges, children: Dict[str, List[str]], deleted: Set[str],
+                   con: Connection, mb: Mailbox) -> None:
+    """Delete a single mailbox if it has no mail and no child mailbox.
+
+    The children of the mailbox have been cleaned before, so a mailbox whose children have
+    all been deleted is deleted too. Mails marked as deleted are expunged first, if there are
+    any. A mailbox with mails unchanged since the last run is skipped.
+
+    :param changes:     the mailboxes changed since the last run
+    :param children:    the names of the children per mailbox name (see mailbox_children)
+    :param deleted:     the names of the mailboxes deleted so far (this one is added if deleted)
+    :param con:         the connection to use
+    :param mb:          the mailbox
+    """
+    mb = mb.rebind(con)
+    mail_count = mb.status('MESSAGES')['MESSAGES']
+    status = mb.status(*changes.status_items) if changes.enabled else {}
+    if mail_count > 0 and changes.unchanged(mb.name, status):
+        if Config().verbose is True:
+            mb_output = color.mailbox(mb.name)
+            sys.stderr.write(f'Mailbox: {mb_output} - unchanged since last run\n')
+        return
+
+    if mail_count > 0:
+        deleted_count = mb.status('DELETED')['DELETED'] if 'IMAP4rev2' in con.capabilities else mb.count('DELETED')
+        if deleted_count > 0:
+            mb.expunge()
+            if deleted_count == mail_count:
+                mail_count = mb.count('ALL')
+
+    has_children = any(c not in deleted for c in children.get(mb.name, ()))
+    if mail_count == 0 and not has_children:
+        if Config().verbose is True:
+            mb_output = color.mailbox(mb.name)
+            sys.stderr.write(f'Mailbox: {mb_output} - removing (no mails, no children)\n')
+        if Config().dry_run is False:
+            mb.delete()
+            changes.forget(mb.name)
+        deleted.add(mb.name)
+    else:
+        changes.record(mb.name, status)
 
 
 @cli.command()
 @click.option('--ssl', is_flag=True, default=False, help='Connect via SSL (e.g. for MS Exchange).')
+@click.option('--date-source', type=click.Choice(['header', 'internaldate', 'auto']), default='header',
+              help='Date mails by their Date header, by their INTERNALDATE or by the header with '
+                   'the INTERNALDATE as fallback (auto).')
+@click.option('-j', '--jobs', type=int, default=1,
+              help='Number of mailboxes to work on in parallel, each with a connection of its own.')
+@click.option('--async', 'use_async', is_flag=True, default=False,
+              help='Drive all the connections from a single asyncio event loop instead of a thread each.')
+@click.option('--full', is_flag=True, default=False,
+              help='Download all mails again, not just the ones not downloaded yet.')
+@click.option('--format', 'download_format', type=click.Choice(['files', 'objects', 'maildir', 'mbox', 'tar']),
+              default='files',
+              help='Write a file per mail named after its date (files), store each mail body once under its '
+                   'SHA-256 with a manifest per mailbox (objects), or write a Maildir, mbox or tar file per mailbox.')
+@click.option('--compression', type=click.Choice(['none', 'gzip', 'zstd']), default='none',
+              help='Compress the maildir, mbox or tar output (zstd needs the zstandard package).')
+@click.option('--per-year', is_flag=True, default=False,
+              help='Write an mbox or tar file per mailbox and year instead of per mailbox.')
 @click.argument('CONNECT', required=True, nargs=1)
 @click.argument('MAILBOX', required=True, nargs=1)
 @click.argument('FOLDER', required=True, nargs=1)
-def download(ssl: bool = False, connect: str = None, mailbox: str = None, folder: str = None) -> None:
+def download(ssl: bool = False,
+             date_source: str = 'header',
+             jobs: int = 1,
+             use_async: bool = False,
+             full: bool = False,
+             download_format: str = 'files',
+             compression: str = 'none',
+             per_year: bool = False,
+             connect: str = None,
+             mailbox: str = None,
+             folder: str = None) -> None:
     """Recursively download messages from an IMAP folder.
 
     \b
@@ -92,7 +276,30 @@ def download(ssl: bool = False, connect: str = None, mailbox: str = None, folder
     MAILBOX is the mailbox name to start downloading.
 
     FOLDER is the local target folder to download mails to.
+
+    The download state of each mailbox is kept in its folder: a later download fetches the
+    mails not downloaded yet only. If the UIDVALIDITY of a mailbox has changed, all of its
+    mails are downloaded again.
+
+    With --format objects the mail bodies of all mailboxes are stored once only, in the
+    .objects folder of FOLDER, and a manifest in the folder of each mailbox lists its mails.
+
+    With --format mbox or tar the mails are appended to a file per mailbox (or per mailbox
+    and year), e.g. 'mails.mbox.zst', with an offset index next to it to extract single
+    mails (see extract).
     """
+    if compression != 'none' and download_format not in ('maildir', 'mbox', 'tar'):
+        sys.stderr.write(color.error('--compression needs --format maildir, mbox or tar.\n'))
+        sys.exit(1)
+    if per_year and download_format not in ('mbox', 'tar'):
+        sys.stderr.write(color.error('--per-year needs --format mbox or tar.\n'))
+        sys.exit(1)
+    try:
+        check_compression(compression)
+    except RuntimeError as e:
+        sys.stderr.write(color.error(str(e)) + '\n')
+        sys.exit(1)
+
     if Config().verbose:
         sys.stderr.write("Recursively downloading messages from IMAP4 '" +
                          color.mailbox(mailbox) +
@@ -107,88 +314,74 @@ def download(ssl: bool = False, connect: str = None, mailbox: str = None, folder
         sys.exit(1)
 
     Config().ssl = ssl
+    Config().date_source = date_source
+    Config().download_compression = None if compression == 'none' else compression
+    Config().download_format = download_format
+    Config().download_per_year = per_year
+    Config().jobs = jobs
     host, port, username, password = Connection.parse(connect)
-    con = Connection(host, port, username, password)
-
-    mbs = con.mailboxes(mailbox)
-    for mb_name in sorted(mbs):
-
-        m = mbs[mb_name]
-        mb_name_output = color.mailbox(mb_name)
-        mail_count = m.select()
-        if mail_count > 0:
-
-            mail_folder = os.path.join(folder, mb_name.replace(m.delimiter, os.sep))
-            sys.stderr.write('Downloading ' + str(mail_count) +
-                             f" mails from mailbox '{mb_name_output}' to '{mail_folder}'\n")
-
-            r, d = m.search('ALL')
-            if not r == 'OK':
-                sys.stderr.write(color.error('Failed to list messages in mailbox.\n'))
-                continue
-
-            for m_id in d[0].decode().split(' '):
-
-                sys.stdout.write(f'Fetching message {m_id}\n')
-                filename = None
-                r, mail_header = m.fetch(m_id, '(BODY.PEEK[HEADER])')
-                try:
-                    header_line = mail_header[0][1].split(b'\r\n')
-                    for l in header_line:
-                        if l.startswith(b'Date:'):
-                            t = email.utils.parsedate(str(l)[8:])
-                            if t:
-                                filename = str(time.mktime(t)) + ".mail"
-                                break
-                            else:
-                                sys.stderr.write(color.error('Failed to parse timestamp: ' + str(l) + '\n'))
-                                sys.exit(1)
-
-                except Exception as e:
-                    sys.stderr.write(color.error('Failed to fetch message header:\n' + str(e) + '\n'))
-                    sys.exit(1)
-
-                if filename is None:
-                    sys.stderr.write(color.error('Cannot deduce filename for mail.\n'))
-                    sys.exit(1)
-
-                sys.stderr.write(f'Writing mail as "{filename}"\n')
-                r, mail_content = m.fetch(m_id, '(BODY[])')
-                if not r == 'OK':
-                    sys.stderr.write(color.error('Failed to fetch mail body.\n'))
-                    sys.exit(1)
-
-                try:
-                    try:
-                        os.makedirs(mail_folder)
-                    except:
-                        pass
-                    f = open(os.path.join(mail_folder, filename), 'wb')
-                    f.write(mail_content[0][1])
-                    f.close()
-                except Exception as e:
-                    print("Failed to write to mail file: " + str(e))
-                    sys.exit(1)
-
-
-def max_year() -> int:
-    """Returns the maximum year for which mails < max_year() are considered old.
-
-    :return:    most recent year for which mails are old
+    if use_async:
+        aio.run(aio.download, host, port, username, password, mailbox, folder, full)
+        return
+    pool = ConnectionPool(host, port, username, password, Config().jobs)
+    try:
+        con = pool.acquire()
+        mbs = con.mailboxes(mailbox)
+        pool.release(con)
+        pool.map(functools.partial(_operation, download_mailbox, folder, full), select_mailboxes(mbs))
+    finally:
+        pool.close()
+
+
+@cli.command()
+@click.option('--uidvalidity', type=int, default=None,
+              help='UIDVALIDITY of the mail, if the mailbox was downloaded again after it changed.')
+@click.argument('CONTAINER', required=True, nargs=1, type=click.Path(exists=True, dir_okay=False))
+@click.argument('UID', required=True, nargs=1, type=int)
+def extract(uidvalidity: int = None, container: str = None, uid: int = None) -> None:
+    """Extract a single mail of an mbox or tar file written by download.
+
+    \b
+    CONTAINER is the mbox or tar file, e.g. 'INBOX/mails.mbox.zst'.
+    UID is the UID of the mail.
+
+    The mail is looked up in the offset index next to CONTAINER and written to stdout.
     """
-    return datetime.date(datetime.date.today().year - 1, 1, 1).year
+    try:
+        mail = extract_mail(container, uid, uidvalidity)
+    except (OSError, RuntimeError, ValueError) as e:
+        sys.stderr.write(color.error(f"Failed to extract mail {uid} from '{container}':\n" + str(e)) + '\n')
+        sys.exit(1)
+    sys.stdout.buffer.write(mail)
 
 
 @cli.command()
 @click.option('--ssl', is_flag=True, default=False, help='Connect via SSL (e.g. for MS Exchange).')
 @click.option('-o', '--omit-mailbox', type=str, default=None, help='List of mailboxes to ignore.')
 @click.option('-y', '--year', type=int, default=None, help='Any mail before 1st January this year are considered old.')
+@click.option('--date-source', type=click.Choice(['header', 'internaldate', 'auto']), default='header',
+              help='Date mails by their Date header, by their INTERNALDATE or by the header with '
+                   'the INTERNALDATE as fallback (auto).')
+@click.option('-j', '--jobs', type=int, default=1,
+              help='Number of mailboxes to work on in parallel, each with a connection of its own.')
+@click.option('--async', 'use_async', is_flag=True, default=False,
+              help='Drive all the connections from a single asyncio event loop instead of a thread each.')
+@click.option('--state', type=click.Path(dir_okay=False), default=None,
+              help='File to keep the status of the mailboxes in. Mailboxes unchanged since the last run '
+                   'are skipped (needs CONDSTORE).')
+@click.option('--index', 'index_path', type=click.Path(dir_okay=False), default=None,
+              help='SQLite file to keep an index of the mails in. Only changes are fetched from the server.')
 @click.argument('CONNECT', required=True, nargs=1)
 @click.argument('MAILBOX-FROM', required=True, nargs=1)
 @click.argument('MAILBOX-TO', required=True, nargs=1)
 def move(ssl: bool = False,
          omit_mailbox: str = None,
          year: int = None,
+         date_source: str = 'header',
+         jobs: int = 1,
+         use_async: bool = False,
+         state: str = None,
+         index_path: str = None,
          connect: str = None,
          mailbox_from: str = None,
          mailbox_to: str = None) -> None:
@@ -205,8 +398,9 @@ def move(ssl: bool = False,
     MAILBOX-TO is the to move to. Use double quotes if name contains spaces.
     """
     Config().ssl = ssl
+    Config().date_source = date_source
+    Config().jobs = jobs
     host, port, username, password = Connection.parse(connect)
-    con = Connection(host, port, username, password)
 
     omit = []
     if omit_mailbox is not None:
@@ -216,35 +410,57 @@ def move(ssl: bool = False,
     if Config().verbose:
         sys.stderr.write(f'Year sent of mails to be moved: < {year}\n')
 
-    mbs = con.mailboxes(mailbox_from)
-    for mb in sorted(mbs):
-
-        mb_from_output = color.mailbox(mb)
-        if mbs[mb] is None:
-            continue
-        if mb in omit:
-            if Config().verbose:
-                sys.stderr.write(f'Omitting mailbox {mb_from_output}\n')
-            continue
-
-        if Config().verbose:
-            sys.stderr.write(f'Checking mailbox {mb_from_output}...\n')
-
-        mails_all, mails_seen, mails_deleted, mails_per_year = mbs[mb].inspect()
-        for y in mails_per_year:
-            if y < year:
-                archive_mailbox = mailbox_to + mbs[mb].delimiter + str(y) + mbs[mb].delimiter + mb
-                if ' ' in archive_mailbox:
-                    archive_mailbox = '"' + archive_mailbox + '"'
-                mb_to_output = color.mailbox(archive_mailbox)
-
-                mails_to_move = len(mails_per_year[y])
-                sys.stdout.write(f'Mailbox: {mb_from_output} - moving {mails_to_move} mails to {mb_to_output}\n')
-                if Config().dry_run is False:
-                    con.create_mailbox(archive_mailbox, mbs[mb].delimiter)
-                    mbs[mb].copy(mails_per_year[y], archive_mailbox)
-                    mbs[mb].store(mails_per_year[y], '+FLAGS', r'(\Deleted)')
-                    mbs[mb].expunge()
+    operation = f'move {username}@{host}:{port} {mailbox_to} {year} {date_source}'
+    index = Index(index_path) if index_path is not None else None
+    try:
+        if use_async:
+            aio.run(aio.move, host, port, username, password, mailbox_from, mailbox_to, year, omit, state, operation,
+                    index)
+            return
+        _move(host, port, username, password, mailbox_from, mailbox_to, year, omit, state, operation, index)
+    finally:
+        if index is not None:
+            index.close()
+
+
+def _move(host: str, port: int, username: str, password: str, mailbox_from: str, mailbox_to: str, year: int,
+          omit: Iterable[str], state: Optional[str], operation: str, index: Optional[Index]) -> None:
+    """Move old mails to the archive mailbox (see the move command).
+
+    :param host:            the host to connect
+    :param port:            the host's port number (if 0 then the default will be used)
+    :param username:        user account for login
+    :param password:        user password for login
+    :param mailbox_from:    the mailbox to start moving from
+    :param mailbox_to:      the mailbox to move to
+    :param year:            mails sent before 1st January of this year are old
+    :param omit:            names of mailboxes to ignore
+    :param state:           the file holding the status of the mailboxes (see MailboxChanges)
+    :param operation:       the operation the status is recorded for
+    :param index:           the index to inspect the mailboxes by (if any)
+    """
+    pool = ConnectionPool(host, port, username, password, Config().jobs)
+    try:
+        con = pool.acquire()
+        changes = MailboxChanges(state, operation, con.capabilities)
+        mbs = con.mailboxes(mailbox_from, changes.status_items)
+        pool.release(con)
+        try:
+            pool.map(functools.partial(_operation, move_mailbox, mailbox_to, year, changes, index),
+                     select_mailboxes(mbs, omit))
+        finally:
+            changes.save()
+    finally:
+        pool.close()
+
+
+def _operation(operation: Callable[..., Generator], *args) -> None:
+    """Run an operation on a single mailbox on a blocking connection (see the operations module).
+
+    :param operation:   the operation, e.g. operations.move_mailbox
+    :param args:        the arguments of the operation, the connection and the mailbox last
+    """
+    steps.run(operation(*args))
 
 
 @cli.command()
@@ -252,43 +468,91 @@ def move(ssl: bool = False,
 @click.option('-m', '--mailbox', help='Top mailbox to start scanning. Use quotes if name contains spaces.')
 @click.option('-l', '--list-boxes-only', is_flag=True, default=False,
               help='Only list mailbox, do not examine each mail therein.')
+@click.option('--years', is_flag=True, default=False,
+              help='Examine each mail and show the number of seen mails per year (slow).')
+@click.option('--date-source', type=click.Choice(['header', 'internaldate', 'auto']), default='header',
+              help='Date mails by their Date header, by their INTERNALDATE or by the header with '
+                   'the INTERNALDATE as fallback (auto).')
+@click.option('-j', '--jobs', type=int, default=1,
+              help='Number of mailboxes to work on in parallel, each with a connection of its own.')
+@click.option('--async', 'use_async', is_flag=True, default=False,
+              help='Drive all the connections from a single asyncio event loop instead of a thread each.')
+@click.option('--index', 'index_path', type=click.Path(dir_okay=False), default=None,
+              help='SQLite file to keep an index of the mails in. Only changes are fetched from the server.')
 @click.argument('CONNECT', required=True, nargs=1)
-def scan(ssl: bool = False, mailbox: str = None, list_boxes_only: bool = False, connect: str = None) -> None:
+def scan(ssl: bool = False,
+         mailbox: str = None,
+         list_boxes_only: bool = False,
+         years: bool = False,
+         date_source: str = 'header',
+         jobs: int = 1,
+         use_async: bool = False,
+         index_path: str = None,
+         connect: str = None) -> None:
     """Scan IMAP folders.
 
     \b
     CONNECT holds the connection details. Syntax is USER[:PASS]@HOST[:PORT]
     like 'john@example.com' or 'bob:mysecret@mail-server.com:143'.
     If password PASS is omitted you are asked for it.
+
+    Unless --years is given the mails are counted by the server (STATUS, LIST-STATUS
+    and ESEARCH where available) and the mails themselves are not examined at all.
+
+    With --index the mails are counted by the index, which is brought up to date first.
+    The size of the mails is shown then, too.
     """
     Config().ssl = ssl
+    Config().date_source = date_source
+    Config().jobs = jobs
     host, port, username, password = Connection.parse(connect)
-    con = Connection(host, port, username, password)
-    mbs = con.mailboxes(Mailbox.strip_path(mailbox or ''))
-    header_shown = False
-    for mb in sorted(mbs):
-
-        if list_boxes_only is False:
-
-            if not header_shown:
-                print('%-70s   all mails   seen mails   deleted mails' % 'Mailbox name')
-                print('%s-----------------------------------------' % ('-' * 70))
-                header_shown = True
-
-            mails_all, mails_seen, mails_deleted, mails_per_year = mbs[mb].inspect()
-            if Config().no_color:
-                print('%-70s       %5d        %5d           %5d' %
-                      (color.mailbox(mb), len(mails_all), len(mails_seen), len(mails_deleted)))
-            else:
-                print('%-79s       %5d        %5d           %5d' %
-                      (color.mailbox(mb), len(mails_all), len(mails_seen), len(mails_deleted)))
-
+    index = Index(index_path) if index_path is not None and not list_boxes_only else None
+    try:
+        if use_async and not list_boxes_only:
+            aio.run(aio.scan, host, port, username, password, mailbox, years, index)
+            return
+        _scan(host, port, username, password, mailbox, list_boxes_only, years, index)
+    finally:
+        if index is not None:
+            index.close()
+
+
+def _scan(host: str, port: int, username: str, password: str, mailbox: str, list_boxes_only: bool, years: bool,
+          index: Optional[Index]) -> None:
+    """Scan IMAP folders (see the scan command).
+
+    :param host:                the host to connect
+    :param port:                the host's port number (if 0 then the default will be used)
+    :param username:            user account for login
+    :param password:            user password for login
+    :param mailbox:             the mailbox to start scanning
+    :param list_boxes_only:     only list the mailboxes
+    :param years:               examine each mail and print the number of seen mails per year
+    :param index:               the index to count the mails by (if any)
+    """
+    pool = ConnectionPool(host, port, username, password, Config().jobs)
+    try:
+        con = pool.acquire()
+        status = scan_status_items(con.capabilities)
+        if list_boxes_only or years or index is not None:
+            mbs = con.mailboxes(Mailbox.strip_path(mailbox or ''))
         else:
-            if not header_shown:
+            mbs = con.mailboxes(Mailbox.strip_path(mailbox or ''), status)
+        pool.release(con)
+
+        if list_boxes_only:
+            if len(mbs) > 0:
                 print('Mailboxes')
                 print('%s-----------------------------------------' % ('-' * 70))
-                header_shown = True
-            print(color.mailbox(mb))
+            for mb in sorted(mbs):
+                print(color.mailbox(mb))
+            return
+
+        if len(mbs) > 0:
+            print_scan_header(index)
+        pool.map(functools.partial(_operation, scan_mailbox, years, status, index), select_mailboxes(mbs))
+    finally:
+        pool.close()
 
 
 def show_version() -> None:
@@ -0,0 +1,187 @@
+# ------------------------------------------------------------
+# imaparchiver/compress.py
+#
+# IMAP4 COMPRESS=DEFLATE (RFC 4978)
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module contains the streaming DEFLATE layer of the COMPRESS extension (RFC 4978).
+
+Once the server acknowledged COMPRESS DEFLATE, everything sent and received on the connection
+is a raw DEFLATE stream (no zlib header). Each write is flushed by Z_SYNC_FLUSH, so the server
+sees a command as soon as it is sent.
+
+The blocking engine swaps the file imaplib reads from for a DeflateReader and routes imaplib's
+send through a Deflater. The asyncio engine wraps its streams in DeflateStreamReader and
+DeflateStreamWriter, which offer the few methods the engine calls.
+"""
+
+import asyncio
+import io
+import zlib
+from typing import Callable
+
+
+# compressed data is read in chunks of this size
+_CHUNK_SIZE = 1 << 16
+
+
+class Deflater(object):
+
+    """Compress data to be sent on a connection."""
+
+    def __init__(self, send: Callable[[bytes], object]):
+        """Constructor.
+
+        :param send:    sends the compressed data (e.g. socket.sendall)
+        """
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._send = send
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress data, flushed so the peer is able to decompress all of it right away.
+
+        :param data:    the data
+        :return:        the compressed data
+        """
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def send(self, data: bytes) -> None:
+        """Compress and send data.
+
+        :param data:    the data
+        """
+        self._send(self.compress(data))
+
+
+class DeflateReader(io.RawIOBase):
+
+    """Decompress the data read from a file (e.g. the socket file of imaplib).
+
+    Wrap it into a io.BufferedReader to get readline() and the like.
+    """
+
+    def __init__(self, raw: io.BufferedIOBase):
+        """Constructor.
+
+        :param raw:     the file giving the compressed data
+        """
+        super().__init__()
+        self._raw = raw
+        self._decompressor = zlib.decompressobj(-15)
+
+    def readable(self) -> bool:
+        """The file is readable."""
+        return True
+
+    def readinto(self, b) -> int:
+        """Read decompressed data.
+
+        :param b:       the buffer to fill
+        :return:        the number of bytes read (0 at the end of the stream)
+        """
+        data = b''
+        while len(data) == 0:
+            if self._decompressor.unconsumed_tail:
+                compressed = self._decompressor.unconsumed_tail
+            else:
+                compressed = self._raw.read1(_CHUNK_SIZE)
+                if len(compressed) == 0:
+                    return 0
+            data = self._decompressor.decompress(compressed, len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class DeflateStreamReader(object):
+
+    """Decompress the data read from an asyncio.StreamReader."""
+
+    def __init__(self, reader, limit: int):
+        """Constructor.
+
+        :param reader:  the asyncio.StreamReader giving the compressed data
+        :param limit:   the maximum length of a line
+        """
+        self._reader = reader
+        self._limit = limit
+        self._decompressor = zlib.decompressobj(-15)
+        self._buffer = bytearray()
+
+    async def _fill(self) -> bool:
+        """Read and decompress more data into the buffer.
+
+        :return:    False at the end of the stream
+        """
+        if self._decompressor.unconsumed_tail:
+            compressed = self._decompressor.unconsumed_tail
+        else:
+            compressed = await self._reader.read(_CHUNK_SIZE)
+            if len(compressed) == 0:
+                return False
+        self._buffer += self._decompressor.decompress(compressed, _CHUNK_SIZE << 4)
+        return True
+
+    async def readexactly(self, n: int) -> bytes:
+        """Read exactly n bytes.
+
+        :param n:   the number of bytes to read
+        :return:    the data
+        """
+        while len(self._buffer) < n:
+            if not await self._fill():
+                raise asyncio.IncompleteReadError(bytes(self._buffer), n)
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def readline(self) -> bytes:
+        """Read a line.
+
+        :return:    the line including the line ending (all that is left at the end of the stream)
+        """
+        start = 0
+        while True:
+            i = self._buffer.find(b'\n', start)
+            if i >= 0:
+                break
+            if len(self._buffer) > self._limit:
+                raise ValueError('Separator is not found, and chunk exceed the limit')
+            start = len(self._buffer)
+            if not await self._fill():
+                i = len(self._buffer) - 1
+                break
+        line = bytes(self._buffer[:i + 1])
+        del self._buffer[:i + 1]
+        return line
+
+
+class DeflateStreamWriter(object):
+
+    """Compress the data written to an asyncio.StreamWriter."""
+
+    def __init__(self, writer):
+        """Constructor.
+
+        :param writer:  the asyncio.StreamWriter to write the compressed data to
+        """
+        self._writer = writer
+        self._deflater = Deflater(writer.write)
+
+    def close(self) -> None:
+        """Close the stream."""
+        self._writer.close()
+
+    async def drain(self) -> None:
+        """Wait until the data written may be sent."""
+        await self._writer.drain()
+
+    def write(self, data: bytes) -> None:
+        """Compress and write data.
+
+        :param data:    the data
+        """
+        self._deflater.send(data)
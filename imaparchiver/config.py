@@ -10,24 +10,45 @@
 
 """This module contains the app wide configuration object."""
 
+import threading
+
 
 class _Singleton(type):
 
-    """Singleton class instance."""
+    """Singleton class instance (thread safe)."""
     _instances = {}
+    _lock = threading.Lock()
 
     def __call__(cls, *args, **kwargs):
         if cls not in cls._instances:
-            cls._instances[cls] = super(_Singleton, cls).__call__(*args, **kwargs)
+            with cls._lock:
+                if cls not in cls._instances:
+                    cls._instances[cls] = super(_Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
 
 class Config(metaclass=_Singleton):
 
-    """This object holds the app wide configurations like command line options, etc."""
+    """This object holds the app wide configurations like command line options, etc.
+
+    The configuration is set up by the main thread before any work is started. Worker
+    threads only read it.
+    """
 
     def __init__(self):
+        self.batch_bytes = 4 << 20
+        self.batch_latency = 2.0
+        self.date_source = 'header'
+        self.download_compression = None    # 'gzip' or 'zstd' for the container formats of download
+        self.download_format = 'files'
+        self.download_per_year = False
         self.dry_run = False
+        self.jobs = 1
+        self.max_line_length = 8192
         self.no_color = False
+        self.no_compress = False
+        self.pipeline_depth = 8
         self.ssl = False
+        self.stats = None               # the stats.Stats collector if asked for
+        self.trace = None               # the tracing.Trace if asked for
         self.verbose = False
@@ -11,54 +11,145 @@
 # thanks to a lot of inspiration from
 # http://pymotw.com/2/imaplib/
 
+import collections
 import getpass
 import imaplib
+import io
+import os
 import re
+import socket
 import sys
-from typing import List
+import threading
+from typing import BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 from .config import Config
 from . import color
-from .mailbox import Mailbox
+from .compress import DeflateReader, Deflater
+from .fetch import split_fetch
+from .idset import IdSet
+from .mailbox import Mailbox, parse_status
+from .stats import Recorder
+
+
+# literals streamed to a file are read in chunks of this size
+_CHUNK_SIZE = 1 << 16
+
+# the folders existing and subscribed per (host, port, user, root folder), see Connection._hierarchy
+Hierarchies = Dict[Tuple[str, int, str, str], Tuple[Set[str], Set[str]]]
+
+
+def discard_files(files: Iterable[BinaryIO]) -> None:
+    """Close the files literals were streamed to and remove them, e.g. when a FETCH failed half way.
+
+    Files without a name on disk (e.g. spooled in memory) are just closed.
+
+    :param files:   the files given by literal_file (see Connection.fetch_stream)
+    """
+    for f in files:
+        try:
+            f.close()
+        except OSError:
+            pass
+        name = getattr(f, 'name', None)
+        if isinstance(name, str):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
 
 
 class Connection(object):
 
-    """This represents a IMAP4 connection."""
+    """This represents a IMAP4 connection.
 
-    def __init__(self, host: str, port: str, username: str, password: str):
+    The mailbox selected is kept in selected as (path, read-only), so mailboxes can skip
+    redundant SELECT and EXAMINE commands.
+    """
+
+    # mailbox creation is serialized among all connections (see ConnectionPool)
+    _create_mailbox_lock = threading.Lock()
+
+    def __init__(self, host: str, port: str, username: str, password: str, hierarchies: Hierarchies = None):
         """Constructor.
 
-        :param host:        the host to connect
-        :param port:        the host's port number (if 0 then the default will be used)
-        :param username:    user account for login
-        :param password:    user password for login
+        :param host:            the host to connect
+        :param port:            the host's port number (if 0 then the default will be used)
+        :param username:        user account for login
+        :param password:        user password for login
+        :param hierarchies:     the folders known per account and root folder, shared with other
+                                connections (see _hierarchy)
         """
         self._connection = None
         self._capabilities = []
+        self._account = (host, port, username)
+        self._hierarchies = {} if hierarchies is None else hierarchies
+        self.selected = None            # type: Optional[Tuple[str, bool]]
+        self._recorder = None           # type: Optional[Recorder]
         self.establish(host, port)
         self.login(username, password)
 
     def __del__(self):
         """Destructor."""
         try:
-            if not self._connection is None:
-                self._connection.close()
-                self._connection.logout()
+            self.close()
         except:
             pass
 
+    def close(self) -> None:
+        """Log out and close the connection.
+
+        The mailbox selected is not closed by CLOSE: CLOSE expunges every mail marked as
+        deleted in a mailbox selected read-write, not just the mails the archiver removed.
+        A mailbox selected read-write is left by UNSELECT (RFC 3691) if the server supports
+        it. LOGOUT never expunges anything.
+        """
+        imap4 = self._connection
+        if imap4 is None:
+            return
+        self._connection = None
+        try:
+            if self.selected is not None and not self.selected[1] and 'UNSELECT' in self._capabilities:
+                imap4.unselect()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        finally:
+            self.selected = None
+        try:
+            imap4.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
     @property
     def capabilities(self) -> List:
         """Returns the capabilities of this connection to the remote host."""
         return self._capabilities
 
+    def _compress(self) -> None:
+        """Switch on COMPRESS=DEFLATE (RFC 4978) if the server supports it and the user did not opt out."""
+        if Config().no_compress is True or 'COMPRESS=DEFLATE' not in self.capabilities:
+            return
+        try:
+            res, data = self._connection.xatom('COMPRESS', 'DEFLATE')
+        except imaplib.IMAP4.error:
+            res = 'BAD'
+        if res != 'OK':
+            sys.stderr.write(color.error('failed to switch to COMPRESS=DEFLATE, going on uncompressed.\n'))
+            return
+        imap4 = self._connection
+        imap4.file = io.BufferedReader(DeflateReader(imap4.file))
+        imap4.send = Deflater(imap4.sock.sendall).send
+        self._record_send()
+        if Config().verbose is True:
+            sys.stderr.write(color.success('Switched to COMPRESS=DEFLATE.\n'))
+
     def create_mailbox(self, path: str, delimiter: str) -> None:
         """Create a mailbox folder (recursively)  on the server.
 
         The folder path given is created recursively. So if path = 'a.b.c.' then
         the folder 'a' is created, then 'b' and finally 'c'.
 
+        This is safe to be called by several connections in parallel.
+
         :param str path:        the mailbox folder name as understood by the IMAP4 server.
         :param str delimiter:   path delimier used
         """
@@ -68,7 +159,20 @@ class Connection(object):
         if len(path) == 0:
             return
 
+        with Connection._create_mailbox_lock:
+            self._create_mailbox(path, delimiter)
+
+    def _create_mailbox(self, path: str, delimiter: str) -> None:
+        """Create a mailbox folder (recursively) on the server without any locking.
+
+        Only the folders missing are created and only the folders not subscribed yet are
+        subscribed (see _hierarchy).
+
+        :param str path:        the mailbox folder name as understood by the IMAP4 server.
+        :param str delimiter:   path delimier used
+        """
         path_stripped = Mailbox.strip_path(path)
+        existing, subscribed = self._hierarchy(path_stripped.split(delimiter)[0])
         mb = ''
         for path_particle in path_stripped.split(delimiter):
 
@@ -80,10 +184,38 @@ class Connection(object):
             if ' ' in mb:
                 mb_quoted = '"' + mb + '"'
 
-            r, d = self._connection.select(mb_quoted)
-            if r == 'NO':
-                self._connection.create(mb_quoted)
-            self._connection.subscribe(mb_quoted)
+            if mb not in existing:
+                res, data = self._connection.create(mb_quoted)
+                if res != 'OK' and not self._create_failed_as_existing(data, mb_quoted):
+                    raise RuntimeError(f'Failed to create mailbox {mb}: {data}')
+                existing.add(mb)
+            if mb not in subscribed:
+                self._connection.subscribe(mb_quoted)
+                subscribed.add(mb)
+
+    @staticmethod
+    def _already_exists(data: List) -> bool:
+        """Check the data of a tagged NO response for the ALREADYEXISTS response code (RFC 5530).
+
+        :param data:    the data of the tagged response
+        :return:        True, if the response code is ALREADYEXISTS
+        """
+        return any(d is not None and b'[ALREADYEXISTS]' in d for d in data)
+
+    def _create_failed_as_existing(self, data: List, mb_quoted: str) -> bool:
+        """Check if a failed CREATE is due to the mailbox being there already.
+
+        This is the case if the server said so with [ALREADYEXISTS] or if a LIST finds the
+        mailbox (e.g. as created by another client in the meantime).
+
+        :param data:        the data of the tagged NO response to CREATE
+        :param mb_quoted:   the mailbox as sent with CREATE
+        :return:            True, if the mailbox exists
+        """
+        if Connection._already_exists(data):
+            return True
+        res, mailbox_list = self._connection.list('""', mb_quoted)
+        return res == 'OK' and any(m is not None for m in mailbox_list)
 
     def _dump_capabilities(self) -> None:
         """Show the capabilities of the connection to the user."""
@@ -133,12 +265,16 @@ class Connection(object):
             self._connection = None
             sys.exit(1)
 
+        # pipelined commands are small writes in a row: do not let Nagle's algorithm hold them back
+        self._connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._record()
+
         if Config().verbose is True:
             sys.stdout.write(color.success('connected.\n') + 'Checking capabilities...')
 
         res, caps = self._connection.capability()
         if res != 'OK' or len(caps) == 0:
-            sys.stderr.write(color.error(f'failed to check capabilities of remote host.\n'))
+            sys.stderr.write(color.error('failed to check capabilities of remote host.\n'))
             sys.exit(1)
         if Config().verbose is True:
             sys.stderr.write(color.success('done.\n'))
@@ -150,11 +286,120 @@ class Connection(object):
             if Config().verbose is True:
                 sys.stderr.write(color.success('Switched to STARTTLS.\n'))
 
+    def fetch_stream(self, sequence_set: str, message_parts: str,
+                     literal_file: Callable[[bytes], Optional[BinaryIO]]) -> Iterator[List]:
+        """Run an UID FETCH and hand over the response mail by mail, while it is received.
+
+        For each literal literal_file(prefix) is asked for a file with the response part in
+        front of the literal as prefix (e.g. b'12 (UID 37 BODY[] {2317}'). The literal is
+        written to that file in chunks as it comes in, or kept in memory if there is no file.
+        So a mail is never held in memory as a whole if it goes to a file. If the response
+        breaks off in the middle of a mail, the files of that mail are closed and removed.
+
+        The iterator has to be run until its end: the connection is not usable before.
+
+        :param sequence_set:    the mail ids
+        :param message_parts:   the message parts to fetch
+        :param literal_file:    gives the file to write a literal to (or None to keep it in memory)
+        :return:                an iterator over the data of each mail, in the format of imaplib but
+                                with a file in place of a literal written to a file
+        """
+        if self._connection is None:
+            raise RuntimeError('No connection to IMAP4 server.')
+
+        imap4 = self._connection
+        tag = imap4._command('UID', 'FETCH', sequence_set, message_parts)
+        while True:
+
+            line = imap4._get_line()
+            if line.startswith(tag + b' '):
+                del imap4.tagged_commands[tag]
+                res = line.split(b' ')[1].decode()
+                if res != 'OK':
+                    raise RuntimeError('Server error on fetching mails. Returned: ' + line.decode(errors='replace'))
+                return
+
+            m = imaplib.Untagged_status.match(line)
+            if m is None:
+                m = imaplib.Untagged_response.match(line)
+            if m is None:
+                continue
+            typ = m.group('type').decode()
+            data = m.group('data') or b''
+            if 'data2' in m.groupdict() and m.group('data2') is not None:
+                data = data + b' ' + m.group('data2')
+            if typ == 'BYE':
+                raise imap4.abort(data.decode(errors='replace'))
+
+            mail_data = []
+            files = []
+            try:
+                while imaplib.Literal.match(data) is not None:
+                    size = int(imaplib.Literal.match(data).group('size'))
+                    f = literal_file(data) if typ == 'FETCH' else None
+                    if f is None:
+                        literal = imap4.read(size)
+                        if len(literal) < size:
+                            raise imap4.abort('socket error: EOF in the middle of a literal')
+                    else:
+                        files.append(f)
+                        while size > 0:
+                            chunk = imap4.read(min(size, _CHUNK_SIZE))
+                            if not chunk:
+                                raise imap4.abort('socket error: EOF in the middle of a literal')
+                            f.write(chunk)
+                            size -= len(chunk)
+                        literal = f
+                    mail_data.append((data, literal))
+                    data = imap4._get_line()
+            except BaseException:
+                discard_files(files)
+                raise
+            mail_data.append(data)
+
+            if typ == 'FETCH':
+                yield mail_data
+            else:
+                for d in mail_data:
+                    imap4._append_untagged(typ, d)
+
+    def forget_mailbox(self, name: str) -> None:
+        """Drop a mailbox just deleted from the folders known to exist (see _hierarchy).
+
+        :param name:    the name of the mailbox
+        """
+        with Connection._create_mailbox_lock:
+            for key, (existing, subscribed) in self._hierarchies.items():
+                if key[:3] == self._account:
+                    existing.discard(name)
+                    subscribed.discard(name)
+
     @property
     def imap4(self) -> object:
         """Get the imaplib.IMAP4 (or imaplib.IMAP4_SSL) object instance"""
         return self._connection
 
+    def _hierarchy(self, root: str) -> Tuple[Set[str], Set[str]]:
+        """Get the folders existing and the folders subscribed below a root folder.
+
+        The folders are listed by a single LIST and LSUB the first time a root folder is
+        asked for and kept up to date by _create_mailbox and forget_mailbox later on. They
+        are kept per account, shared by all the connections of a pool and guarded by
+        _create_mailbox_lock.
+
+        :param root:    the root folder, e.g. 'Archive'
+        :return:        the names of the folders existing, the names of the folders subscribed
+        """
+        key = self._account + (root,)
+        if key not in self._hierarchies:
+            pattern = '"' + root + '*"'
+            res, mailbox_list = self._connection.list('""', pattern)
+            existing = {Mailbox(self, m.decode()).name for m in mailbox_list if res == 'OK' and m is not None}
+            res, mailbox_list = self._connection.lsub('""', pattern)
+            subscribed = {Mailbox(self, m.decode()).name for m in mailbox_list if res == 'OK' and m is not None}
+            self._hierarchies[key] = (existing, subscribed)
+        return self._hierarchies[key]
+
     def login(self, username, password):
         """
             Run user authentication against a mail server.
@@ -187,16 +432,34 @@ class Connection(object):
             sys.stderr.write(color.success('done.\n'))
             sys.stderr.write(color.success(f'User {username} logged in.\n'))
 
-    def mailboxes(self, root: str = 'INBOX'):
+        # servers may advertise more capabilities (e.g. MOVE) once the user is authenticated
+        res, caps = self._connection.capability()
+        if res == 'OK' and len(caps) > 0:
+            self._capabilities = caps[0].decode().split()
+            self._dump_capabilities()
+        self._compress()
+
+    def mailboxes(self, root: str = 'INBOX', status: Tuple[str, ...] = None):
         """Load all mailboxes from the server.
 
+        If status items are given and the server supports LIST-STATUS (RFC 5819) the status
+        of all the mailboxes is delivered along with the list in the very same round trip.
+        See Mailbox.status.
+
         :param root:    top root mailbox
+        :param status:  status items to get along with the list (e.g. ('MESSAGES', 'UNSEEN'))
         """
 
         if self._connection is None:
             raise RuntimeError('No connection to IMAP4 server.')
 
-        if root:
+        status_list = []
+        if status and 'LIST-STATUS' in self.capabilities:
+            status_items = ' '.join(status)
+            res, data = self._connection.xatom('LIST', root or '""', '*', f'RETURN (STATUS ({status_items}))')
+            _, mailbox_list = self._connection.response('LIST')
+            _, status_list = self._connection.response('STATUS')
+        elif root:
             res, mailbox_list = self._connection.list(root)
         else:
             res, mailbox_list = self._connection.list()
@@ -209,6 +472,12 @@ class Connection(object):
                 mb = Mailbox(self, m.decode())
                 mbs[mb.name] = mb
 
+        for s in status_list:
+            if isinstance(s, bytes):
+                name, items = parse_status(s)
+                if name in mbs:
+                    mbs[name]._status.update(items)
+
         return mbs
 
     @staticmethod
@@ -276,6 +545,49 @@ class Connection(object):
 
         return host, port, username, password
 
+    def _record(self) -> None:
+        """Record the commands and the bytes on the wire if asked for (see Config().stats and Config().trace).
+
+        The imaplib.IMAP4 object is hooked: each command sent, each line and literal received.
+        """
+        if Config().stats is None and Config().trace is None:
+            return
+        imap4 = self._connection
+        recorder = self._recorder = Recorder(self, Config().stats, Config().trace)
+        command, readline, read = imap4._command, imap4.readline, imap4.read
+
+        def _command(name, *args):
+            recorder.start(name, args)
+            tag = command(name, *args)
+            recorder.started(tag)
+            return tag
+
+        def _readline():
+            line = readline()
+            recorder.response(line)
+            return line
+
+        def _read(size):
+            data = read(size)
+            recorder.received(len(data))
+            return data
+
+        imap4._command, imap4.readline, imap4.read = _command, _readline, _read
+        self._record_send()
+
+    def _record_send(self) -> None:
+        """Count the bytes sent by the current send function of the imaplib.IMAP4 object (see _record)."""
+        if self._recorder is None:
+            return
+        imap4 = self._connection
+        recorder, send = self._recorder, imap4.send
+
+        def _send(data):
+            recorder.sent(len(data))
+            return send(data)
+
+        imap4.send = _send
+
     def _pick_auth_methods(self) -> List:
         """Picks the set of available AUTH methods of the server.
 
@@ -287,4 +599,159 @@ class Connection(object):
             if m is not None and len(m.groups()) == 1:
                 auth.append(m.groups()[0])
 
-        return auth
\ No newline at end of file
+        return auth
+
+    def pipeline(self, commands: List[Tuple[str, ...]]) -> List[Tuple[str, List]]:
+        """Run several UID commands with up to Config().pipeline_depth commands in flight.
+
+        The commands are sent without waiting for the completion of the commands sent before
+        (RFC 3501, section 5.5). Untagged FETCH responses are handed to the command whose
+        sequence set holds the UID of the response. Any other untagged data goes to the command
+        completed next, so do not pipeline commands whose responses cannot be told apart (like
+        two SEARCH commands).
+
+        If a command fails with BAD, the commands still in flight are waited for before the
+        error is raised, so the connection is ready for the next command. If the connection
+        is lost, it is closed: the responses of the commands in flight cannot be told anymore.
+
+        Example:
+
+        >>> con.pipeline([('FETCH', '1:1000', '(FLAGS)'), ('STORE', '1001:2000', '+FLAGS', '(\\Seen)')])
+        [('OK', [b'1 (UID 1 FLAGS (\\Seen))', ...]), ('OK', [b'1001 (UID 1001 FLAGS (\\Seen))', ...])]
+
+        :param commands:    the commands as (command, sequence set, further arguments...)
+        :return:            return code and data per command, just like imaplib.IMAP4.uid()
+        """
+        if self._connection is None:
+            raise RuntimeError('No connection to IMAP4 server.')
+
+        depth = max(Config().pipeline_depth, 1)
+        if depth == 1 or len(commands) < 2:
+            return [self._connection.uid(*c) for c in commands]
+
+        mail_ids = [IdSet.parse(c[1]) for c in commands]
+        data = [[] for c in commands]
+        results = [None] * len(commands)
+        in_flight = collections.deque()
+        for i, c in enumerate(commands):
+            if len(in_flight) == depth:
+                self._pipeline_complete(commands, mail_ids, data, results, in_flight)
+            in_flight.append((i, self._connection._command('UID', *c)))
+        while len(in_flight) > 0:
+            self._pipeline_complete(commands, mail_ids, data, results, in_flight)
+
+        return results
+
+    def _pipeline_abort(self) -> None:
+        """Close a connection lost amid pipelined commands, it cannot be used anymore."""
+        imap4, self._connection = self._connection, None
+        self.selected = None
+        try:
+            imap4.shutdown()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _pipeline_collect(untagged_responses: Dict[str, List], commands: List[Tuple[str, ...]],
+                          mail_ids: List[IdSet], data: List[List], results: List[Tuple[str, List]],
+                          window: List[int], res: str, tagged_data: List) -> None:
+        """Collect the responses of a pipelined command just completed.
+
+        :param untagged_responses:  the untagged responses received so far (by type)
+        :param commands:            all the pipelined commands
+        :param mail_ids:            the mail ids per command
+        :param data:                the untagged data collected so far per command
+        :param results:             return code and data per command
+        :param window:              index of the command completed, followed by the ones still in flight
+        :param res:                 return code of the command completed
+        :param tagged_data:         data of the tagged response of the command completed
+        """
+        i = window[0]
+        name = commands[i][0].upper()
+        if name not in ('SEARCH', 'SORT', 'THREAD'):
+            name = 'FETCH'
+        untagged_data = untagged_responses.pop(name, [])
+        if name != 'FETCH':
+            data[i].extend(untagged_data)
+        else:
+            for mail_id, mail_data in split_fetch(untagged_data):
+                owner = i
+                if mail_id is not None:
+                    owner = next((j for j in window if mail_id in mail_ids[j]), i)
+                data[owner].extend(mail_data)
+
+        if res == 'NO':
+            results[i] = (res, tagged_data)
+        else:
+            results[i] = (res, data[i] or [None])
+        data[i] = None
+
+    def _pipeline_complete(self, commands: List[Tuple[str, ...]], mail_ids: List[IdSet], data: List[List],
+                           results: List[Tuple[str, List]], in_flight: Deque[Tuple[int, bytes]]) -> None:
+        """Wait for the completion of the oldest pipelined command in flight and collect its responses.
+
+        :param commands:    all the pipelined commands
+        :param mail_ids:    the mail ids per command
+        :param data:        the untagged data collected so far per command
+        :param results:     return code and data per command
+        :param in_flight:   index and tag of the commands in flight, oldest first
+        """
+        i, tag = in_flight.popleft()
+        try:
+            res, tagged_data = self._connection._command_complete('UID', tag)
+        except (imaplib.IMAP4.abort, OSError):
+            self._pipeline_abort()
+            raise
+        except imaplib.IMAP4.error:
+            self._pipeline_drain(in_flight)
+            raise
+        self._pipeline_collect(self._connection.untagged_responses, commands, mail_ids, data, results,
+                               [i] + [j for j, t in in_flight], res, tagged_data)
+
+    def _pipeline_drain(self, in_flight: Deque[Tuple[int, bytes]]) -> None:
+        """Wait for the completion of all the pipelined commands in flight and drop their responses.
+
+        :param in_flight:   index and tag of the commands in flight, oldest first
+        """
+        while len(in_flight) > 0:
+            i, tag = in_flight.popleft()
+            try:
+                self._connection._command_complete('UID', tag)
+            except (imaplib.IMAP4.abort, OSError):
+                self._pipeline_abort()
+                raise
+            except imaplib.IMAP4.error:
+                pass
+        for name in ('FETCH', 'SEARCH', 'SORT', 'THREAD'):
+            self._connection.untagged_responses.pop(name, None)
+
+    def status(self, mbs: Iterable[Mailbox], items: Tuple[str, ...]) -> None:
+        """Get status items of many mailboxes at once.
+
+        The STATUS commands are pipelined (see Config().pipeline_depth), as each STATUS response
+        names its mailbox. Status items already known (e.g. delivered by LIST-STATUS, see
+        mailboxes) are not asked for again. Mailboxes the server denies a status for (e.g.
+        \\Noselect ones) are left as they are.
+
+        :param mbs:     the mailboxes
+        :param items:   the status data items (e.g. ('MESSAGES', 'UIDNEXT'))
+        """
+        if self._connection is None:
+            raise RuntimeError('No connection to IMAP4 server.')
+
+        mbs = {mb.name: mb for mb in mbs if not all(i in mb._status for i in items)}
+        status_items = '(' + ' '.join(items) + ')'
+        depth = max(Config().pipeline_depth, 1)
+        in_flight = collections.deque()
+        for mb in mbs.values():
+            if len(in_flight) == depth:
+                self._connection._command_complete('STATUS', in_flight.popleft())
+            in_flight.append(self._connection._command('STATUS', mb.path, status_items))
+        while len(in_flight) > 0:
+            self._connection._command_complete('STATUS', in_flight.popleft())
+
+        for s in self._connection.untagged_responses.pop('STATUS', []):
+            if isinstance(s, bytes):
+                name, status = parse_status(s)
+                if name in mbs:
+                    mbs[name]._status.update(status)
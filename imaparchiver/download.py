@@ -0,0 +1,451 @@
+# ------------------------------------------------------------
+# imaparchiver/download.py
+#
+# write downloaded mails to the local disk
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module writes the mails downloaded to the local disk.
+
+Mails are fetched in batches with a single FETCH command per batch, sized by a Batcher to
+the bytes and the time a command should take (see the batch module). The body of each mail is
+streamed to a temporary file in the target folder while it is received, and renamed once the
+mail is complete. So neither a whole mail nor a whole batch is ever held in memory and there
+are no partially written mail files.
+
+Mails are written in one of these formats (see Config().download_format):
+
+    - files:    a file per mail in the folder of its mailbox, named after the date of the mail
+    - objects:  content-addressed, each body stored once under its SHA-256 and a manifest per
+                mailbox listing its mails (see ObjectStore)
+    - maildir:  a Maildir per mailbox (see the archive module)
+    - mbox:     mbox files per mailbox or per mailbox and year, with an offset index (ditto)
+    - tar:      tar files per mailbox or per mailbox and year, with an offset index (ditto)
+
+The download state of each mailbox is kept in its folder, so later downloads fetch the mails
+not downloaded yet only.
+"""
+
+import filecmp
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from typing import BinaryIO, List, Optional, Tuple, Union
+
+from .archive import ContainerStore, MaildirStore
+from .config import Config
+from .fetch import parse_fetch
+from .idset import IdSet
+from .mailbox import dates_from_fetch
+
+
+# name of the file holding the download state inside each mailbox folder
+STATE_FILE = '.imap-archiver-state.json'
+
+# name of the manifest file inside each mailbox folder (objects format)
+MANIFEST_FILE = '.imap-archiver-manifest.jsonl'
+
+# name of the folder inside the target folder holding the mail bodies (objects format)
+OBJECTS_FOLDER = '.objects'
+
+_PATTERN_BODY = re.compile(rb'BODY\[\]( <\d+>)? \{\d+\}$')
+
+
+class DownloadState(object):
+
+    """The download state of a single mailbox kept in the local folder of the mailbox.
+
+    The state consists of the UIDVALIDITY of the mailbox and the highest UID downloaded so far.
+    Mails up to this UID are not downloaded again. The state is written as soon as a mail and
+    all the mails with lower UIDs are on disk, so an interrupted download resumes right after
+    the last mail written. Mails the server sends no FETCH response for, e.g. as they have been
+    expunged by another client meanwhile, are skipped once their FETCH batch is done.
+
+    If the UIDVALIDITY of the mailbox has changed, the UIDs known are meaningless and the whole
+    mailbox is downloaded again.
+    """
+
+    def __init__(self, folder: str, uid_validity: Optional[int], full: bool = False):
+        """Constructor.
+
+        :param folder:          the local folder of the mailbox
+        :param uid_validity:    the current UIDVALIDITY of the mailbox (None if unknown)
+        :param full:            ignore any state recorded and download all mails
+        """
+        self._folder = folder
+        self._uid_validity = uid_validity
+        self._pending = iter(())
+        self._next = None           # type: Optional[int]
+        self._done = set()
+        self._fetched = set()
+
+        state = {} if full or uid_validity is None else self._load()
+        self.resync = bool(state) and state.get('uidvalidity') != uid_validity
+        self.uid = 0 if self.resync else int(state.get('uid', 0))
+
+    def commit(self, mail_id: int) -> None:
+        """Note a mail as written to disk.
+
+        :param mail_id:     the mail id (UID)
+        """
+        self._done.add(mail_id)
+        self._advance()
+
+    def _advance(self) -> None:
+        """Move the highest UID downloaded past the mails done and write the state if it moved."""
+        if self._next not in self._done:
+            return
+        while self._next in self._done:
+            self._done.discard(self._next)
+            self.uid = self._next
+            self._next = next(self._pending, None)
+        self._save()
+
+    def fetched(self, mail_id: int) -> None:
+        """Note a mail the server sent a FETCH response for (see batch_fetched).
+
+        :param mail_id:     the mail id (UID)
+        """
+        self._fetched.add(mail_id)
+
+    def batch_fetched(self, mail_ids: IdSet) -> None:
+        """Skip the mails of a FETCH batch just done the server sent no response for.
+
+        These mails are gone (e.g. expunged by another client since the SEARCH) and must not
+        hold back the highest UID downloaded.
+
+        :param mail_ids:    the mail ids (UIDs) of the batch
+        """
+        for mail_id in mail_ids:
+            if mail_id in self._fetched:
+                self._fetched.discard(mail_id)
+            else:
+                self._done.add(mail_id)
+        self._advance()
+
+    def _load(self) -> dict:
+        """Read the state recorded in the folder.
+
+        :return:    the state recorded (empty if there is none)
+        """
+        try:
+            with open(os.path.join(self._folder, STATE_FILE)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def new_mails(self, mail_ids: IdSet) -> IdSet:
+        """Get the mails not downloaded yet.
+
+        These mails are expected to be committed in turn.
+
+        :param mail_ids:    the mail ids (UIDs) of the mailbox
+        :return:            the mail ids not downloaded yet
+        """
+        if self.uid > 0:
+            mail_ids = mail_ids - IdSet.parse(f'1:{self.uid}')
+        self._pending = iter(mail_ids)
+        self._next = next(self._pending, None)
+        self._done = set()
+        self._fetched = set()
+        return mail_ids
+
+    def _save(self) -> None:
+        """Write the state to the folder."""
+        if self._uid_validity is None:
+            return
+        os.makedirs(self._folder, exist_ok=True)
+        path = os.path.join(self._folder, STATE_FILE)
+        part = os.path.join(self._folder, f'.{uuid.uuid4().hex}.part')
+        with open(part, 'w') as f:
+            json.dump({'uidvalidity': self._uid_validity, 'uid': self.uid}, f)
+        os.replace(part, path)
+
+    def search_criteria(self) -> Tuple[str, ...]:
+        """The criteria to SEARCH the mails not downloaded yet.
+
+        :return:    the search criteria, e.g. ('UID', '1234:*')
+        """
+        if self.uid == 0:
+            return ('ALL',)
+        return ('UID', f'{self.uid + 1}:*')
+
+
+class FileStore(object):
+
+    """Writes each mail to a file of its own in the folder of its mailbox (the files format).
+
+    The mail file is named after the date of the mail, e.g. '1561975200.0.mail'. Mails of the
+    same second get a counter appended, e.g. '1561975200.0-1.mail', unless they are the very
+    same mail: a mail found on disk already is not written again.
+    """
+
+    def __init__(self, mail_folder: str):
+        """Constructor.
+
+        :param mail_folder:     the folder the mails are written to
+        """
+        self._folder = mail_folder
+        self._stored = []           # type: List[int]
+
+    def close(self) -> List[int]:
+        """Done with the mailbox.
+
+        :return:    the mail ids (UIDs) stored since asked last
+        """
+        return self.stored()
+
+    def literal_file(self, prefix: bytes) -> Optional[BinaryIO]:
+        """Get a temporary file to stream a mail body to (the literal_file for Mailbox.fetch_stream).
+
+        :param prefix:  the response part in front of the literal
+        :return:        the file for a body, None for any other literal
+        """
+        if _PATTERN_BODY.search(prefix) is None:
+            return None
+        os.makedirs(self._folder, exist_ok=True)
+        return open(os.path.join(self._folder, f'.{uuid.uuid4().hex}.part'), 'xb')
+
+    def save(self, mail_data: list) -> Tuple[Optional[int], Optional[str], bool]:
+        """Move a mail just streamed to a temporary file to its final name.
+
+        If the mail cannot be dated, the temporary file is removed.
+
+        :param mail_data:   the data of the mail as handed over by Mailbox.fetch_stream
+        :return:            mail id, path of the mail file (None if the mail could not be dated),
+                            whether the mail file was written (False: on disk already)
+        """
+        body = _body(mail_data)
+        mail_id = next((mail.uid for mail in parse_fetch(mail_data)), None)
+        t = dates_from_fetch(mail_data).get(mail_id)
+        if body is None:
+            return mail_id, None, False
+        if t is None:
+            os.remove(body.name)
+            return mail_id, None, False
+
+        base = os.path.join(self._folder, str(time.mktime(t)))
+        path = base + '.mail'
+        n = 0
+        while os.path.exists(path):
+            if filecmp.cmp(body.name, path, shallow=False):
+                os.remove(body.name)
+                self._stored.append(mail_id)
+                return mail_id, path, False
+            n += 1
+            path = f'{base}-{n}.mail'
+        os.replace(body.name, path)
+        self._stored.append(mail_id)
+        return mail_id, path, True
+
+    def stored(self) -> List[int]:
+        """Get the mails written since asked last.
+
+        :return:    the mail ids (UIDs)
+        """
+        stored, self._stored = self._stored, []
+        return stored
+
+
+class ObjectStore(object):
+
+    """Stores mail bodies content-addressed, each body once only (the objects format).
+
+    The bodies of all mailboxes go to OBJECTS_FOLDER in the target folder, named after their
+    SHA-256, e.g. '.objects/3f/3fa2...e1'. The SHA-256 is computed while a body is streamed
+    in. A body stored already, because the mail is present in several mailboxes (cross-posted
+    or copied by the move command) or downloaded again (--full, UIDVALIDITY changed), is not
+    written again.
+
+    The manifest in the folder of each mailbox maps its mails to the bodies, one JSON line
+    per mail, e.g.:
+
+        {"uidvalidity": 1561975200, "uid": 17, "message_id": "<1234@example.com>",
+         "date": 1561975200.0, "size": 2317, "sha256": "3fa2...e1"}
+
+    The manifest is appended to only and a mail listed already is not listed again.
+    """
+
+    def __init__(self, folder: str, mail_folder: str, uid_validity: Optional[int]):
+        """Constructor.
+
+        :param folder:          the target folder holding the bodies of all mailboxes
+        :param mail_folder:     the folder of the mailbox holding the manifest
+        :param uid_validity:    the current UIDVALIDITY of the mailbox (None if unknown)
+        """
+        self._objects = os.path.join(folder, OBJECTS_FOLDER)
+        self._folder = mail_folder
+        self._uid_validity = uid_validity
+        self._manifest = None
+        self._listed = set()
+        self._stored = []           # type: List[int]
+        try:
+            with open(os.path.join(mail_folder, MANIFEST_FILE)) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._listed.add((entry['uidvalidity'], entry['uid'], entry['sha256']))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except OSError:
+            pass
+
+    def close(self) -> List[int]:
+        """Done with the mailbox: close the manifest.
+
+        :return:    the mail ids (UIDs) stored since asked last
+        """
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+        return self.stored()
+
+    def literal_file(self, prefix: bytes) -> Optional[BinaryIO]:
+        """Get a temporary file to stream a mail body to (the literal_file for Mailbox.fetch_stream).
+
+        :param prefix:  the response part in front of the literal
+        :return:        the file for a body, None for any other literal
+        """
+        if _PATTERN_BODY.search(prefix) is None:
+            return None
+        os.makedirs(self._objects, exist_ok=True)
+        return _HashingFile(open(os.path.join(self._objects, f'.{uuid.uuid4().hex}.part'), 'xb'))
+
+    def save(self, mail_data: list) -> Tuple[Optional[int], Optional[str], bool]:
+        """Store the body of a mail just streamed to a temporary file and list it in the manifest.
+
+        :param mail_data:   the data of the mail as handed over by Mailbox.fetch_stream
+        :return:            mail id, path of the body (None if there is no body),
+                            whether the body was written (False: stored already)
+        """
+        body = _body(mail_data)
+        mail = next(parse_fetch(mail_data), None)
+        mail_id = None if mail is None else mail.uid
+        if body is None or mail_id is None:
+            if body is not None:
+                os.remove(body.name)
+            return mail_id, None, False
+
+        digest = body.sha256.hexdigest()
+        path = os.path.join(self._objects, digest[:2], digest)
+        written = not os.path.exists(path)
+        if written:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(body.name, path)
+        else:
+            os.remove(body.name)
+
+        if (self._uid_validity, mail_id, digest) not in self._listed:
+            t = dates_from_fetch(mail_data).get(mail_id)
+            if self._manifest is None:
+                os.makedirs(self._folder, exist_ok=True)
+                self._manifest = open(os.path.join(self._folder, MANIFEST_FILE), 'a')
+            self._manifest.write(json.dumps({'uidvalidity': self._uid_validity, 'uid': mail_id,
+                                             'message_id': mail.message_id,
+                                             'date': None if t is None else time.mktime(t),
+                                             'size': body.size, 'sha256': digest}) + '\n')
+            self._manifest.flush()
+            self._listed.add((self._uid_validity, mail_id, digest))
+        self._stored.append(mail_id)
+        return mail_id, path, written
+
+    def stored(self) -> List[int]:
+        """Get the mails written since asked last.
+
+        :return:    the mail ids (UIDs)
+        """
+        stored, self._stored = self._stored, []
+        return stored
+
+
+class _HashingFile(object):
+
+    """A file computing the SHA-256 of the data written to it."""
+
+    def __init__(self, f: BinaryIO):
+        """Constructor.
+
+        :param f:   the file to write to
+        """
+        self._file = f
+        self.name = f.name
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def close(self) -> None:
+        """Close the file."""
+        self._file.close()
+
+    def write(self, data: bytes) -> int:
+        """Write to the file.
+
+        :param data:    the data to write
+        :return:        the number of bytes written
+        """
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+
+def _body(mail_data: list) -> Optional[BinaryIO]:
+    """Get the file a mail body was streamed to and close it.
+
+    :param mail_data:   the data of the mail as handed over by Mailbox.fetch_stream
+    :return:            the file of the body (None if there is none)
+    """
+    body = None
+    for d in mail_data:
+        if isinstance(d, tuple) and not isinstance(d[1], bytes):
+            body = d[1]
+            body.close()
+    return body
+
+
+def download_parts() -> str:
+    """The message parts to fetch for downloading mails.
+
+    BODY.PEEK leaves the \\Seen flag of the mails untouched. The Date header field is fetched
+    along unless the mails are dated by their INTERNALDATE only, the Message-ID header field
+    for the manifests and indexes of the objects, mbox and tar formats and the flags for the
+    maildir format.
+
+    :return:    the message parts
+    """
+    items = 'UID FLAGS INTERNALDATE' if Config().download_format == 'maildir' else 'UID INTERNALDATE'
+    fields = [] if Config().date_source == 'internaldate' else ['DATE']
+    if Config().download_format in ('mbox', 'objects', 'tar'):
+        fields.append('MESSAGE-ID')
+    if len(fields) == 0:
+        return f'({items} BODY.PEEK[])'
+    return f'({items} BODY.PEEK[HEADER.FIELDS ({" ".join(fields)})] BODY.PEEK[])'
+
+
+def mail_store(folder: str, mail_folder: str,
+               uid_validity: Optional[int]) -> Union[ContainerStore, FileStore, MaildirStore, ObjectStore]:
+    """Get the store writing the mails of a mailbox in the format asked for (Config().download_format).
+
+    Every store hands out the files to stream the mail bodies to (literal_file) and takes
+    each mail once received (save). The mails stored for good (stored, close) may lag behind
+    the mails taken, as containers are written frame by frame.
+
+    :param folder:          the target folder
+    :param mail_folder:     the folder of the mailbox
+    :param uid_validity:    the current UIDVALIDITY of the mailbox (None if unknown)
+    :return:                the store
+    """
+    download_format = Config().download_format
+    if download_format == 'objects':
+        return ObjectStore(folder, mail_folder, uid_validity)
+    if download_format == 'maildir':
+        return MaildirStore(mail_folder, uid_validity, Config().download_compression)
+    if download_format in ('mbox', 'tar'):
+        return ContainerStore(mail_folder, uid_validity, download_format, Config().download_compression,
+                              Config().download_per_year)
+    return FileStore(mail_folder)
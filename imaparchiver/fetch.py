@@ -0,0 +1,253 @@
+# ------------------------------------------------------------
+# imaparchiver/fetch.py
+#
+# parse the responses to FETCH commands
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module parses the responses to FETCH commands.
+
+imaplib hands over the response to a FETCH as a list of bytes and (prefix, literal) tuples.
+The parser walks this list once and picks the data items of interest out of the response
+prefixes and header literals by plain bytes searches: nothing is decoded to str and no
+header is split into lines. Mail dates are parsed when asked for only, by a fast path for
+well-formed RFC 5322 dates with the day cached, so email.utils.parsedate
+is left with the odd ones.
+"""
+
+import email.utils
+import functools
+from typing import Iterator, Optional, Tuple
+
+
+# number of days kept by the date cache
+DATE_CACHE_SIZE = 65536
+
+_MONTHS = {b'jan': 1, b'feb': 2, b'mar': 3, b'apr': 4, b'may': 5, b'jun': 6,
+           b'jul': 7, b'aug': 8, b'sep': 9, b'oct': 10, b'nov': 11, b'dec': 12}
+
+
+class FetchedMail(object):
+
+    """The data items of a single mail found in the response to a FETCH.
+
+    Apart from the UID, the data items are picked out of the response when asked for only.
+    Data items not asked for by the FETCH (or not understood) are None.
+    """
+
+    __slots__ = ('uid', '_items', '_header')
+
+    def __init__(self):
+        """Constructor."""
+        self.uid = None                 # type: Optional[int]
+        self._items = b''               # type: bytes
+        self._header = None             # type: Optional[bytes]
+
+    def _add(self, items: bytes, literal: Optional[object]) -> None:
+        """Add a response prefix (or a remainder after a literal) and its literal.
+
+        :param items:       the response prefix, e.g. b'1 (UID 17 RFC822.SIZE 1234 BODY[HEADER] {1234}'
+        :param literal:     the literal following the response prefix (if any)
+        """
+        self._items += items
+        if self.uid is None:
+            i = items.find(b'UID ')
+            if i > 0 and items[i - 1] in b'( ':
+                self.uid = _number(items, i + 4)
+        if isinstance(literal, bytes) and b'HEADER' in items[items.rfind(b'BODY['):]:
+            self._header = literal
+
+    @property
+    def flags(self) -> Optional[str]:
+        """The flags, separated by spaces."""
+        i = self._items.find(b'FLAGS (')
+        return None if i < 0 else self._items[i + 7:self._items.find(b')', i + 7)].decode()
+
+    @property
+    def header_date(self) -> Optional[tuple]:
+        """The date of the Date header field (as returned by email.utils.parsedate)."""
+        date = _header_field(self._header, b'date:')
+        return None if date is None else parse_date(date)
+
+    @property
+    def internal_date(self) -> Optional[tuple]:
+        """The INTERNALDATE (like email.utils.parsedate would return it)."""
+        i = self._items.find(b'INTERNALDATE "')
+        return None if i < 0 else parse_internal_date(self._items[i + 14:self._items.find(b'"', i + 14)])
+
+    @property
+    def message_id(self) -> Optional[str]:
+        """The Message-ID header field."""
+        message_id = _header_field(self._header, b'message-id:')
+        return None if message_id is None else message_id.replace(b'\r\n', b'').decode('ascii', 'replace')
+
+    @property
+    def size(self) -> Optional[int]:
+        """The RFC822.SIZE."""
+        i = self._items.find(b'RFC822.SIZE ')
+        return None if i < 0 else _number(self._items, i + 12)
+
+
+def _header_field(header: Optional[bytes], name: bytes) -> Optional[bytes]:
+    """Find a field in a header.
+
+    :param header:  the header
+    :param name:    the name of the field in lower case, with the colon, e.g. b'date:'
+    :return:        the value of the field, still folded (None if the field is missing)
+    """
+    if header is None:
+        return None
+    lower = header.lower()
+    if lower.startswith(name):
+        start = len(name)
+    else:
+        start = lower.find(b'\n' + name)
+        if start < 0:
+            return None
+        start += len(name) + 1
+    end = header.find(b'\n', start)
+    while end >= 0 and header[end + 1:end + 2] in (b' ', b'\t'):
+        end = header.find(b'\n', end + 1)
+    return header[start:end if end >= 0 else len(header)].strip()
+
+
+def _number(data: bytes, i: int) -> Optional[int]:
+    """Read a number.
+
+    :param data:    the data holding the number
+    :param i:       the index the number starts at
+    :return:        the number (None if there is none)
+    """
+    number = data[i:i + 20].split(None, 1)
+    number = number[0].rstrip(b')') if number else b''
+    return int(number) if number.isdigit() else None
+
+
+def parse_date(date: bytes) -> Optional[tuple]:
+    """Parse the value of a Date header field.
+
+    Dates like 'Mon, 1 Jul 2019 12:00:00 +0200' are parsed right here, anything else is handed
+    over to email.utils.parsedate. Either way the result is the very same.
+
+    :param date:    the value of the Date header field (maybe folded)
+    :return:        the date (as returned by email.utils.parsedate) or None
+    """
+    parts = date.split()
+    if len(parts) > 4 and parts[0][-1:] == b',':
+        del parts[0]
+    if len(parts) >= 4:
+        day = _parse_day(parts[0], parts[1], parts[2])
+        time_of_day = parts[3].split(b':')
+        if day is not None and 2 <= len(time_of_day) <= 3:
+            try:
+                return day + (int(time_of_day[0]), int(time_of_day[1]),
+                              int(time_of_day[2]) if len(time_of_day) == 3 else 0, 0, 1, -1)
+            except ValueError:
+                pass
+    try:
+        return email.utils.parsedate(date.replace(b'\r\n', b'').replace(b'\n', b'').decode('ascii', 'replace'))
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_day(day: bytes, month: bytes, year: bytes) -> Optional[Tuple[int, int, int]]:
+    """Parse the day of a date.
+
+    :param day:     the day of the month, e.g. b'1'
+    :param month:   the month, e.g. b'Jul'
+    :param year:    the year, e.g. b'2019'
+    :return:        year, month, day of the month (None if not of the usual form)
+    """
+    month = _MONTHS.get(month.lower())
+    if month is None or not year[:1].isdigit():
+        return None
+    try:
+        day, year = int(day), int(year)
+    except ValueError:
+        return None
+    return (year, month, day) if year >= 100 else None
+
+
+def parse_fetch(fetch_data: list) -> Iterator[FetchedMail]:
+    """Parse the response to a FETCH.
+
+    Literals are parsed if they are header fields (BODY[HEADER...]) held in memory only. The
+    mail is identified by its UID, not by its sequence number.
+
+    :param fetch_data:  the data returned by imaplib for the FETCH command
+    :return:            an iterator over the mails
+    """
+    mail = None
+    for d in fetch_data:
+
+        literal = None
+        if isinstance(d, tuple):
+            d, literal = d
+        elif d == b')':
+            continue
+        if not isinstance(d, bytes):
+            continue
+        if d[:1].isdigit():
+            if mail is not None:
+                yield mail
+            mail = FetchedMail()
+        elif mail is None:
+            continue
+        mail._add(d, literal)
+
+    if mail is not None:
+        yield mail
+
+
+def parse_internal_date(internal_date: bytes) -> Optional[tuple]:
+    """Parse an INTERNALDATE.
+
+    :param internal_date:   the INTERNALDATE, e.g. b'01-Jul-2019 12:00:00 +0200' (day maybe padded by space)
+    :return:                the date (like email.utils.parsedate would return it) or None
+    """
+    if internal_date[1:2] == b'-':
+        internal_date = b' ' + internal_date
+    month = _MONTHS.get(internal_date[3:6].lower())
+    if len(internal_date) < 20 or month is None:
+        return None
+    try:
+        return (int(internal_date[7:11]), month, int(internal_date[0:2]),
+                int(internal_date[12:14]), int(internal_date[15:17]), int(internal_date[18:20]), 0, 1, -1)
+    except ValueError:
+        return None
+
+
+def split_fetch(fetch_data: list) -> Iterator[Tuple[Optional[int], list]]:
+    """Split the response of a FETCH into the responses for each single mail.
+
+    imaplib hands over a mail either as plain bytes (no literal, e.g. only INTERNALDATE asked
+    for) or as a tuple of (response prefix, literal) followed by the remainder of the response.
+    The mail is identified by the UID found in the response, not by its sequence number.
+
+    :param fetch_data:  the data returned by imaplib for the FETCH command
+    :return:            an iterator over mail UID (None if not present), the data items of the mail
+    """
+    mail_id = None
+    mail_data = []
+    for d in fetch_data:
+
+        prefix = d[0] if isinstance(d, tuple) else d
+        if not isinstance(prefix, bytes):
+            continue
+        if prefix[:1].isdigit():
+            if len(mail_data) > 0:
+                yield mail_id, mail_data
+            mail_id = None
+            mail_data = []
+
+        i = prefix.find(b'UID ')
+        if i > 0 and prefix[i - 1] in b'( ':
+            mail_id = _number(prefix, i + 4)
+        mail_data.append(d)
+
+    if len(mail_data) > 0:
+        yield mail_id, mail_data
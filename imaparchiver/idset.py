@@ -0,0 +1,274 @@
+# ------------------------------------------------------------
+# imaparchiver/idset.py
+#
+# a set of mail ids
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module contains the IdSet, a compact set of mail ids."""
+
+import array
+import bisect
+from typing import Callable, Iterable, Iterator, List, Tuple, Union
+
+
+# SEARCH responses are parsed in slices of about this size
+_PARSE_SLICE = 65536
+
+
+class IdSet(object):
+
+    """A set of mail ids (UIDs) kept as sorted ranges.
+
+    The ranges are stored in two arrays of unsigned 32 bit integers (which is what UIDs
+    are). Hence a mailbox with millions of mails takes a few bytes per range of consecutive
+    mail ids rather than a Python object per mail id.
+
+    Rendered as string this is an IMAP4 sequence set like '1:500,502,510:900'.
+
+    Example:
+
+    >>> s = IdSet(['3', '1', '2', '7'])
+    >>> str(s)
+    '1:3,7'
+    >>> list(s.split(3))
+    ['1:3', '7']
+    >>> str(s - IdSet([2]))
+    '1,3,7'
+    """
+
+    def __init__(self, ids: Iterable[Union[int, str, bytes]] = None):
+        """Constructor.
+
+        :param ids:     the mail ids (or another IdSet)
+        """
+        self._first = array.array('I')
+        self._last = array.array('I')
+        self._count = 0
+        if ids is None:
+            return
+        if isinstance(ids, IdSet):
+            self._first = array.array('I', ids._first)
+            self._last = array.array('I', ids._last)
+            self._count = ids._count
+            return
+
+        for i in sorted(set(int(i) for i in ids)):
+            self._append(i, i)
+
+    def __and__(self, other: 'IdSet') -> 'IdSet':
+        ids = IdSet()
+        i, j = 0, 0
+        while i < len(self._first) and j < len(other._first):
+            first = max(self._first[i], other._first[j])
+            last = min(self._last[i], other._last[j])
+            if first <= last:
+                ids._append(first, last)
+            if self._last[i] < other._last[j]:
+                i += 1
+            else:
+                j += 1
+        return ids
+
+    def __bool__(self) -> bool:
+        return self._count > 0
+
+    def __contains__(self, i: Union[int, str, bytes]) -> bool:
+        i = int(i)
+        k = bisect.bisect_right(self._first, i) - 1
+        return k >= 0 and i <= self._last[k]
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, IdSet):
+            return NotImplemented
+        return self._first == other._first and self._last == other._last
+
+    __hash__ = None
+
+    def __iter__(self) -> Iterator[int]:
+        for first, last in zip(self._first, self._last):
+            yield from range(first, last + 1)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __or__(self, other: 'IdSet') -> 'IdSet':
+        ids = IdSet()
+        i, j = 0, 0
+        while i < len(self._first) or j < len(other._first):
+            if j == len(other._first) or i < len(self._first) and self._first[i] <= other._first[j]:
+                ids._append(self._first[i], self._last[i])
+                i += 1
+            else:
+                ids._append(other._first[j], other._last[j])
+                j += 1
+        return ids
+
+    def __repr__(self) -> str:
+        return f'IdSet({str(self)!r})'
+
+    def __str__(self) -> str:
+        return ','.join(self._render(first, last) for first, last in zip(self._first, self._last))
+
+    def __sub__(self, other: 'IdSet') -> 'IdSet':
+        ids = IdSet()
+        j = 0
+        for first, last in zip(self._first, self._last):
+            while j < len(other._first) and other._last[j] < first:
+                j += 1
+            k = j
+            while first <= last and k < len(other._first) and other._first[k] <= last:
+                if other._first[k] > first:
+                    ids._append(first, other._first[k] - 1)
+                first = max(first, other._last[k] + 1)
+                k += 1
+            if first <= last:
+                ids._append(first, last)
+        return ids
+
+    def _append(self, first: int, last: int) -> None:
+        """Append a range of ids not below any id present.
+
+        :param first:   first id of the range
+        :param last:    last id of the range
+        """
+        if len(self._last) > 0 and self._last[-1] + 1 >= first:
+            if last > self._last[-1]:
+                self._count += last - self._last[-1]
+                self._last[-1] = last
+            return
+        self._first.append(first)
+        self._last.append(last)
+        self._count += last - first + 1
+
+    def batches(self, size: Union[int, Callable[[], int]]) -> Iterator['IdSet']:
+        """Split the set into several ones, each holding at most size ids.
+
+        The size may be a function, which is asked for the size of each batch anew when the
+        batch is started (see batch.Batcher).
+
+        :param size:    maximum number of ids per batch (or a function giving it)
+        :return:        an iterator over the batches
+        """
+        batch_size = size if callable(size) else lambda: size
+        batch = IdSet()
+        n_max = max(batch_size(), 1)
+        for first, last in zip(self._first, self._last):
+            while first <= last:
+                n = min(last - first + 1, n_max - batch._count)
+                batch._append(first, first + n - 1)
+                first += n
+                if batch._count == n_max:
+                    yield batch
+                    batch = IdSet()
+                    n_max = max(batch_size(), 1)
+        if batch:
+            yield batch
+
+    @staticmethod
+    def parse(sequence_set: Union[str, bytes]) -> 'IdSet':
+        """Create an IdSet from an IMAP4 sequence set (or a SEARCH response).
+
+        Both '1:3,7' and '1 2 3 7' are understood. '*' is not.
+
+        The sequence set is processed in slices, so the (potentially huge) response
+        of a SEARCH is never split into a list of all its ids at once.
+
+        :param sequence_set:    the sequence set
+        :return:                the IdSet holding the ids given
+        """
+        if isinstance(sequence_set, str):
+            sequence_set = sequence_set.encode()
+        sequence_set = sequence_set.replace(b',', b' ')
+
+        ids = IdSet()
+        unordered = []
+        run_first, run_last = None, None
+        start = 0
+        while start < len(sequence_set):
+
+            end = sequence_set.find(b' ', start + _PARSE_SLICE)
+            if end == -1:
+                end = len(sequence_set)
+            sequence_slice = sequence_set[start:end]
+            start = end + 1
+
+            if b':' in sequence_slice:
+                parts = (IdSet._parse_range(part) for part in sequence_slice.split())
+            else:
+                parts = ((i, i) for i in map(int, sequence_slice.split()))
+
+            # collect runs of consecutive ids first, this is way faster than _append on each id
+            for first, last in parts:
+                if run_last is not None and run_last + 1 == first:
+                    run_last = last
+                elif run_last is not None and first <= run_last:
+                    unordered.append((first, last))
+                else:
+                    if run_first is not None:
+                        ids._append(run_first, run_last)
+                    run_first, run_last = first, last
+        if run_first is not None:
+            ids._append(run_first, run_last)
+
+        # servers are not obliged to sort SEARCH responses
+        if len(unordered) > 0:
+            ranges = sorted(ids.ranges + unordered)
+            ids = IdSet()
+            for first, last in ranges:
+                ids._append(first, last)
+        return ids
+
+    @staticmethod
+    def _parse_range(part: bytes) -> Tuple[int, int]:
+        """Parse a single id range of an IMAP4 sequence set.
+
+        :param part:    the range, e.g. b'3:7' or b'4'
+        :return:        first id, last id
+        """
+        if b':' not in part:
+            return int(part), int(part)
+        first, last = part.split(b':')
+        return min(int(first), int(last)), max(int(first), int(last))
+
+    @property
+    def ranges(self) -> List[Tuple[int, int]]:
+        """The sorted list of the (first, last) id ranges."""
+        return list(zip(self._first, self._last))
+
+    @staticmethod
+    def _render(first: int, last: int) -> str:
+        """Render a single id range.
+
+        :param first:   first id of the range
+        :param last:    last id of the range
+        :return:        the range as part of an IMAP4 sequence set
+        """
+        if first == last:
+            return str(first)
+        return f'{first}:{last}'
+
+    def split(self, max_length: int) -> Iterator[str]:
+        """Render the set as several IMAP4 sequence sets, each not longer than max_length.
+
+        A single range is never split. So a sequence set may exceed max_length if a single
+        id range alone does.
+
+        :param max_length:  maximum length of each sequence set
+        :return:            an iterator over the sequence sets
+        """
+        parts = []
+        length = 0
+        for first, last in zip(self._first, self._last):
+            r = self._render(first, last)
+            if len(parts) > 0 and length + 1 + len(r) > max_length:
+                yield ','.join(parts)
+                parts = []
+                length = 0
+            length = length + len(r) + (1 if len(parts) > 0 else 0)
+            parts.append(r)
+        if len(parts) > 0:
+            yield ','.join(parts)
@@ -0,0 +1,358 @@
+# ------------------------------------------------------------
+# imaparchiver/index.py
+#
+# a local index of the mails on the server
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module contains the local index of the mails on the server.
+
+The index is a SQLite database holding the metadata of each mail (dates, size, flags and
+Message-ID) keyed by mailbox, UIDVALIDITY and UID. Once filled, an index is brought up to
+date by fetching the metadata of new mails and the flags of the others only. Mails are
+counted and sorted into years by SQL instead of asking the server for each mail again.
+"""
+
+import functools
+import sqlite3
+import threading
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Tuple
+
+from . import color
+from . import steps
+from .config import Config
+from .fetch import parse_fetch
+from .idset import IdSet
+from .units import format_size
+
+
+# the message parts fetched for a mail new to the index
+METADATA_PARTS = '(UID FLAGS RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (DATE MESSAGE-ID)])'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailboxes (
+    name TEXT PRIMARY KEY,
+    uidvalidity INTEGER,
+    uidnext INTEGER,
+    highestmodseq INTEGER
+);
+CREATE TABLE IF NOT EXISTS mails (
+    mailbox TEXT,
+    uidvalidity INTEGER,
+    uid INTEGER,
+    sent TEXT,
+    received TEXT,
+    size INTEGER,
+    flags TEXT,
+    message_id TEXT,
+    PRIMARY KEY (mailbox, uidvalidity, uid)
+);
+"""
+
+
+def flags_parts(modseq: Optional[int] = None) -> str:
+    """The message parts to FETCH to update the flags of the mails in the index.
+
+    :param modseq:  fetch the flags of the mails changed since this MODSEQ only (needs CONDSTORE)
+    :return:        the message parts, e.g. '(UID FLAGS) (CHANGEDSINCE 1234)'
+    """
+    if modseq:
+        return f'(UID FLAGS) (CHANGEDSINCE {modseq})'
+    return '(UID FLAGS)'
+
+
+def _format_date(t: Optional[tuple]) -> Optional[str]:
+    """Format a date as stored in the index.
+
+    :param t:   the date (as returned by email.utils.parsedate)
+    :return:    the date as 'YYYY-MM-DD HH:MM:SS' (None if not known)
+    """
+    if t is None:
+        return None
+    return '%04d-%02d-%02d %02d:%02d:%02d' % t[:6]
+
+
+def _parse_flags(fetch_data: list) -> Iterable[Tuple[int, str]]:
+    """Get the flags of mails out of the response to a FETCH.
+
+    :param fetch_data:  the data returned by imaplib for the FETCH command
+    :return:            an iterator over mail UID, flags (separated by spaces)
+    """
+    for mail in parse_fetch(fetch_data):
+        if mail.uid is not None and mail.flags is not None:
+            yield mail.uid, mail.flags
+
+
+def print_index_counts(index: 'Index', name: str, years: bool) -> None:
+    """Print the mail counts and sizes of a single mailbox by the index.
+
+    :param index:   the index
+    :param name:    the name of the mailbox
+    :param years:   print the number of seen mails and the size of all mails per year
+    """
+    count_all, count_seen, count_deleted, size = index.counts(name)
+    if Config().no_color:
+        print('%-70s       %5d        %5d           %5d   %10s' %
+              (color.mailbox(name), count_all, count_seen, count_deleted, format_size(size)))
+    else:
+        print('%-79s       %5d        %5d           %5d   %10s' %
+              (color.mailbox(name), count_all, count_seen, count_deleted, format_size(size)))
+    if years:
+        mails_per_year = index.inspect(name)[3]
+        sizes = index.sizes(name)
+        for y in sorted(set(mails_per_year) | set(sizes)):
+            print('%-70s                    %5d                   %10s' %
+                  (f'    {y}', len(mails_per_year.get(y, ())), format_size(sizes.get(y, 0))))
+
+
+def status_items(capabilities: Iterable[str]) -> Tuple[str, ...]:
+    """The status items of a mailbox the index is kept up to date with.
+
+    These are delivered by the server on selecting the mailbox.
+
+    :param capabilities:    the capabilities of the server
+    :return:                the status items
+    """
+    if 'CONDSTORE' in capabilities:
+        return 'UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'
+    return 'UIDVALIDITY', 'UIDNEXT'
+
+
+class Index(object):
+
+    """The local index of the mails of an account.
+
+    The index may be shared by several threads, each working on a mailbox of its own.
+    """
+
+    def __init__(self, path: str):
+        """Constructor.
+
+        :param path:    the SQLite database file
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+
+    def add(self, name: str, uid_validity: int, fetch_data: list) -> None:
+        """Add mails to the index.
+
+        :param name:            the name of the mailbox
+        :param uid_validity:    the UIDVALIDITY of the mailbox
+        :param fetch_data:      the response to a FETCH of METADATA_PARTS
+        """
+        mails = []
+        for mail in parse_fetch(fetch_data):
+            if mail.uid is not None:
+                mails.append((name, uid_validity, mail.uid, _format_date(mail.header_date),
+                              _format_date(mail.internal_date), mail.size, mail.flags or '', mail.message_id))
+
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO mails VALUES (?, ?, ?, ?, ?, ?, ?, ?)', mails)
+
+    def close(self) -> None:
+        """Close the index."""
+        with self._lock:
+            self._db.close()
+
+    def counts(self, name: str) -> (int, int, int, int):
+        """Count the mails of a mailbox.
+
+        :param name:    the name of the mailbox
+        :return:        number of all, seen and deleted mails, size of all mails (in bytes)
+        """
+        with self._lock:
+            return self._db.execute("""
+                SELECT COUNT(*), COUNT(NULLIF(instr(flags, '\\Seen'), 0)),
+                       COUNT(NULLIF(instr(flags, '\\Deleted'), 0)), COALESCE(SUM(size), 0)
+                FROM mails JOIN mailboxes ON mailbox = name AND mails.uidvalidity = mailboxes.uidvalidity
+                WHERE name = ?""", (name,)).fetchone()
+
+    def inspect(self, name: str) -> (IdSet, IdSet, IdSet, Dict[int, IdSet]):
+        """Inspect a mailbox like Mailbox.inspect does, but by the index.
+
+        :param name:    the name of the mailbox
+        :return:        all mail ids, seen mail ids, deleted mail ids, seen mails per year
+        """
+        with self._lock:
+            rows = self._db.execute(f"""
+                SELECT uid, instr(flags, '\\Seen'), instr(flags, '\\Deleted'), {self._year()}
+                FROM mails JOIN mailboxes ON mailbox = name AND mails.uidvalidity = mailboxes.uidvalidity
+                WHERE name = ?""", (name,)).fetchall()
+
+        mails_per_year = {}
+        for uid, seen, deleted, year in rows:
+            if seen and year is not None:
+                mails_per_year.setdefault(year, []).append(uid)
+        return (IdSet(r[0] for r in rows), IdSet(r[0] for r in rows if r[1]), IdSet(r[0] for r in rows if r[2]),
+                {y: IdSet(mails_per_year[y]) for y in mails_per_year})
+
+    def mails(self, name: str, uid_validity: int) -> IdSet:
+        """Get the mails of a mailbox in the index.
+
+        Mails of a former UIDVALIDITY of the mailbox are dropped.
+
+        :param name:            the name of the mailbox
+        :param uid_validity:    the current UIDVALIDITY of the mailbox
+        :return:                the mail ids (UIDs) in the index
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM mails WHERE mailbox = ? AND uidvalidity != ?', (name, uid_validity))
+            rows = self._db.execute('SELECT uid FROM mails WHERE mailbox = ? AND uidvalidity = ?',
+                                    (name, uid_validity)).fetchall()
+        return IdSet(r[0] for r in rows)
+
+    def record(self, name: str, status: Dict[str, int]) -> None:
+        """Record the status of a mailbox the index is up to date with.
+
+        :param name:    the name of the mailbox
+        :param status:  the status of the mailbox (UIDVALIDITY, UIDNEXT, HIGHESTMODSEQ)
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO mailboxes VALUES (?, ?, ?, ?)',
+                             (name, status.get('UIDVALIDITY'), status.get('UIDNEXT'), status.get('HIGHESTMODSEQ')))
+
+    def recorded(self, name: str) -> Dict[str, int]:
+        """Get the status of a mailbox the index is up to date with.
+
+        :param name:    the name of the mailbox
+        :return:        the status recorded (empty if there is none)
+        """
+        with self._lock:
+            row = self._db.execute('SELECT uidvalidity, uidnext, highestmodseq FROM mailboxes WHERE name = ?',
+                                   (name,)).fetchone()
+        if row is None:
+            return {}
+        return {k: v for k, v in zip(('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'), row) if v is not None}
+
+    def remove(self, name: str, uid_validity: int, mail_ids: IdSet) -> None:
+        """Remove mails from the index.
+
+        :param name:            the name of the mailbox
+        :param uid_validity:    the UIDVALIDITY of the mailbox
+        :param mail_ids:        the mail ids (UIDs) to remove
+        """
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM mails WHERE mailbox = ? AND uidvalidity = ? AND uid = ?',
+                                 ((name, uid_validity, i) for i in mail_ids))
+
+    def sizes(self, name: str) -> Dict[int, int]:
+        """Get the size of the mails of a mailbox per year.
+
+        :param name:    the name of the mailbox
+        :return:        the size of the mails (in bytes) per year
+        """
+        with self._lock:
+            rows = self._db.execute(f"""
+                SELECT {self._year()} AS year, SUM(size)
+                FROM mails JOIN mailboxes ON mailbox = name AND mails.uidvalidity = mailboxes.uidvalidity
+                WHERE name = ? AND year IS NOT NULL GROUP BY year""", (name,)).fetchall()
+        return dict(rows)
+
+    def sync(self, mb: object) -> None:
+        """Bring the index of a mailbox up to date.
+
+        If the server supports CONDSTORE, an unchanged mailbox costs the SELECT only and only
+        the flags of mails changed are fetched. Otherwise the flags of all mails are fetched.
+        The metadata of mails new to the index is fetched in any case.
+
+        The steps are taken by sync_steps, so the asyncio engine syncs the very same way.
+
+        :param mb:  the mailbox (bound to a connection)
+        """
+        steps.run(self.sync_steps(mb))
+
+    def sync_fetches(self, name: str, status: Dict[str, int], mail_ids: IdSet,
+                     plan: Tuple[IdSet, Optional[int]]) -> List[Tuple[IdSet, str, Callable[[list], None]]]:
+        """The second step of sync: drop the mails gone and plan the FETCH commands for the others.
+
+        :param name:        the name of the mailbox
+        :param status:      the status of the selected mailbox (see status_items)
+        :param mail_ids:    the ids of all mails in the mailbox
+        :param plan:        as returned by sync_plan
+        :return:            the mail ids, the message parts and the function to apply the response with per FETCH
+        """
+        mail_ids_known, modseq = plan
+        uid_validity = status['UIDVALIDITY']
+        self.remove(name, uid_validity, mail_ids_known - mail_ids)
+        fetches = []
+        if len(mail_ids_known & mail_ids) > 0:
+            fetches.append((mail_ids_known & mail_ids, flags_parts(modseq),
+                            functools.partial(self.update_flags, name, uid_validity)))
+        if len(mail_ids - mail_ids_known) > 0:
+            fetches.append((mail_ids - mail_ids_known, METADATA_PARTS, functools.partial(self.add, name, uid_validity)))
+        return fetches
+
+    def sync_plan(self, name: str, status: Dict[str, int], mail_count: int) -> Optional[Tuple[IdSet, Optional[int]]]:
+        """The first step of sync: check if the index of the selected mailbox has to be synced at all.
+
+        :param name:        the name of the mailbox
+        :param status:      the status of the selected mailbox (see status_items)
+        :param mail_count:  the number of mails in the mailbox
+        :return:            None if up to date, otherwise the mail ids in the index and the
+                            HIGHESTMODSEQ the flags in the index are up to date with
+        """
+        mail_ids_known = self.mails(name, status['UIDVALIDITY'])
+        up_to_date, modseq = self.up_to_date(name, status, mail_count, mail_ids_known)
+        if up_to_date:
+            return None
+        return mail_ids_known, modseq
+
+    def sync_steps(self, mb: object) -> Generator[Tuple, object, None]:
+        """The steps of sync, yielding the calls to make (see the steps module).
+
+        :param mb:  the mailbox (bound to a connection)
+        """
+        mail_count = yield mb.select, True
+        status = yield (mb.status,) + status_items(mb.capabilities)
+        plan = self.sync_plan(mb.name, status, mail_count)
+        if plan is None:
+            return
+
+        res, [mail_ids] = yield mb.search, 'ALL'
+        for fetch_ids, message_parts, apply in self.sync_fetches(mb.name, status, IdSet.parse(mail_ids), plan):
+            res, fetch_data = yield mb.fetch, fetch_ids, message_parts
+            apply(fetch_data)
+        self.record(mb.name, status)
+
+    def up_to_date(self, name: str, status: Dict[str, int], mail_count: int,
+                   mail_ids_known: IdSet) -> Tuple[bool, Optional[int]]:
+        """Check if the index of a mailbox is up to date.
+
+        :param name:            the name of the mailbox
+        :param status:          the status of the selected mailbox (see status_items)
+        :param mail_count:      the number of mails in the mailbox
+        :param mail_ids_known:  the mail ids in the index
+        :return:                up to date or not, the HIGHESTMODSEQ the flags in the index are up to date with
+        """
+        recorded = self.recorded(name)
+        if recorded.get('UIDVALIDITY') != status.get('UIDVALIDITY') or not recorded.get('HIGHESTMODSEQ'):
+            return False, None
+        return recorded == status and len(mail_ids_known) == mail_count, recorded['HIGHESTMODSEQ']
+
+    def update_flags(self, name: str, uid_validity: int, fetch_data: list) -> None:
+        """Update the flags of mails in the index.
+
+        :param name:            the name of the mailbox
+        :param uid_validity:    the UIDVALIDITY of the mailbox
+        :param fetch_data:      the response to a FETCH of flags_parts()
+        """
+        with self._lock, self._db:
+            self._db.executemany('UPDATE mails SET flags = ? WHERE mailbox = ? AND uidvalidity = ? AND uid = ?',
+                                 ((flags, name, uid_validity, i) for i, flags in _parse_flags(fetch_data)))
+
+    @staticmethod
+    def _year() -> str:
+        """The SQL expression of the year of a mail by the configured date source.
+
+        :return:    the SQL expression
+        """
+        date_source = Config().date_source
+        if date_source == 'header':
+            return 'CAST(substr(sent, 1, 4) AS INTEGER)'
+        if date_source == 'internaldate':
+            return 'CAST(substr(received, 1, 4) AS INTEGER)'
+        return 'CAST(substr(COALESCE(sent, received), 1, 4) AS INTEGER)'
@@ -8,17 +8,218 @@
 # (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
 # ------------------------------------------------------------
 
-import email.utils
+import copy
+import datetime
+import imaplib
 import re
 import sys
-from typing import Dict, List, Optional
+import time
+from typing import BinaryIO, Callable, Dict, Generator, Iterable, Iterator, List, Optional, Tuple
 
 from . import color
+from .batch import Batcher, response_size
+from .config import Config
+from .fetch import parse_fetch
+from .idset import IdSet
+
+
+# the range of years asked the server for in the first place
+_YEAR_FIRST = 1970
+
+_PATTERN_ESEARCH_COUNT = re.compile(rb'\bCOUNT (?P<count>\d+)')
+_PATTERN_STATUS = re.compile(rb'^(?P<name>"(?:[^"\\]|\\.)*"|\S+) \((?P<items>.*)\)\s*$')
+
+
+def bisect_years(year_from: int, year_to: int, res: str, data: list) -> (Dict[int, IdSet], Optional[int]):
+    """Decide on the response to a SEARCH for the seen mails of a span of years (see Mailbox._years_from_search).
+
+    Spans without any mail (or failed to search) are dropped and a single year is done. Any
+    other span has to be halved and both halves searched again.
+
+    :param year_from:   first year searched (inclusive)
+    :param year_to:     last year searched (exclusive)
+    :param res:         the return code of the SEARCH
+    :param data:        the data returned by the SEARCH
+    :return:            the mail ids per year found, the year to split the span at (or None)
+    """
+    if res != 'OK':
+        return {}, None
+    mail_ids = IdSet.parse(data[0])
+    if len(mail_ids) == 0:
+        return {}, None
+    if year_to - year_from == 1:
+        return {year_from: mail_ids}, None
+    return {}, (year_from + year_to) // 2
+
+
+def check_response(res: str, action: str) -> None:
+    """Raise a RuntimeError unless the server completed a command successfully.
+
+    :param res:     the return code of the command
+    :param action:  what the command was about, e.g. 'searching INBOX'
+    """
+    if res != 'OK':
+        raise RuntimeError(f'Server error on {action}. Returned: ' + str(res))
+
+
+def date_fetch_parts() -> str:
+    """The message parts to FETCH to date mails by the configured date source.
+
+    Depending on the configured date source this is the Date header field only, the
+    INTERNALDATE or both of them. Either way the server sends just a few dozen bytes per mail
+    instead of the whole header.
+
+    :return:    the message parts, e.g. '(INTERNALDATE)'
+    """
+    date_source = Config().date_source
+    if date_source == 'header':
+        return '(BODY.PEEK[HEADER.FIELDS (DATE)])'
+    if date_source == 'internaldate':
+        return '(INTERNALDATE)'
+    return '(INTERNALDATE BODY.PEEK[HEADER.FIELDS (DATE)])'
+
+
+def dates_from_fetch(fetch_data: list) -> Dict[int, tuple]:
+    """Get the dates of mails out of the response to a FETCH of date_fetch_parts().
+
+    The Date header field takes precedence over the INTERNALDATE if both are fetched.
+
+    :param fetch_data:  the data returned by imaplib for the FETCH command
+    :return:            the date (as returned by email.utils.parsedate) per mail id
+    """
+    date_source = Config().date_source
+    mail_dates = {}
+    for mail in parse_fetch(fetch_data):
+        if mail.uid is None:
+            continue
+        if mail.header_date is not None and date_source != 'internaldate':
+            mail_dates[mail.uid] = mail.header_date
+        elif mail.internal_date is not None and date_source != 'header':
+            mail_dates[mail.uid] = mail.internal_date
+    return mail_dates
+
+
+def inspect_criteria(criteria: Tuple[str, ...]) -> List[Tuple[str, ...]]:
+    """The SEARCH criteria for all, the seen and the deleted mails inspected (see Mailbox.inspect).
+
+    :param criteria:    inspect the mails matching these search criteria only
+    :return:            the search criteria for all mails, the seen mails and the deleted mails
+    """
+    return [criteria or ('ALL',), ('SEEN',) + criteria, ('DELETED',) + criteria]
+
+
+def merge_years(mails_per_year: Dict[int, IdSet], more_mails_per_year: Dict[int, IdSet]) -> Dict[int, IdSet]:
+    """Add mails per year to mails per year.
+
+    :param mails_per_year:          the mail ids per year to add to
+    :param more_mails_per_year:     the mail ids per year to add
+    :return:                        mails_per_year
+    """
+    for y, mail_ids in more_mails_per_year.items():
+        mails_per_year[y] = mails_per_year.get(y, IdSet()) | mail_ids
+    return mails_per_year
+
+
+def parse_esearch_count(esearch_data: list) -> int:
+    """Get the number of mails out of the response to a SEARCH RETURN (COUNT).
+
+    :param esearch_data:    the ESEARCH responses
+    :return:                the number of mails found
+    """
+    for d in esearch_data:
+        m = _PATTERN_ESEARCH_COUNT.search(d or b'')
+        if m is not None:
+            return int(m.group('count'))
+    return 0
+
+
+def parse_status(status_response: bytes) -> (str, Dict[str, int]):
+    """Parse a STATUS response.
+
+    Example:
+
+    >>> parse_status(b'"INBOX.Folder with Spaces" (MESSAGES 231 UNSEEN 4)')
+    ('INBOX.Folder with Spaces', {'MESSAGES': 231, 'UNSEEN': 4})
+
+    :param status_response:     the STATUS response (without the leading '* STATUS')
+    :return:                    mailbox name, status items
+    """
+    m = _PATTERN_STATUS.match(status_response)
+    if m is None:
+        raise RuntimeError('Malformed STATUS response: ' + str(status_response))
+    items = m.group('items').decode().split()
+    name = m.group('name').decode()
+    if name.startswith('"'):
+        name = name[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return name, {items[i].upper(): int(items[i + 1]) for i in range(0, len(items) - 1, 2)}
+
+
+def undated_mails(mails_seen: IdSet, mails_per_year: Dict[int, IdSet]) -> IdSet:
+    """Get the seen mails not dated yet.
+
+    :param mails_seen:      the ids of the seen mails
+    :param mails_per_year:  the mail ids per year known
+    :return:                the ids of the seen mails not found in any year
+    """
+    mails_dated = IdSet()
+    for y in mails_per_year:
+        mails_dated = mails_dated | mails_per_year[y]
+    return mails_seen - mails_dated
+
+
+def year_search_criteria(year_from: int, year_to: int) -> Tuple[str, ...]:
+    """The SEARCH criteria for the seen mails dated within a span of years.
+
+    Mails are dated by the Date header unless the configured date source is the INTERNALDATE.
+
+    :param year_from:   first year (inclusive)
+    :param year_to:     last year (exclusive)
+    :return:            the search criteria
+    """
+    since, before = 'SENTSINCE', 'SENTBEFORE'
+    if Config().date_source == 'internaldate':
+        since, before = 'SINCE', 'BEFORE'
+    return 'SEEN', f'{since} 1-Jan-{year_from}', f'{before} 1-Jan-{year_to}'
+
+
+def year_span() -> (int, int):
+    """The span of years the server is asked for the seen mails in the first place.
+
+    :return:    first year (inclusive), last year (exclusive)
+    """
+    return _YEAR_FIRST, datetime.date.today().year + 2
+
+
+def years_from_dates(mail_ids: IdSet, mail_dates: Dict[int, tuple], mailbox_name: str) -> Dict[int, IdSet]:
+    """Bucket mails by the year of their dates.
+
+    Mails without a date are reported and left out.
+
+    :param mail_ids:        the mail ids to bucket
+    :param mail_dates:      the date (as returned by email.utils.parsedate) per mail id
+    :param mailbox_name:    the name of the mailbox of the mails (for the report)
+    :return:                the mail ids per year
+    """
+    mails_per_year = {}
+    for mail_id in mail_ids:
+        if mail_id not in mail_dates:
+            sys.stderr.write(color.error(f'Failed to deduce year of mail {mail_id} in {mailbox_name}.\n'))
+            continue
+        mail_year = mail_dates[mail_id][0]
+        if mail_year not in mails_per_year:
+            mails_per_year[mail_year] = []
+        mails_per_year[mail_year].append(mail_id)
+
+    return {y: IdSet(mails_per_year[y]) for y in mails_per_year}
 
 
 class Mailbox(object):
 
-    """This is a single mailbox found on the IMAP4 server."""
+    """This is a single mailbox found on the IMAP4 server.
+
+    All mails are addressed by their UIDs, which - unlike sequence numbers - stay valid
+    when other mails of the mailbox are expunged.
+    """
 
     def __init__(self, connection: object, mailbox_entry: str):
 
@@ -43,104 +244,205 @@ class Mailbox(object):
         if self._name.startswith('"'):
             self._name = self._name[1:]
         self._connection = connection
+        self._status = {}
+
+    def _batcher(self, command: str) -> Batcher:
+        """Get a new Batcher for an UID command on this mailbox.
+
+        :param command:     the IMAP4 command to prefix with UID
+        :return:            the batcher
+        """
+        return Batcher(f'UID {command} in {color.mailbox(self.name)}')
+
+    @property
+    def capabilities(self) -> List[str]:
+        """The capabilities of the server of the connection this mailbox is bound to."""
+        return self._connection.capabilities
 
     @property
     def children(self) -> bool:
         """Does this mailbox do have children?"""
         return self._children
 
-    def copy(self, mail_ids: List[str], destination: str = None) -> None:
+    def copy(self, mail_ids: Iterable[str], destination: str = None) -> None:
         """Copy mails from the current mailbox to a destination mailbox.
 
-        :param list[str] mail_ids:  list of mail ids to copy
-        :param str destination:     name of destination mailbox
+        A failed COPY raises a RuntimeError.
+
+        :param mail_ids:        mail ids to copy
+        :param destination:     name of destination mailbox
         """
+        mail_ids = IdSet(mail_ids)
         if len(mail_ids) == 0 or len(destination) == 0:
             return
-        self.select()
-        m = ','.join(mail_ids)
+        self._select()
         d = self.quote_path(destination)
-        self._connection.imap4.copy(m, d)
+        res, data = self._uid('COPY', mail_ids, d)
+        check_response(res, f'copying mails from {self.name} to {destination}')
+
+    def count(self, *criteria) -> int:
+        """Count the mails matching some search criteria.
+
+        With ESEARCH (RFC 4731) the server just returns the number of mails found instead of
+        the list of all their ids.
+
+        :param criteria:    IMAP4 search criteria
+        :return:            number of mails matching the criteria
+        """
+        if 'ESEARCH' not in self._connection.capabilities:
+            res, [mail_ids] = self.search(*criteria)
+            check_response(res, f'searching {self.name}')
+            return len(IdSet.parse(mail_ids))
+
+        self._select(readonly=True)
+        res, data = self._connection.imap4.uid('SEARCH', 'RETURN (COUNT)', *criteria)
+        check_response(res, f'searching {self.name}')
+        res, esearch_data = self._connection.imap4.response('ESEARCH')
+        return parse_esearch_count(esearch_data)
+
+    def dates(self, mail_ids: Iterable[int]) -> Dict[int, tuple]:
+        """Fetch the dates of mails.
+
+        Depending on the configured date source this fetches the Date header field, the
+        INTERNALDATE or both of them (see date_fetch_parts).
+
+        :param mail_ids:    the mail ids to get the dates for
+        :return:            the date (as returned by email.utils.parsedate) per mail id
+        """
+        self._select(readonly=True)
+        res, fetch_data = self._uid('FETCH', IdSet(mail_ids), date_fetch_parts())
+        check_response(res, f'fetching mail dates in {self.name}')
+        return dates_from_fetch(fetch_data)
 
     def delete(self) -> None:
         """Delete this mailbox on the IMAP4 server."""
+        self._connection.selected = None
         self._connection.imap4.select()
-        self._connection.imap4.delete(self.path)
+        res, data = self._connection.imap4.delete(self.path)
+        if res == 'OK':
+            self._connection.forget_mailbox(self.name)
 
     @property
     def delimiter(self) -> str:
         """Mailbox name delimiter used to build mailbox hierarchy."""
         return self._delimiter
 
-    def expunge(self) -> None:
-        """Permanently delete marked mails in current mailbox."""
-        self.select()
-        self._connection.imap4.expunge()
+    def expunge(self, mail_ids: Iterable[str] = None) -> None:
+        """Permanently delete marked mails in current mailbox.
+
+        If mail ids are given and the server supports UIDPLUS then only these mails are
+        removed (if marked as deleted). Otherwise all marked mails of the mailbox are.
+
+        :param mail_ids:    mail ids to remove
+        """
+        self._select()
+        if mail_ids is not None and 'UIDPLUS' in self._connection.capabilities:
+            mail_ids = IdSet(mail_ids)
+            if len(mail_ids) > 0:
+                self._uid('EXPUNGE', mail_ids)
+        else:
+            self._connection.imap4.expunge()
 
     def fetch(self, ids, message_parts) -> (str, List[str]):
         """Get some content from the IMAP4 server within this mailbox.
 
         Example:
 
-        >>> con.fetch('1,2', '(BODY)')
-        ('OK', [b'1 (BODY ("text" "plain" ("charset" "UTF-8") NIL NIL "8bit" 909 38))',
-                b'2 (BODY ("text" "plain" ("charset" "ISO-8859-1" "format" "flowed") NIL NIL "7bit" 696 32))'])
+        >>> mb.fetch('1:2', '(BODY)')
+        ('OK', [b'1 (UID 1 BODY ("text" "plain" ("charset" "UTF-8") NIL NIL "8bit" 909 38))',
+                b'2 (UID 2 BODY ("text" "plain" ("charset" "ISO-8859-1" "format" "flowed") NIL NIL "7bit" 696 32))'])
 
-        :param list[int] ids:       the mail ids requested
+        :param ids:                 the mail ids requested (a sequence set or some mail ids)
         :param str message_parts:   content requested
         :return:                    return code, list[content]
         :rtype:                     str, list[bytes]
         """
-        self.select()
-        return self._connection.imap4.fetch(ids, message_parts)
-
-    def inspect(self) -> (List[int], List[int], List[int], Dict[int, List[int]]):
+        self._select(readonly=True)
+        if isinstance(ids, str):
+            return self._connection.imap4.uid('FETCH', ids, message_parts)
+        return self._uid('FETCH', IdSet(ids), message_parts)
+
+    def fetch_stream(self, mail_ids: Iterable[int], message_parts: str,
+                     literal_file: Callable[[bytes], Optional[BinaryIO]],
+                     batch_fetched: Callable[[IdSet], None] = None) -> Iterator[List]:
+        """Fetch mails and hand over the response mail by mail, while it is received.
+
+        See Connection.fetch_stream: big literals may go straight to a file. The mails are
+        fetched in batches sized by a Batcher.
+
+        :param mail_ids:        the mail ids requested
+        :param message_parts:   content requested
+        :param literal_file:    gives the file to write a literal to (or None to keep it in memory)
+        :param batch_fetched:   called with the mail ids of each batch once all its mails have been
+                                handed over
+        :return:                an iterator over the data of each mail
+        """
+        self._select(readonly=True)
+        batcher = self._batcher('FETCH')
+        for batch in batcher.batches(IdSet(mail_ids)):
+            start, size = time.monotonic(), 0
+            for sequence_set in self._sequence_sets('FETCH', batch, message_parts):
+                for mail_data in self._connection.fetch_stream(sequence_set, message_parts, literal_file):
+                    size += response_size(mail_data)
+                    yield mail_data
+            batcher.record(len(batch), size, time.monotonic() - start)
+            if batch_fetched is not None:
+                batch_fetched(batch)
+
+    def inspect(self, *criteria) -> (IdSet, IdSet, IdSet, Dict[int, IdSet]):
 
         """Inspect the current mailbox.
 
-        :return:    all mail ids, seen mail ids, deleted mail ids, seen mails per year
+        :param criteria:    inspect the mails matching these search criteria only, e.g. ('MODSEQ', '1234')
+        :return:            all mail ids, seen mail ids, deleted mail ids, seen mails per year
         """
-        res, [mails_all] = self.search('ALL')
-        res, [mails_seen] = self.search('SEEN')
-        res, [mails_deleted] = self.search('DELETED')
-
-        mails_all = mails_all.decode().split(' ')
-        if len(mails_all) > 0 and mails_all[0] == '':
-            mails_all.pop()
-
-        mails_seen = mails_seen.decode().split(' ')
-        if len(mails_seen) > 0 and mails_seen[0] == '':
-            mails_seen.pop()
-
-        mails_deleted = mails_deleted.decode().split(' ')
-        if len(mails_deleted) > 0 and mails_deleted[0] == '':
-            mails_deleted.pop()
+        mails_all, mails_seen, mails_deleted = [IdSet.parse(self.search(*c)[1][0]) for c in inspect_criteria(criteria)]
 
         mails_per_year = {}
         if len(mails_seen) > 0:
 
-            # run in chunks of 1000 mails... reason: overload of library otherwise
-            i = 0
-            m = mails_seen[i:i + 1000]
-            while len(m) > 0:
+            # let the server do the bucketing, only mails it can't date are left over to us
+            mails_per_year = self._years_from_search(*year_span(), *criteria)
+            merge_years(mails_per_year, self._years_from_fetch(undated_mails(mails_seen, mails_per_year)))
 
-                res, header_data = self.fetch(','.join(m), '(BODY.PEEK[HEADER])')
-                pattern_mail_id = re.compile('(?P<msgid>.*?) .*')
-                for h in header_data:
-                    if isinstance(h, tuple):
+        return mails_all, mails_seen, mails_deleted, mails_per_year
 
-                        mail_id = pattern_mail_id.match(h[0].decode()).groups()[0]
-                        mail_header = h[1].split(b'\r\n')
-                        mail_year = self._year_from_mail_header(mail_header)
-                        if mail_year is not None:
-                            if mail_year not in mails_per_year:
-                                mails_per_year[mail_year] = []
-                            mails_per_year[mail_year].append(mail_id)
+    def move(self, mail_ids: Iterable[str], destination: str) -> IdSet:
+        """Move mails from the current mailbox to a destination mailbox.
 
-                i = i + 1000
-                m = mails_seen[i:i + 1000]
+        If the server supports MOVE (RFC 6851) the mails are moved right away. Otherwise they
+        are copied and marked as deleted: these mails are returned and have to be expunged
+        by the caller. Thus, moving mails to several destinations needs one expunge only.
+        A failed MOVE or COPY raises a RuntimeError, so mails not copied are never marked as
+        deleted.
 
-        return mails_all, mails_seen, mails_deleted, mails_per_year
+        :param mail_ids:        mail ids to move
+        :param destination:     name of destination mailbox
+        :return:                mail ids still to expunge
+        """
+        mail_ids = IdSet(mail_ids)
+        how = self._move_command(mail_ids, destination)
+        if how == 'MOVE':
+            self._select()
+            res, data = self._uid('MOVE', mail_ids, self.quote_path(destination))
+            check_response(res, f'moving mails from {self.name} to {destination}')
+        elif how == 'COPY':
+            self.copy(mail_ids, destination)
+            self.store(mail_ids, '+FLAGS', r'(\Deleted)')
+        return mail_ids if how == 'COPY' else IdSet()
+
+    def _move_command(self, mail_ids: IdSet, destination: str) -> Optional[str]:
+        """Decide how to move mails (see move).
+
+        :param mail_ids:        mail ids to move
+        :param destination:     name of destination mailbox
+        :return:                None if there is nothing to move, 'MOVE' or 'COPY' (and mark deleted)
+        """
+        if len(mail_ids) == 0 or len(destination) == 0:
+            return None
+        if 'MOVE' in self._connection.capabilities:
+            return 'MOVE'
+        return 'COPY'
 
     @property
     def name(self) -> str:
@@ -169,23 +471,71 @@ class Mailbox(object):
             path_quoted = path_quoted + '"'
         return path_quoted
 
+    def rebind(self, connection: object) -> 'Mailbox':
+        """Get this very mailbox but operated on by another connection.
+
+        :param connection:  the IMAP4 server connection to use
+        :return:            the mailbox bound to the connection given
+        """
+        if connection is self._connection:
+            return self
+        mb = copy.copy(self)
+        mb._connection = connection
+        mb._status = dict(self._status)
+        return mb
+
     def search(self, *criteria) -> (str, List[bytes]):
         """Search inside the selected mailbox.
 
         :param criteria:    IMAP4 search criteria
         :return:            result string, mail ids matching the criteria
         """
-        self.select()
-        return self._connection.imap4.search(None, *criteria)
+        self._select(readonly=True)
+        return self._connection.imap4.uid('SEARCH', *criteria)
 
-    def select(self) -> int:
+    def select(self, readonly: bool = False) -> int:
         """Selects this mailbox for the next IMAP operation.
 
-        :return:     the number of mails in this mailbox
+        A mailbox selected read-only (EXAMINE) is not changed by the server at all, e.g. no
+        \\Recent flags are cleared, and servers may take cheaper locks for it.
+
+        The UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ the server reports on selecting are
+        remembered as status items (see status).
+
+        :param readonly:    select the mailbox read-only
+        :return:            the number of mails in this mailbox
         """
         if not self._connection:
             raise RuntimeError('No connection.')
-        return int(self._connection.imap4.select(self.path)[1][0])
+        imap4 = self._connection.imap4
+        self._connection.selected = None
+        mail_count = int(imap4.select(self.path, readonly)[1][0])
+        self._connection.selected = (self.path, readonly)
+        self._status_from_select(imap4.untagged_responses)
+        return mail_count
+
+    def _select(self, readonly: bool = False) -> None:
+        """Select this mailbox unless it is selected already.
+
+        A mailbox selected read-write serves read-only operations, too.
+
+        :param readonly:    the mailbox is used read-only
+        """
+        selected = self._connection.selected if self._connection else None
+        if selected is not None and selected[0] == self.path and (readonly or not selected[1]):
+            return
+        self.select(readonly)
+
+    def _sequence_sets(self, command: str, mail_ids: IdSet, *args) -> Iterator[str]:
+        """Split mail ids into sequence sets so the UID commands do not exceed the maximum line length.
+
+        :param command:     the IMAP4 command to prefix with UID
+        :param mail_ids:    the mail ids the command applies to
+        :param args:        further command arguments
+        :return:            an iterator over the sequence sets
+        """
+        overhead = len(f'A000 UID {command} ') + sum(len(a) + 1 for a in args)
+        yield from mail_ids.split(max(Config().max_line_length - overhead, 1))
 
     @staticmethod
     def strip_path(path: str = None) -> str:
@@ -202,34 +552,133 @@ class Mailbox(object):
 
         return path_stripped
 
-    def store(self, mail_ids: List[int], operation: str, flags: str) -> None:
+    def status(self, *items, refresh: bool = False) -> Dict[str, int]:
+        """Get status items of this mailbox, e.g. status('MESSAGES', 'UNSEEN').
+
+        This does not select the mailbox. The status is remembered: if it is known already
+        (e.g. delivered along with the mailbox list, see Connection.mailboxes) no further
+        command is issued at all unless a refresh is requested.
+
+        :param items:       the status data items
+        :param refresh:     ask the server in any case
+        :return:            the value of each status item
+        """
+        items = [i.upper() for i in items]
+        if refresh or not all(i in self._status for i in items):
+            res, data = self._connection.imap4.status(self.path, '(' + ' '.join(items) + ')')
+            self._status_from_response(res, data)
+        return {i: self._status[i] for i in items if i in self._status}
+
+    def _status_from_response(self, res: str, status_data: list) -> None:
+        """Remember the status items reported by the server in response to STATUS.
+
+        :param res:             the return code of the STATUS command
+        :param status_data:     the STATUS responses
+        """
+        check_response(res, f'status of {self.name}')
+        for d in status_data:
+            if isinstance(d, bytes):
+                self._status.update(parse_status(d)[1])
+
+    def _status_from_select(self, untagged_responses: Dict[str, list]) -> None:
+        """Remember the status items reported by the server on selecting this mailbox.
+
+        :param untagged_responses:  the untagged responses to the SELECT command
+        """
+        for item in ('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'):
+            data = untagged_responses.get(item)
+            if data:
+                self._status[item] = int(data[-1])
+
+    def store(self, mail_ids: Iterable[str], operation: str, flags: str) -> None:
         """Modify mail flags inside this mailbox.
 
-        This will delete the mails 1, 2 and 5 in the current mailbox:
+        This will delete the mails with UIDs 1, 2 and 5 in the current mailbox:
         >>> mb = Mailbox(...)
-        >>> mb.store([b'1', b'2', b'5'], '+FLAGS', r'(\Deleted)')
+        >>> mb.store(['1', '2', '5'], '+FLAGS', r'(\Deleted)')
 
-        :param mail_ids:    list of mail ids to modify
+        :param mail_ids:    mail ids to modify
         :param operation:   IMAP4 operation
         :param flags:       IMAP4 flags to apply
         """
-        self.select()
-        m = ','.join(mail_ids)
-        self._connection.imap4.store(m, operation, flags)
+        self._select()
+        self._uid('STORE', IdSet(mail_ids), operation, flags)
 
-    @staticmethod
-    def _year_from_mail_header(mail_header: List[bytes]) -> Optional[int]:
-        """Pick the year of the email by examinig a mail header.
+    def _uid(self, command: str, mail_ids: IdSet, *args) -> (str, List):
+        """Run an UID command on some mails.
 
-        :param mail_header:     all mail headers of a mail
-        :return:                the year of the mail
+        The mails are split into batches sized by a Batcher, and a batch is split further if
+        the command line would exceed the configured maximum line length otherwise. The
+        commands are pipelined in rounds of Config().pipeline_depth batches.
+
+        :param command:     the IMAP4 command to prefix with UID
+        :param mail_ids:    the mail ids the command applies to
+        :param args:        further command arguments
+        :return:            the first failed (or last) return code, the collected responses
+        """
+        rounds = self._uid_rounds(command, mail_ids, *args)
+        try:
+            commands = next(rounds)
+            while True:
+                commands = rounds.send(self._connection.pipeline(commands))
+        except StopIteration as done:
+            return done.value
+
+    def _uid_rounds(self, command: str, mail_ids: IdSet,
+                    *args) -> Generator[List[Tuple], List[Tuple[str, List]], Tuple[str, List]]:
+        """The sans-IO part of _uid: plan the rounds of commands to pipeline and collect their results.
+
+        Each round of commands is yielded and the return code and data per command has to
+        be sent back before the next round is planned.
+
+        :param command:     the IMAP4 command to prefix with UID
+        :param mail_ids:    the mail ids the command applies to
+        :param args:        further command arguments
+        :return:            the first failed (or last) return code, the collected responses
         """
-        for mh in mail_header:
-            if mh.startswith(b'Date:'):
-                try:
-                    return email.utils.parsedate(str(mh)[8:])[0]
-                except:
-                    sys.stderr.write(color.error('Failed to deduce year of mail.\n'))
-                    sys.stderr.write(color.error('Defective mail: \n' + str(mail_header) + '\n'))
-                    return None
+        batcher = self._batcher(command)
+        res, data = 'OK', []
+        for batch_round in batcher.rounds(mail_ids, Config().pipeline_depth):
+            commands = [(command, s) + args for b in batch_round for s in self._sequence_sets(command, b, *args)]
+            start, size = time.monotonic(), 0
+            for r, d in (yield commands):
+                if res == 'OK':
+                    res = r
+                size += response_size(d)
+                data.extend(d)
+            batcher.record(sum(len(b) for b in batch_round), size, time.monotonic() - start, len(commands))
+        return res, data
+
+    def _years_from_fetch(self, mail_ids: IdSet) -> Dict[int, IdSet]:
+        """Get the years of mails by fetching their dates.
+
+        :param mail_ids:    the mail ids to examine
+        :return:            the mail ids per year
+        """
+        return years_from_dates(mail_ids, self.dates(mail_ids), self.name)
+
+    def _years_from_search(self, year_from: int, year_to: int, *criteria) -> Dict[int, IdSet]:
+        """Get the years of the seen mails by asking the server.
+
+        This runs a binary search over the year boundaries: the span [year_from, year_to[
+        is halved until a single year is left. Spans without any mail are dropped on the
+        way, so only a few SEARCH round trips are needed for each year present.
 
+        Unless the mails are dated by their INTERNALDATE, mails with no (or a defective) Date
+        header are not found by the server. Neither are mails dated outside of the year span
+        given.
+
+        :param year_from:   first year to search (inclusive)
+        :param year_to:     last year to search (exclusive)
+        :param criteria:    further search criteria
+        :return:            the mail ids per year
+        """
+        try:
+            res, data = self.search(*year_search_criteria(year_from, year_to), *criteria)
+        except imaplib.IMAP4.error:
+            res, data = 'NO', []
+        mails_per_year, year_middle = bisect_years(year_from, year_to, res, data)
+        if year_middle is not None:
+            mails_per_year = self._years_from_search(year_from, year_middle, *criteria)
+            mails_per_year.update(self._years_from_search(year_middle, year_to, *criteria))
+        return mails_per_year
@@ -0,0 +1,207 @@
+# ------------------------------------------------------------
+# imaparchiver/operations.py
+#
+# the work done on a single mailbox by download, move and scan
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module holds the work done on a single mailbox, shared by both engines.
+
+Each operation is a generator yielding the calls to make on the mailbox or the connection
+(see the steps module): the blocking commands run it by steps.run, the asyncio engine by
+aio.run_steps. So all the decisions and all the output are the same for both engines.
+"""
+
+import functools
+import os
+import sys
+from typing import Generator, Iterable, Optional, Tuple
+
+from . import color
+from .changes import MailboxChanges
+from .config import Config
+from .download import DownloadState, download_parts, mail_store
+from .idset import IdSet
+from .index import Index, print_index_counts
+from .policy import archive_path, years_to_archive
+from .steps import each
+
+
+def download_mailbox(folder: str, full: bool, con: object, mb: object) -> Generator[Tuple, object, None]:
+    """Download the messages of a single mailbox not downloaded yet.
+
+    :param folder:  the local target folder
+    :param full:    download all messages regardless of the download state
+    :param con:     the connection to use
+    :param mb:      the mailbox
+    """
+    mb = mb.rebind(con)
+    mb_name_output = color.mailbox(mb.name)
+    mail_count = yield mb.select, True
+    if mail_count == 0:
+        return
+
+    mail_folder = os.path.join(folder, mb.name.replace(mb.delimiter, os.sep))
+    uid_validity = (yield mb.status, 'UIDVALIDITY').get('UIDVALIDITY')
+    state = DownloadState(mail_folder, uid_validity, full)
+    if state.resync:
+        sys.stderr.write(f"UIDVALIDITY of mailbox '{mb_name_output}' changed, downloading all mails again.\n")
+
+    r, d = yield (mb.search,) + state.search_criteria()
+    if not r == 'OK':
+        sys.stderr.write(color.error('Failed to list messages in mailbox.\n'))
+        return
+
+    mail_ids = state.new_mails(IdSet.parse(d[0]))
+    if not mail_ids:
+        if Config().verbose:
+            sys.stderr.write(f"No new mails in mailbox '{mb_name_output}'\n")
+        return
+    sys.stderr.write(f"Downloading {len(mail_ids)} mails from mailbox '{mb_name_output}' to '{mail_folder}'\n")
+
+    store = mail_store(folder, mail_folder, uid_validity)
+    try:
+        yield each, mb.fetch_stream(mail_ids, download_parts(), store.literal_file, state.batch_fetched), \
+            functools.partial(_save_mail, store, state)
+    except (OSError, RuntimeError) as e:
+        sys.stderr.write(color.error('Failed to download mails:\n' + str(e) + '\n'))
+        sys.exit(1)
+    finally:
+        for stored_id in store.close():
+            state.commit(stored_id)
+
+
+def move_mailbox(mailbox_to: str, year: int, changes: MailboxChanges, index: Optional[Index], con: object,
+                 mb: object) -> Generator[Tuple, object, None]:
+    """Move the old mails of a single mailbox.
+
+    A mailbox unchanged since the last run is skipped. Of a changed mailbox only the mails
+    changed since the last run are inspected, if the server supports CONDSTORE. With an
+    index the mailbox is inspected by the index, which is brought up to date first.
+
+    :param mailbox_to:  the mailbox to move to
+    :param year:        mails sent before 1st January of this year are old
+    :param changes:     the mailboxes changed since the last run
+    :param index:       the index to inspect the mailbox by (if any)
+    :param con:         the connection to use
+    :param mb:          the mailbox
+    """
+    mb_from_output = color.mailbox(mb.name)
+    mb = mb.rebind(con)
+    status = {}
+    if changes.enabled:
+        status = yield (mb.status,) + changes.status_items
+    if changes.unchanged(mb.name, status):
+        if Config().verbose:
+            sys.stderr.write(f'Mailbox {mb_from_output} unchanged since last run\n')
+        return
+    if Config().verbose:
+        sys.stderr.write(f'Checking mailbox {mb_from_output}...\n')
+
+    mails_to_expunge = IdSet()
+    if index is not None:
+        yield from index.sync_steps(mb)
+        mails_all, mails_seen, mails_deleted, mails_per_year = index.inspect(mb.name)
+    else:
+        modseq = changes.modseq(mb.name, status)
+        criteria = () if modseq is None else ('MODSEQ', str(modseq + 1))
+        mails_all, mails_seen, mails_deleted, mails_per_year = yield (mb.inspect,) + criteria
+    for y in years_to_archive(mails_per_year, year):
+        archive_mailbox = archive_path(mailbox_to, mb, y)
+        mb_to_output = color.mailbox(archive_mailbox)
+
+        mails_to_move = len(mails_per_year[y])
+        sys.stdout.write(f'Mailbox: {mb_from_output} - moving {mails_to_move} mails to {mb_to_output}\n')
+        if Config().dry_run is False:
+            yield con.create_mailbox, archive_mailbox, mb.delimiter
+            mails_to_expunge = mails_to_expunge | (yield mb.move, mails_per_year[y], archive_mailbox)
+
+    if len(mails_to_expunge) > 0:
+        yield mb.expunge, mails_to_expunge
+    changes.record(mb.name, status)
+
+
+def print_scan_header(index: Optional[Index]) -> None:
+    """Print the header of the mail counts printed by scan_mailbox.
+
+    :param index:   the index the mails are counted by (if any)
+    """
+    if index is not None:
+        print('%-70s   all mails   seen mails   deleted mails         size' % 'Mailbox name')
+        print('%s------------------------------------------------------' % ('-' * 70))
+    else:
+        print('%-70s   all mails   seen mails   deleted mails' % 'Mailbox name')
+        print('%s-----------------------------------------' % ('-' * 70))
+
+
+def _save_mail(store: object, state: DownloadState, mail_data: list) -> None:
+    """Save a mail just fetched and remember the mails stored for good.
+
+    :param store:       the store the mails are written to (see download.mail_store)
+    :param state:       the download state of the mailbox
+    :param mail_data:   the FETCH response of the mail
+    """
+    m_id, path, written = store.save(mail_data)
+    state.fetched(m_id)
+    sys.stdout.write(f'Fetched message {m_id}\n')
+    if path is None:
+        sys.stderr.write(color.error('Cannot deduce filename for mail.\n'))
+        sys.exit(1)
+    if written:
+        sys.stderr.write(f'Wrote mail as "{os.path.basename(path)}"\n')
+    else:
+        sys.stderr.write(f'Mail stored as "{os.path.basename(path)}" already\n')
+    for stored_id in store.stored():
+        state.commit(stored_id)
+
+
+def scan_mailbox(years: bool, status: Tuple[str, ...], index: Optional[Index], con: object,
+                 mb: object) -> Generator[Tuple, object, None]:
+    """Print the mail counts of a single mailbox.
+
+    :param years:   examine each mail and print the number of seen mails per year
+    :param status:  the STATUS items to count mails by (see scan_status_items)
+    :param index:   the index to count the mails by (if any)
+    :param con:     the connection to use
+    :param mb:      the mailbox
+    """
+    mb = mb.rebind(con)
+    mails_per_year = {}
+    if index is not None:
+        yield from index.sync_steps(mb)
+        print_index_counts(index, mb.name, years)
+        return
+    if years:
+        mails_all, mails_seen, mails_deleted, mails_per_year = yield (mb.inspect,)
+        count_all, count_seen, count_deleted = len(mails_all), len(mails_seen), len(mails_deleted)
+    else:
+        mb_status = yield (mb.status,) + status
+        count_all = mb_status['MESSAGES']
+        count_seen = mb_status['MESSAGES'] - mb_status['UNSEEN']
+        if 'DELETED' in mb_status:
+            count_deleted = mb_status['DELETED']
+        else:
+            count_deleted = yield mb.count, 'DELETED'
+
+    if Config().no_color:
+        print('%-70s       %5d        %5d           %5d' %
+              (color.mailbox(mb.name), count_all, count_seen, count_deleted))
+    else:
+        print('%-79s       %5d        %5d           %5d' %
+              (color.mailbox(mb.name), count_all, count_seen, count_deleted))
+    for y in sorted(mails_per_year):
+        print('%-70s                    %5d' % (f'    {y}', len(mails_per_year[y])))
+
+
+def scan_status_items(capabilities: Iterable[str]) -> Tuple[str, ...]:
+    """Get the STATUS items scan_mailbox counts the mails by.
+
+    :param capabilities:    the capabilities of the server
+    :return:                the status items
+    """
+    if 'IMAP4rev2' in capabilities:
+        return 'MESSAGES', 'UNSEEN', 'DELETED'
+    return 'MESSAGES', 'UNSEEN'
@@ -0,0 +1,118 @@
+# ------------------------------------------------------------
+# imaparchiver/policy.py
+#
+# which mailboxes to work on and which mails are old
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module holds the rules which mailboxes are worked on and where old mails go to.
+
+These rules are shared by the commands run on blocking connections and the asyncio engine
+(see the aio module).
+"""
+
+import datetime
+import sys
+from typing import Dict, Iterable, List
+
+from . import color
+from .config import Config
+from .idset import IdSet
+from .mailbox import Mailbox
+
+
+def archive_path(mailbox_to: str, mb: Mailbox, year: int) -> str:
+    """Get the archive mailbox for the mails of a mailbox sent in a year.
+
+    Example:
+
+    >>> archive_path('Archive', mb, 2013)       # with mb.name == 'INBOX.Friends'
+    'Archive.2013.INBOX.Friends'
+
+    :param mailbox_to:  the archive mailbox
+    :param mb:          the mailbox the mails are moved from
+    :param year:        the year the mails are sent
+    :return:            the path of the archive mailbox (quoted if need be)
+    """
+    archive_mailbox = mailbox_to + mb.delimiter + str(year) + mb.delimiter + mb.name
+    if ' ' in archive_mailbox:
+        archive_mailbox = '"' + archive_mailbox + '"'
+    return archive_mailbox
+
+
+def mailbox_children(mbs: Iterable[Mailbox]) -> Dict[str, List[str]]:
+    """Get the tree of mailboxes: the children of each mailbox.
+
+    A mailbox is a child of the closest of its ancestors in the list. So the tree stays
+    connected even if some intermediate mailbox has not been listed.
+
+    :param mbs:     the mailboxes (see Connection.mailboxes)
+    :return:        the names of the children per mailbox name
+    """
+    mbs = list(mbs)
+    names = {mb.name for mb in mbs}
+    children = {name: [] for name in names}
+    for mb in mbs:
+        path = mb.name.split(mb.delimiter) if mb.delimiter else [mb.name]
+        for i in range(len(path) - 1, 0, -1):
+            parent = mb.delimiter.join(path[:i])
+            if parent in names:
+                children[parent].append(mb.name)
+                break
+    return children
+
+
+def mailbox_levels(mbs: Iterable[Mailbox]) -> List[List[Mailbox]]:
+    """Group mailboxes by their depth in the hierarchy, deepest first.
+
+    The mailboxes of a level are no ancestors of each other, so they may be worked on in
+    parallel once all the deeper levels are done.
+
+    :param mbs:     the mailboxes
+    :return:        the mailboxes per level, deepest level first
+    """
+    levels = {}
+    for mb in mbs:
+        depth = mb.name.count(mb.delimiter) if mb.delimiter else 0
+        levels.setdefault(depth, []).append(mb)
+    return [levels[d] for d in sorted(levels, reverse=True)]
+
+
+def max_year() -> int:
+    """Returns the maximum year for which mails < max_year() are considered old.
+
+    :return:    most recent year for which mails are old
+    """
+    return datetime.date(datetime.date.today().year - 1, 1, 1).year
+
+
+def select_mailboxes(mbs: Dict[str, Mailbox], omit: Iterable[str] = ()) -> List[Mailbox]:
+    """Pick the mailboxes to work on.
+
+    :param mbs:     the mailboxes found (see Connection.mailboxes)
+    :param omit:    names of mailboxes to ignore
+    :return:        the mailboxes to work on, sorted by name
+    """
+    selected = []
+    for name in sorted(mbs):
+        if mbs[name] is None:
+            continue
+        if name in omit:
+            if Config().verbose:
+                sys.stderr.write(f'Omitting mailbox {color.mailbox(name)}\n')
+            continue
+        selected.append(mbs[name])
+    return selected
+
+
+def years_to_archive(mails_per_year: Dict[int, IdSet], year: int) -> List[int]:
+    """Pick the years whose mails are old.
+
+    :param mails_per_year:  the mail ids per year (see Mailbox.inspect)
+    :param year:            mails sent before 1st January of this year are old
+    :return:                the years to archive, sorted
+    """
+    return sorted(y for y in mails_per_year if y < year)
@@ -0,0 +1,224 @@
+# ------------------------------------------------------------
+# imaparchiver/pool.py
+#
+# a pool of IMAP4 server connections
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module contains the connection pool to work on several mailboxes in parallel."""
+
+import concurrent.futures
+import contextlib
+import contextvars
+import queue
+import sys
+import threading
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+from .connection import Connection
+
+
+# the output collected for the current pool task (if any)
+_task_output = contextvars.ContextVar('task_output', default=None)
+
+
+class _Output(object):
+
+    """Stand-in for sys.stdout or sys.stderr collecting the output of pool tasks.
+
+    Anything written by a pool task (a thread or an asyncio task running collect_output) is
+    collected for this very task. Anything else is passed to the original stream.
+    """
+
+    def __init__(self, stream: object):
+        """Constructor.
+
+        :param stream:  the original stream
+        """
+        self._stream = stream
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def flush(self) -> None:
+        if _task_output.get() is None:
+            self._stream.flush()
+
+    def write(self, text: str) -> int:
+        output = _task_output.get()
+        if output is None:
+            return self._stream.write(text)
+        output.append((self._stream, text))
+        return len(text)
+
+
+@contextlib.contextmanager
+def collect_output() -> Iterator[List[Tuple[object, str]]]:
+    """Collect the output of the current thread (or asyncio task) while redirect_output is in place.
+
+    :return:    the list the output is collected in as (stream, text) pairs
+    """
+    output = []
+    token = _task_output.set(output)
+    try:
+        yield output
+    finally:
+        _task_output.reset(token)
+
+
+@contextlib.contextmanager
+def redirect_output() -> Iterator[None]:
+    """Replace sys.stdout and sys.stderr, so the output of pool tasks can be collected."""
+    if isinstance(sys.stdout, _Output):
+        yield
+        return
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _Output(stdout), _Output(stderr)
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def replay_output(output: List[Tuple[object, str]]) -> None:
+    """Write the output collected for a task to the original streams.
+
+    :param output:  the output collected (see collect_output)
+    """
+    for stream, text in output:
+        stream.write(text)
+
+
+class ConnectionPool(object):
+
+    """A pool of authenticated connections to the very same IMAP4 account.
+
+    The pool runs a task per item (e.g. per mailbox) on up to size connections in parallel.
+    Each connection is used by one task at a time only. The output of each task is collected
+    and replayed in the order of the items, as if the tasks had run one after the other.
+    """
+
+    def __init__(self, host: str, port: int, username: str, password: str, size: int = 1):
+        """Constructor.
+
+        :param host:        the host to connect
+        :param port:        the host's port number (if 0 then the default will be used)
+        :param username:    user account for login
+        :param password:    user password for login
+        :param size:        maximum number of connections
+        """
+        self._host = host
+        self._port = port
+        self._username = username
+        self._password = password
+        self._size = max(size, 1)
+        self._connections = []          # type: List[Connection]
+        self._connecting = 0
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._hierarchies = {}          # shared by the connections (see Connection._hierarchy)
+
+    def acquire(self) -> Connection:
+        """Get an idle connection, connect and log in a new one if there is none.
+
+        The connection has to be handed back by release().
+
+        :return:    a connection for exclusive use
+        """
+        with self._lock:
+            connect = self._idle.empty() and self._connecting + len(self._connections) < self._size
+            if connect:
+                self._connecting += 1
+        if not connect:
+            return self._idle.get()
+
+        try:
+            con = Connection(self._host, self._port, self._username, self._password, self._hierarchies)
+        finally:
+            with self._lock:
+                self._connecting -= 1
+        with self._lock:
+            self._connections.append(con)
+        return con
+
+    def close(self) -> None:
+        """Log out all connections.
+
+        The idle connections are logged out right away, the ones still in use as soon as
+        they are released.
+        """
+        with self._lock:
+            self._connections = []
+            idle, self._idle = self._idle, queue.Queue()
+        while not idle.empty():
+            idle.get_nowait().close()
+
+    def map(self, task: Callable[[Connection, object], None], items: Iterable) -> None:
+        """Run task(connection, item) for all items.
+
+        If the pool holds just a single connection the tasks run one after the other in the
+        calling thread. An exception raised by a task (including SystemExit) is re-raised
+        after the output of all the preceding tasks and of the failed one has been replayed.
+
+        :param task:    the task to run
+        :param items:   the items to run the task for
+        """
+        if self._size == 1:
+            for item in items:
+                con = self.acquire()
+                try:
+                    task(con, item)
+                finally:
+                    self.release(con)
+            return
+
+        with redirect_output(), concurrent.futures.ThreadPoolExecutor(max_workers=self._size) as executor:
+            futures = [executor.submit(self._run, task, item) for item in items]
+            try:
+                for f in futures:
+                    output, exception = f.result()
+                    replay_output(output)
+                    if exception is not None:
+                        raise exception
+            finally:
+                for f in futures:
+                    f.cancel()
+
+    def release(self, con: Connection) -> None:
+        """Hand back a connection acquired before.
+
+        :param con:     the connection
+        """
+        with self._lock:
+            if con in self._connections:
+                if con.imap4 is not None:
+                    self._idle.put(con)
+                    return
+                # lost (see Connection._pipeline_abort), a new connection may take its place
+                self._connections.remove(con)
+
+        # the pool has been closed meanwhile or the connection is lost
+        con.close()
+
+    def _run(self, task: Callable[[Connection, object], None], item: object) -> Tuple[List, BaseException]:
+        """Run a single task on a pool thread and collect its output.
+
+        :param task:    the task to run
+        :param item:    the item to run the task for
+        :return:        the output collected as (stream, text) pairs, the exception raised (if any)
+        """
+        exception = None
+        con = None
+        with collect_output() as output:
+            try:
+                con = self.acquire()
+                task(con, item)
+            except BaseException as e:
+                exception = e
+            finally:
+                if con is not None:
+                    self.release(con)
+        return output, exception
@@ -0,0 +1,242 @@
+# ------------------------------------------------------------
+# imaparchiver/profiling.py
+#
+# profile a whole run
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module profiles a whole run of a command (see --profile).
+
+Two modes are supported:
+
+    - cprofile: deterministic profiling by cProfile of the main thread and of any thread
+                started later on (e.g. by the ConnectionPool), exact call counts but a
+                noticeable overhead
+    - sample:   the stacks of all threads are sampled every SAMPLE_INTERVAL seconds, which
+                is cheap enough for production runs; the call counts are sample counts then
+
+Either way a pstats dump is written, to be examined by pstats, snakeviz, etc., and the time
+is broken down by category: waiting for the server (socket reads), parsing responses,
+email.utils.parsedate, imaparchiver itself and anything else.
+"""
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from typing import TextIO, Tuple
+
+from . import color
+
+
+# seconds between two samples in sample mode
+SAMPLE_INTERVAL = 0.005
+
+# number of functions listed in the report
+TOP_FUNCTIONS = 20
+
+# the categories the time is broken down into
+CATEGORIES = ('socket reads', 'response parsing', 'email.utils.parsedate', 'imaparchiver', 'other')
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# functions of imaplib reading from the socket, any other imaplib function parses responses
+_IMAPLIB_READS = ('read', 'readline', '_get_line', 'send')
+
+# modules of the standard library reading from the socket, waiting for data included
+_SOCKET_MODULES = ('socket.py', 'ssl.py', 'selectors.py', 'streams.py', 'selector_events.py')
+
+# modules of imaparchiver reading from the socket and parsing responses
+_PACKAGE_SOCKET_MODULES = ('compress.py',)
+_PACKAGE_PARSING_MODULES = ('fetch.py', 'idset.py')
+
+
+def category(func: Tuple[str, int, str]) -> str:
+    """Get the category of a function in the report.
+
+    :param func:    the function as in pstats: file name, line number, function name
+    :return:        the category (see CATEGORIES)
+    """
+    file_name, _, name = func
+    if file_name == '~':
+        if any(s in name for s in ('recv', 'select.', 'sendall', "'read' of '_ssl")):
+            return 'socket reads'
+        if "'re.Pattern'" in name:
+            return 'response parsing'
+        return 'other'
+
+    directory, module = os.path.split(os.path.abspath(file_name))
+    in_package = directory == _PACKAGE_DIR
+    if os.path.basename(directory) == 'email' and module in ('_parseaddr.py', 'utils.py'):
+        return 'email.utils.parsedate'
+    if module == 'imaplib.py':
+        return 'socket reads' if name in _IMAPLIB_READS else 'response parsing'
+    if not in_package:
+        return 'socket reads' if module in _SOCKET_MODULES else 'other'
+    if module in _PACKAGE_SOCKET_MODULES:
+        return 'socket reads'
+    if module in _PACKAGE_PARSING_MODULES or name.startswith(('parse', '_parse')) or name == '_get_response':
+        return 'response parsing'
+    return 'imaparchiver'
+
+
+class _Sampler(object):
+
+    """Samples the stacks of all threads, a profiler object for pstats.Stats."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        """Constructor.
+
+        :param interval:    seconds between two samples
+        """
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._self = {}
+        self._total = {}
+        self._callers = {}
+        self.stats = {}
+
+    def create_stats(self) -> None:
+        """Stop sampling and convert the samples into the format of pstats."""
+        self.disable()
+        self.stats = {}
+        for func, count in self._total.items():
+            seconds = count * self._interval
+            callers = {c: (n, n, 0.0, n * self._interval) for c, n in self._callers.get(func, {}).items()}
+            self.stats[func] = (count, count, self._self.get(func, 0) * self._interval, seconds, callers)
+
+    def disable(self) -> None:
+        """Stop sampling."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def enable(self) -> None:
+        """Start sampling."""
+        self._thread.start()
+
+    def _run(self) -> None:
+        """Take samples until stopped."""
+        own = threading.get_ident()
+        while not self._stop.wait(self._interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own:
+                    self._sample(frame)
+
+    def _sample(self, frame: object) -> None:
+        """Record a single stack.
+
+        :param frame:   the innermost frame of the stack
+        """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        self._self[stack[0]] = self._self.get(stack[0], 0) + 1
+        for func in set(stack):
+            self._total[func] = self._total.get(func, 0) + 1
+        for callee, caller in set(zip(stack, stack[1:])):
+            callers = self._callers.setdefault(callee, {})
+            callers[caller] = callers.get(caller, 0) + 1
+
+
+class Profiler(object):
+
+    """Profiles everything from start to stop and writes a pstats dump.
+
+    Example:
+
+    >>> profiler = Profiler('move.prof', 'sample')
+    >>> profiler.start()
+    >>> ...
+    >>> profiler.stop()
+    >>> profiler.print_report(sys.stderr)
+    """
+
+    def __init__(self, path: str, mode: str = 'cprofile'):
+        """Constructor.
+
+        :param path:    path of the pstats dump to write
+        :param mode:    'cprofile' or 'sample'
+        """
+        if mode not in ('cprofile', 'sample'):
+            raise ValueError('Unknown profile mode: ' + mode)
+        self._path = path
+        self._mode = mode
+        self._profilers = []
+        self._lock = threading.Lock()
+        self._start = None
+        self._seconds = 0.0
+        self._stats = None          # type: pstats.Stats
+
+    def print_report(self, out: TextIO) -> None:
+        """Print the time per category and the functions taking the most time by themselves.
+
+        :param out:     the stream to print to
+        """
+        if self._stats is None:
+            return
+        stats = self._stats.stats
+        per_category = {c: 0.0 for c in CATEGORIES}
+        for func, (cc, nc, tt, ct, callers) in stats.items():
+            per_category[category(func)] += tt
+        total = sum(per_category.values()) or 1.0
+
+        out.write(color.success(f'Profile written to {self._path}') +
+                  f' ({self._mode}, {self._seconds:.2f} s wall time, {total:.2f} s profiled):\n')
+        out.write('%-24s %9s %7s\n' % ('category', 'self s', 'share'))
+        for c in CATEGORIES:
+            out.write('%-24s %9.3f %6.1f%%\n' % (c, per_category[c], 100 * per_category[c] / total))
+
+        calls = 'samples' if self._mode == 'sample' else 'calls'
+        out.write('\n%9s %9s %9s  %-22s %s\n' % ('self s', 'cum s', calls, 'category', 'function'))
+        for func, (cc, nc, tt, ct, callers) in sorted(stats.items(), key=lambda i: -i[1][2])[:TOP_FUNCTIONS]:
+            file_name, line, name = func
+            location = name if file_name == '~' else f'{os.path.basename(file_name)}:{line}({name})'
+            out.write('%9.3f %9.3f %9d  %-22s %s\n' % (tt, ct, nc, category(func), location))
+
+    def _profile_thread(self, frame: object, event: str, arg: object) -> None:
+        """Start a cProfile profiler for a thread just started (see threading.setprofile).
+
+        :param frame:   the current frame
+        :param event:   the profile event
+        :param arg:     the profile event argument
+        """
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        with self._lock:
+            if self._start is None:
+                return
+            self._profilers.append(profiler)
+        profiler.enable()
+
+    def start(self) -> None:
+        """Start profiling."""
+        self._start = time.monotonic()
+        if self._mode == 'sample':
+            profiler = _Sampler()
+        else:
+            profiler = cProfile.Profile()
+            threading.setprofile(self._profile_thread)
+        self._profilers.append(profiler)
+        profiler.enable()
+
+    def stop(self) -> None:
+        """Stop profiling and write the pstats dump."""
+        if self._start is None:
+            return
+        threading.setprofile(None)
+        with self._lock:
+            self._seconds = time.monotonic() - self._start
+            self._start = None
+            profilers = list(self._profilers)
+        profilers[0].disable()
+        self._stats = pstats.Stats(*profilers)
+        self._stats.dump_stats(self._path)
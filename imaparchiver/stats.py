@@ -0,0 +1,352 @@
+# ------------------------------------------------------------
+# imaparchiver/stats.py
+#
+# per command statistics of the IMAP4 traffic
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module records the IMAP4 commands sent: count, bytes, wall time and latency histogram.
+
+The figures are kept per command (e.g. 'UID FETCH') and per mailbox and command. Each
+connection has got a Recorder fed by the engine with the commands sent and the bytes on the
+wire. The Recorder hands each completed command to the Stats collector shared by all
+connections (see Config().stats) and to the wire trace (see Config().trace and the tracing
+module):
+
+>>> Config().stats = Stats()
+>>> ...
+>>> Config().stats.print_summary(sys.stderr)
+
+The bytes are counted as IMAP4 protocol data, i.e. before COMPRESS=DEFLATE. Responses are
+attributed to the oldest command in flight, which is exact unless commands are pipelined.
+"""
+
+import bisect
+import collections
+import itertools
+import json
+import threading
+import time
+import weakref
+from typing import Optional, TextIO
+
+from .tracing import Trace
+from .units import format_size
+
+
+# upper bounds of the buckets of the latency histograms (seconds), the last bucket is unbounded
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+# commands whose first argument is the mailbox worked on, any other command works on the selected one
+_MAILBOX_COMMANDS = ('APPEND', 'CREATE', 'DELETE', 'EXAMINE', 'SELECT', 'STATUS', 'SUBSCRIBE', 'UNSUBSCRIBE')
+
+# commands not related to any mailbox
+_SESSION_COMMANDS = ('AUTHENTICATE', 'CAPABILITY', 'COMPRESS', 'ID', 'LIST', 'LOGIN', 'LOGOUT', 'LSUB', 'NAMESPACE',
+                     'NOOP', 'STARTTLS')
+
+# number of mailboxes listed in the summary
+_SUMMARY_MAILBOXES = 10
+
+# the ids of the connections recorded
+_connection_ids = itertools.count(1)
+
+
+class CommandStats(object):
+
+    """The figures of a single kind of command."""
+
+    def __init__(self):
+        """Constructor."""
+        self.count = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, bytes_sent: int, bytes_received: int, seconds: float, status: str) -> None:
+        """Add a single command.
+
+        :param bytes_sent:      bytes sent
+        :param bytes_received:  bytes received
+        :param seconds:         time from sending the command until its completion
+        :param status:          status of the tagged response, e.g. 'OK'
+        """
+        self.count += 1
+        if status != 'OK':
+            self.failed += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def as_dict(self) -> dict:
+        """Get the figures as plain dictionary (e.g. for JSON).
+
+        :return:    the figures
+        """
+        return {'count': self.count, 'failed': self.failed, 'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received, 'seconds': self.seconds, 'max_seconds': self.max_seconds,
+                'histogram': list(self.histogram)}
+
+    def merge(self, other: 'CommandStats') -> None:
+        """Add the figures of other commands.
+
+        :param other:   the figures to add
+        """
+        self.count += other.count
+        self.failed += other.failed
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def percentile(self, p: float) -> float:
+        """Estimate a percentile of the latency from the histogram.
+
+        :param p:   the percentile, e.g. 0.9
+        :return:    the upper bound of the bucket holding the percentile (seconds)
+        """
+        rank = p * self.count
+        total = 0
+        for i, n in enumerate(self.histogram):
+            total += n
+            if total >= rank and n > 0:
+                return min(LATENCY_BUCKETS[i], self.max_seconds) if i < len(LATENCY_BUCKETS) else self.max_seconds
+        return self.max_seconds
+
+
+class Stats(object):
+
+    """Collects the figures of the commands of all connections. This is thread safe."""
+
+    def __init__(self):
+        """Constructor."""
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._start_cpu = time.process_time()
+        self.commands = collections.defaultdict(CommandStats)
+        self.mailboxes = {}
+
+    def add(self, command: str, mailbox: Optional[str], bytes_sent: int, bytes_received: int, seconds: float,
+            status: str) -> None:
+        """Add a single command.
+
+        :param command:         the command, e.g. 'UID FETCH'
+        :param mailbox:         the mailbox the command worked on (None: none)
+        :param bytes_sent:      bytes sent
+        :param bytes_received:  bytes received
+        :param seconds:         time from sending the command until its completion
+        :param status:          status of the tagged response, e.g. 'OK'
+        """
+        with self._lock:
+            self.commands[command].add(bytes_sent, bytes_received, seconds, status)
+            if mailbox is not None:
+                per_command = self.mailboxes.setdefault(mailbox, collections.defaultdict(CommandStats))
+                per_command[command].add(bytes_sent, bytes_received, seconds, status)
+
+    def as_dict(self) -> dict:
+        """Get the figures as plain dictionary (e.g. for JSON).
+
+        :return:    the figures
+        """
+        with self._lock:
+            return {'wall_seconds': time.monotonic() - self._start,
+                    'cpu_seconds': time.process_time() - self._start_cpu,
+                    'latency_buckets': list(LATENCY_BUCKETS),
+                    'commands': {c: s.as_dict() for c, s in sorted(self.commands.items())},
+                    'mailboxes': {m: {c: s.as_dict() for c, s in sorted(per_command.items())}
+                                  for m, per_command in sorted(self.mailboxes.items())}}
+
+    def print_summary(self, out: TextIO) -> None:
+        """Print a summary: the figures per command and the mailboxes taking the most time.
+
+        :param out:     the stream to print to
+        """
+        with self._lock:
+            commands = sorted(self.commands.items(), key=lambda i: -i[1].seconds)
+            mailboxes = []
+            for name, per_command in self.mailboxes.items():
+                total = CommandStats()
+                for s in per_command.values():
+                    total.merge(s)
+                mailboxes.append((name, total))
+            mailboxes.sort(key=lambda i: -i[1].seconds)
+            wall = time.monotonic() - self._start
+            cpu = time.process_time() - self._start_cpu
+
+        total = CommandStats()
+        for _, s in commands:
+            total.merge(s)
+        out.write(f'IMAP4 commands: {total.count} in {wall:.2f} s wall time ({cpu:.2f} s CPU), '
+                  f'{total.seconds:.2f} s waiting for responses, '
+                  f'{format_size(total.bytes_sent)} sent, {format_size(total.bytes_received)} received\n')
+        if total.count == 0:
+            return
+
+        out.write('%-16s %7s %10s %10s %9s %8s %8s %8s %8s %8s\n' % ('command', 'count', 'sent', 'received',
+                                                                      'total s', 'mean ms', 'p50 ms', 'p90 ms',
+                                                                      'p99 ms', 'max ms'))
+        for name, s in commands + [('total', total)]:
+            out.write('%-16s %7d %10s %10s %9.2f %8.1f %8.1f %8.1f %8.1f %8.1f\n' % (
+                name, s.count, format_size(s.bytes_sent), format_size(s.bytes_received), s.seconds,
+                1000 * s.seconds / s.count, 1000 * s.percentile(0.5), 1000 * s.percentile(0.9),
+                1000 * s.percentile(0.99), 1000 * s.max_seconds))
+
+        if len(mailboxes) == 0:
+            return
+        width = max(len(name) for name, _ in mailboxes[:_SUMMARY_MAILBOXES])
+        out.write('\n%-*s %7s %10s %10s %9s\n' % (width, 'mailbox', 'count', 'sent', 'received', 'total s'))
+        for name, s in mailboxes[:_SUMMARY_MAILBOXES]:
+            out.write('%-*s %7d %10s %10s %9.2f\n' % (width, name, s.count, format_size(s.bytes_sent),
+                                                      format_size(s.bytes_received), s.seconds))
+        if len(mailboxes) > _SUMMARY_MAILBOXES:
+            out.write(f'... and {len(mailboxes) - _SUMMARY_MAILBOXES} more mailboxes\n')
+
+    def write_json(self, path: str) -> None:
+        """Write the figures to a JSON file.
+
+        :param path:    path of the file
+        """
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+class _Command(object):
+
+    """A single command sent, waiting for its completion."""
+
+    __slots__ = ('name', 'mailbox', 'args', 'start', 'start_time', 'bytes_sent', 'bytes_received')
+
+    def __init__(self, name: str, mailbox: Optional[str], args: tuple):
+        """Constructor.
+
+        :param name:        the command, e.g. 'UID FETCH'
+        :param mailbox:     the mailbox the command works on (None: none)
+        :param args:        the arguments of the command (following the command name)
+        """
+        self.name = name
+        self.mailbox = mailbox
+        self.args = args
+        self.start = time.monotonic()
+        self.start_time = time.time()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+class Recorder(object):
+
+    """Records the commands of a single connection and hands them to the collectors when completed.
+
+    The engine calls start before sending a command, sent and received for the bytes on the
+    wire, and either completed (if it parses the tagged responses itself) or response for each
+    line received.
+    """
+
+    def __init__(self, connection: object, stats: Optional[Stats], trace: Optional[Trace] = None):
+        """Constructor.
+
+        :param connection:  the connection, its selected mailbox is the one worked on by most commands
+        :param stats:       the Stats collector (None: none)
+        :param trace:       the wire trace (None: none)
+        """
+        self.id = next(_connection_ids)
+        self._connection = weakref.ref(connection)
+        self._stats = stats
+        self._trace = trace
+        self._in_flight = collections.OrderedDict()
+        self._sending = None                              # type: Optional[_Command]
+
+    def completed(self, tag: bytes, status: str) -> None:
+        """A command has been completed.
+
+        :param tag:     the tag of the command
+        :param status:  the status of the tagged response, e.g. 'OK'
+        """
+        command = self._in_flight.pop(tag, None)
+        if command is None:
+            return
+        if command is self._sending:
+            self._sending = None
+        seconds = time.monotonic() - command.start
+        if self._stats is not None:
+            self._stats.add(command.name, command.mailbox, command.bytes_sent, command.bytes_received, seconds,
+                            status)
+        if self._trace is not None:
+            self._trace.add(self.id, tag, command.name, command.mailbox, command.args, command.start_time,
+                            command.start_time + seconds, command.bytes_sent, command.bytes_received, status)
+
+    def received(self, size: int) -> None:
+        """Bytes have been received. They are attributed to the oldest command in flight.
+
+        :param size:    number of bytes
+        """
+        for command in self._in_flight.values():
+            command.bytes_received += size
+            return
+
+    def response(self, line: bytes) -> None:
+        """A line has been received (see received). If it is a tagged response, the command is completed.
+
+        :param line:    the line
+        """
+        self.received(len(line))
+        if line[:1] in (b'*', b'+') or len(self._in_flight) == 0:
+            return
+        tag, _, rest = line.partition(b' ')
+        if tag in self._in_flight:
+            self.completed(tag, rest.split(b' ', 1)[0].decode(errors='replace').rstrip('\r\n'))
+
+    def sent(self, size: int) -> None:
+        """Bytes have been sent. They are attributed to the command sent last.
+
+        :param size:    number of bytes
+        """
+        if self._sending is not None:
+            self._sending.bytes_sent += size
+
+    def start(self, name: str, args: tuple) -> None:
+        """A command is about to be sent (see started).
+
+        :param name:    the command, e.g. 'UID'
+        :param args:    the arguments of the command
+        """
+        name = name.upper()
+        mailbox = None
+        if name == 'UID' and len(args) > 0:
+            name = name + ' ' + str(args[0]).upper()
+            args = args[1:]
+        if name in _MAILBOX_COMMANDS and len(args) > 0:
+            mailbox = _mailbox_name(args[0])
+        elif name not in _SESSION_COMMANDS:
+            selected = getattr(self._connection(), 'selected', None)
+            mailbox = _mailbox_name(selected[0]) if selected is not None else None
+        self._sending = _Command(name, mailbox, args)
+
+    def started(self, tag: bytes) -> None:
+        """The command just started has been sent.
+
+        :param tag:     the tag of the command
+        """
+        if self._sending is not None:
+            self._in_flight[tag] = self._sending
+
+
+def _mailbox_name(path: object) -> str:
+    """Get the name of a mailbox from a command argument.
+
+    :param path:    the mailbox path as sent, maybe quoted
+    :return:        the mailbox name
+    """
+    if isinstance(path, bytes):
+        path = path.decode(errors='replace')
+    path = str(path)
+    if len(path) > 1 and path[0] == '"' and path[-1] == '"':
+        path = path[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return path
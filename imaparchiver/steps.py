@@ -0,0 +1,63 @@
+# ------------------------------------------------------------
+# imaparchiver/steps.py
+#
+# run the steps of an operation on blocking connections
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module runs the steps of an operation shared by both engines.
+
+Such an operation (see the operations module and Index.sync_steps) is a generator taking
+all the decisions but talking to the server by yielding the calls to make. Each call is a
+tuple (function, arguments...), its result is sent back into the generator and an exception
+raised by it is thrown into the generator. run() makes the calls on blocking connections,
+aio.run_steps awaits them on asyncio connections.
+
+Example:
+
+>>> def steps(mb):
+...     mail_count = yield mb.select, True
+...     return mail_count
+>>> run(steps(mb))
+42
+"""
+
+from typing import Callable, Generator, Iterable
+
+
+def each(items: Iterable, handler: Callable[[object], None]) -> None:
+    """Hand all the items of a stream to a handler, e.g. the mails of Mailbox.fetch_stream.
+
+    Yield (each, stream, handler) for a stream: the asyncio engine iterates the stream by
+    async for instead.
+
+    :param items:       the items, e.g. an iterator
+    :param handler:     called for each item
+    """
+    for item in items:
+        handler(item)
+
+
+def run(steps: Generator) -> object:
+    """Run the steps of an operation, making the calls yielded.
+
+    :param steps:   the generator of the operation
+    :return:        the value returned by the generator
+    """
+    result, error = None, None
+    try:
+        while True:
+            try:
+                call = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            result, error = None, None
+            try:
+                result = call[0](*call[1:])
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
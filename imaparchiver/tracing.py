@@ -0,0 +1,295 @@
+# ------------------------------------------------------------
+# imaparchiver/tracing.py
+#
+# wire trace of the IMAP4 commands and its analysis
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module writes a trace of all the IMAP4 commands sent (see --trace) and analyzes it.
+
+The trace is a JSON Lines file holding a line per command and its response, written as the
+command completes:
+
+    {"connection": 2, "tag": "JBKF7", "command": "UID FETCH", "mailbox": "INBOX",
+     "args": "1:250 (UID FLAGS)", "start": 1570000000.123, "end": 1570000000.151,
+     "bytes_sent": 36, "response_size": 18734, "status": "OK"}
+
+The start and end are seconds since the epoch. Credentials are never written: the arguments
+of LOGIN and AUTHENTICATE are redacted. Neither are mails: responses are recorded by their
+size only, and long arguments are cut.
+
+The analysis (see analyze-trace) reconstructs the critical path of the run and flags
+redundant SELECTs and runs of serial round trips, which could have been pipelined.
+"""
+
+import json
+import threading
+from typing import List, Optional, TextIO
+
+
+# the arguments of these commands are never written
+REDACTED_COMMANDS = ('AUTHENTICATE', 'LOGIN')
+
+# arguments are cut to this length
+MAX_ARGS_LENGTH = 200
+
+# this many commands of the same kind, each sent after the one before completed, make a serial run
+SERIAL_RUN = 4
+
+# number of entries listed per finding
+_REPORT_ENTRIES = 10
+
+
+def redact(command: str, args: tuple) -> str:
+    """Get the arguments of a command as written to the trace.
+
+    :param command:     the command, e.g. 'LOGIN'
+    :param args:        the arguments
+    :return:            the arguments, redacted and cut
+    """
+    if command in REDACTED_COMMANDS:
+        return '[redacted]'
+    text = ' '.join(a.decode(errors='replace') if isinstance(a, bytes) else str(a) for a in args)
+    if len(text) > MAX_ARGS_LENGTH:
+        text = text[:MAX_ARGS_LENGTH] + '...'
+    return text
+
+
+class Trace(object):
+
+    """Writes the wire trace, shared by all connections. This is thread safe."""
+
+    def __init__(self, path: str):
+        """Constructor.
+
+        :param path:    path of the JSON Lines file to write
+        """
+        self._lock = threading.Lock()
+        self._file = open(path, 'w')
+
+    def add(self, connection: int, tag: bytes, command: str, mailbox: Optional[str], args: tuple, start: float,
+            end: float, bytes_sent: int, response_size: int, status: str) -> None:
+        """Write a single command.
+
+        :param connection:      the id of the connection
+        :param tag:             the tag of the command
+        :param command:         the command, e.g. 'UID FETCH'
+        :param mailbox:         the mailbox the command worked on (None: none)
+        :param args:            the arguments of the command
+        :param start:           the time the command was sent (seconds since the epoch)
+        :param end:             the time the command completed (seconds since the epoch)
+        :param bytes_sent:      bytes sent
+        :param response_size:   bytes received
+        :param status:          status of the tagged response, e.g. 'OK'
+        """
+        line = json.dumps({'connection': connection,
+                           'tag': tag.decode(errors='replace') if isinstance(tag, bytes) else str(tag),
+                           'command': command, 'mailbox': mailbox, 'args': redact(command, args),
+                           'start': round(start, 6), 'end': round(end, 6), 'bytes_sent': bytes_sent,
+                           'response_size': response_size, 'status': status})
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + '\n')
+
+    def close(self) -> None:
+        """Close the trace file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def load(path: str) -> List[dict]:
+    """Load a wire trace.
+
+    :param path:    path of the JSON Lines file
+    :return:        the commands, ordered by their start
+    """
+    with open(path) as f:
+        commands = [json.loads(line) for line in f if line.strip()]
+    commands.sort(key=lambda c: (c['start'], c['end']))
+    return commands
+
+
+def _exclusive_times(commands: List[dict]) -> List[float]:
+    """Get the time each command of a connection keeps it busy on its own.
+
+    Time commands in flight overlap (pipelined) is attributed to the command sent first.
+
+    :param commands:    the commands of the connection, ordered by their start
+    :return:            the exclusive time of each command (seconds)
+    """
+    times = []
+    frontier = None
+    for c in commands:
+        start = c['start'] if frontier is None else max(c['start'], frontier)
+        times.append(max(c['end'] - start, 0.0))
+        frontier = c['end'] if frontier is None else max(frontier, c['end'])
+    return times
+
+
+def critical_path(commands: List[dict]) -> dict:
+    """Reconstruct the critical path: the connection completing last and what kept it busy.
+
+    The time of the critical path is split into the time waiting for the server (commands in
+    flight), the time in between commands (the client working) and the time before the first
+    command of the connection (waiting for other connections, connecting).
+
+    :param commands:    the commands, ordered by their start
+    :return:            the critical path
+    """
+    span_start = min(c['start'] for c in commands)
+    span_end = max(c['end'] for c in commands)
+    connection = max(commands, key=lambda c: c['end'])['connection']
+    path = [c for c in commands if c['connection'] == connection]
+
+    waiting = 0.0
+    per_command = {}
+    per_mailbox = {}
+    for c, seconds in zip(path, _exclusive_times(path)):
+        waiting += seconds
+        entry = per_command.setdefault(c['command'], [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        if c['mailbox'] is not None:
+            per_mailbox[c['mailbox']] = per_mailbox.get(c['mailbox'], 0.0) + seconds
+
+    lead_in = path[0]['start'] - span_start
+    return {'connection': connection, 'seconds': span_end - span_start, 'commands': len(path),
+            'waiting': waiting, 'client': max(span_end - span_start - lead_in - waiting, 0.0), 'lead_in': lead_in,
+            'per_command': {name: {'count': n, 'seconds': s} for name, (n, s) in per_command.items()},
+            'per_mailbox': per_mailbox}
+
+
+def redundant_selects(commands: List[dict]) -> List[dict]:
+    """Find SELECT and EXAMINE commands which are redundant or not used at all.
+
+    A SELECT of the mailbox selected read-write already is redundant, as is an EXAMINE of the
+    mailbox selected already. A SELECT or EXAMINE followed by another one without any
+    command in between is not used.
+
+    :param commands:    the commands, ordered by their start
+    :return:            the commands flagged, each with the reason in 'finding'
+    """
+    found = []
+    selected = {}
+    for c in commands:
+        con = c['connection']
+        command = c['command']
+        if command in ('SELECT', 'EXAMINE'):
+            readonly = command == 'EXAMINE'
+            current = selected.get(con)
+            if current is not None and current[0] == c['mailbox'] and (readonly or not current[1]):
+                found.append(dict(c, finding=f'{current[2]["command"]} of {c["mailbox"]} in effect already'))
+                continue
+            if current is not None and not current[3]:
+                found.append(dict(current[2], finding=f'not used before {command} of {c["mailbox"]}'))
+            if c['status'] == 'OK':
+                selected[con] = (c['mailbox'], readonly, c, False)
+            else:
+                selected.pop(con, None)
+        elif command in ('CLOSE', 'UNSELECT', 'LOGOUT'):
+            selected.pop(con, None)
+        elif con in selected and c['mailbox'] == selected[con][0]:
+            selected[con] = selected[con][:3] + (True,)
+    return found
+
+
+def serial_runs(commands: List[dict], run: int = SERIAL_RUN) -> List[dict]:
+    """Find runs of commands of the same kind on a connection, each sent after the one before completed.
+
+    Such a run takes a round trip per command, while pipelining them (or batching them into
+    fewer commands) takes a single round trip or a few.
+
+    :param commands:    the commands, ordered by their start
+    :param run:         minimum number of commands of a run
+    :return:            the runs found
+    """
+    per_connection = {}
+    for c in commands:
+        per_connection.setdefault(c['connection'], []).append(c)
+
+    runs = []
+    for con, cmds in per_connection.items():
+        current = []
+        for c in cmds + [None]:
+            if c is not None and current and c['command'] == current[-1]['command'] and \
+                    c['start'] >= current[-1]['end']:
+                current.append(c)
+                continue
+            if len(current) >= run:
+                mailboxes = sorted({m['mailbox'] for m in current if m['mailbox'] is not None})
+                runs.append({'connection': con, 'command': current[0]['command'], 'count': len(current),
+                             'seconds': current[-1]['end'] - current[0]['start'], 'mailboxes': mailboxes,
+                             'first_tag': current[0]['tag']})
+            current = [c] if c is not None else []
+    runs.sort(key=lambda r: -r['seconds'])
+    return runs
+
+
+def analyze(commands: List[dict]) -> dict:
+    """Analyze a wire trace.
+
+    :param commands:    the commands, ordered by their start
+    :return:            the critical path, the redundant SELECTs and the serial runs
+    """
+    if len(commands) == 0:
+        return {'commands': 0}
+    serial = 0
+    last = {}
+    for c in commands:
+        previous = last.get(c['connection'])
+        if previous is not None and c['start'] >= previous['end']:
+            serial += 1
+        last[c['connection']] = c
+    return {'commands': len(commands), 'connections': len({c['connection'] for c in commands}),
+            'serial': serial, 'critical_path': critical_path(commands),
+            'redundant_selects': redundant_selects(commands), 'serial_runs': serial_runs(commands)}
+
+
+def print_analysis(analysis: dict, out: TextIO) -> None:
+    """Print the analysis of a wire trace.
+
+    :param analysis:    the analysis (see analyze)
+    :param out:         the stream to print to
+    """
+    if analysis['commands'] == 0:
+        out.write('No commands traced.\n')
+        return
+
+    path = analysis['critical_path']
+    out.write(f'{analysis["commands"]} commands on {analysis["connections"]} connections in '
+              f'{path["seconds"]:.3f} s, {analysis["serial"]} sent only after the command before completed\n\n')
+
+    seconds = path['seconds'] or 1.0
+    out.write(f'Critical path: connection {path["connection"]}, {path["commands"]} commands\n')
+    for label, key in (('waiting for the server', 'waiting'), ('in between commands', 'client'),
+                       ('before the first command', 'lead_in')):
+        out.write('    %-26s %9.3f s %6.1f%%\n' % (label, path[key], 100 * path[key] / seconds))
+    out.write('\n    %-26s %7s %11s\n' % ('command', 'count', 'seconds'))
+    for name, entry in sorted(path['per_command'].items(), key=lambda i: -i[1]['seconds']):
+        out.write('    %-26s %7d %9.3f s\n' % (name, entry['count'], entry['seconds']))
+    if path['per_mailbox']:
+        out.write('\n    %-40s %11s\n' % ('mailbox', 'seconds'))
+        for name, s in sorted(path['per_mailbox'].items(), key=lambda i: -i[1])[:_REPORT_ENTRIES]:
+            out.write('    %-40s %9.3f s\n' % (name, s))
+
+    selects = analysis['redundant_selects']
+    out.write(f'\nRedundant SELECTs: {len(selects)}\n')
+    for c in selects[:_REPORT_ENTRIES]:
+        out.write(f'    connection {c["connection"]} {c["tag"]} {c["command"]} {c["mailbox"]}: {c["finding"]}\n')
+    if len(selects) > _REPORT_ENTRIES:
+        out.write(f'    ... and {len(selects) - _REPORT_ENTRIES} more\n')
+
+    runs = analysis['serial_runs']
+    out.write(f'\nSerial runs of {SERIAL_RUN} or more commands: {len(runs)}, '
+              f'{sum(r["count"] for r in runs)} round trips\n')
+    for r in runs[:_REPORT_ENTRIES]:
+        mailboxes = ', '.join(r['mailboxes'][:3]) + (', ...' if len(r['mailboxes']) > 3 else '')
+        out.write(f'    connection {r["connection"]} from {r["first_tag"]}: {r["count"]} x {r["command"]} in '
+                  f'{r["seconds"]:.3f} s' + (f' ({mailboxes})' if mailboxes else '') + '\n')
+    if len(runs) > _REPORT_ENTRIES:
+        out.write(f'    ... and {len(runs) - _REPORT_ENTRIES} more\n')
@@ -0,0 +1,26 @@
+# ------------------------------------------------------------
+# imaparchiver/units.py
+#
+# format figures for humans
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+"""This module formats figures like sizes for humans."""
+
+
+def format_size(size: int) -> str:
+    """Format a size for humans.
+
+    :param size:    the size in bytes
+    :return:        the size, e.g. '1.5 MiB'
+    """
+    if size < 1024:
+        return f'{size} B'
+    for unit in ('KiB', 'MiB', 'GiB', 'TiB'):
+        size /= 1024
+        if size < 1024:
+            break
+    return f'{size:.1f} {unit}'
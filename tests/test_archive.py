@@ -0,0 +1,118 @@
+# ------------------------------------------------------------
+# tests/test_archive.py
+#
+# test the container files of the download command
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+import gzip
+import os
+import socket
+
+import pytest
+
+from imaparchiver.archive import INDEX_SUFFIX, Container, MaildirStore, extract
+
+
+def _entry(uid: int, uid_validity: int = 1) -> dict:
+    return {'uidvalidity': uid_validity, 'uid': uid, 'message_id': f'<{uid}@example.com>', 'date': None}
+
+
+def _add(container: Container, uid: int, uid_validity: int = 1) -> None:
+    container.add(b'From MAILER-DAEMON\n', [f'Subject: mail {uid}\n'.encode(), b'\n', b'body\n'], b'\n',
+                  _entry(uid, uid_validity))
+
+
+@pytest.mark.parametrize('compression, suffix', [(None, '.mbox'), ('gzip', '.mbox.gz')])
+def test_extract(tmp_path, compression, suffix):
+    path = str(tmp_path / ('mails' + suffix))
+    container = Container(path, compression)
+    _add(container, 17)
+    _add(container, 18)
+    assert container.close() == [17, 18]
+
+    assert extract(path, 17) == b'Subject: mail 17\n\nbody\n'
+    assert extract(path, 18, 1) == b'Subject: mail 18\n\nbody\n'
+    with pytest.raises(RuntimeError):
+        extract(path, 19)
+
+
+def test_extract_by_uidvalidity(tmp_path):
+    path = str(tmp_path / 'mails.mbox')
+    container = Container(path)
+    _add(container, 17, 1)
+    container.close()
+    container = Container(path)
+    container.add(b'From MAILER-DAEMON\n', [b'other\n'], b'\n', _entry(17, 2))
+    container.close()
+
+    assert extract(path, 17, 1) == b'Subject: mail 17\n\nbody\n'
+    assert extract(path, 17, 2) == b'other\n'
+    assert extract(path, 17) == b'other\n'
+
+
+def test_reopen_truncates_trailer_and_partial_frame(tmp_path):
+    path = str(tmp_path / 'mails.tar.gz')
+    container = Container(path, 'gzip', trailer=b'\0' * 1024)
+    _add(container, 1)
+    container.close()
+    with open(path, 'ab') as f:
+        f.write(b'a frame not listed in the index')
+
+    container = Container(path, 'gzip', trailer=b'\0' * 1024)
+    assert container.listed == {(1, 1)}
+    _add(container, 2)
+    container.close()
+
+    with gzip.open(path) as f:
+        data = f.read()
+    assert data.count(b'\0' * 1024) == 1
+    assert data.endswith(b'\0' * 1024)
+    assert extract(path, 1) == b'Subject: mail 1\n\nbody\n'
+    assert extract(path, 2) == b'Subject: mail 2\n\nbody\n'
+
+
+def test_mbox_unquotes_from_lines(tmp_path):
+    path = str(tmp_path / 'mails.mbox')
+    container = Container(path)
+    container.add(b'From MAILER-DAEMON\n', [b'>From here\n', b'>>From there\n'], b'\n', _entry(1))
+    container.close()
+    assert extract(path, 1) == b'From here\n>From there\n'
+
+
+def test_no_index(tmp_path):
+    path = tmp_path / 'mails.mbox'
+    path.write_bytes(b'From someone\n\nnot ours\n')
+    with pytest.raises(RuntimeError):
+        Container(str(path))
+    assert not (tmp_path / ('mails.mbox' + INDEX_SUFFIX)).exists()
+
+
+def _maildir_save(store: MaildirStore, uid: int) -> tuple:
+    prefix = f'1 (UID {uid} FLAGS (\\Seen \\Answered) BODY[] {{5}}'.encode()
+    f = store.literal_file(prefix)
+    f.write(b'hello')
+    return store.save([(prefix, f), b')'])
+
+
+def test_maildir_recognizes_mails_of_any_host(tmp_path):
+    store = MaildirStore(str(tmp_path), 42)
+    mail_id, path, written = _maildir_save(store, 17)
+    assert (mail_id, written) == (17, True)
+    assert os.path.basename(path).split('.')[1] == 'U42I17'
+    assert path.endswith(':2,RS')
+    assert store.close() == [17]
+
+    os.rename(path, path.replace(socket.gethostname(), 'elsewhere'))
+    store = MaildirStore(str(tmp_path), 42)
+    mail_id, path, written = _maildir_save(store, 17)
+    assert (mail_id, written) == (17, False)
+    assert 'elsewhere' in path
+    assert os.listdir(tmp_path / 'tmp') == []
+    assert len(os.listdir(tmp_path / 'cur')) == 1
+
+    store = MaildirStore(str(tmp_path), 43)
+    assert _maildir_save(store, 17)[2] is True
@@ -0,0 +1,75 @@
+# ------------------------------------------------------------
+# tests/test_batch.py
+#
+# test the adaptive batches of mails
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+import pytest
+
+from imaparchiver.batch import MAX_SIZE, MIN_SIZE, Batcher, response_size
+from imaparchiver.config import Config
+from imaparchiver.idset import IdSet
+
+
+@pytest.fixture(autouse=True)
+def budget(monkeypatch):
+    monkeypatch.setattr(Config(), 'batch_bytes', 1000)
+    monkeypatch.setattr(Config(), 'batch_latency', 1.0)
+    monkeypatch.setattr(Config(), 'verbose', False)
+
+
+def test_response_size():
+    assert response_size([b'12345', None, (b'1 (BODY[] {3}', b'abc'), b')']) == 5 + 13 + 3 + 1
+    assert response_size([(b'1 (BODY[] {300}', None)]) == 15 + 300
+
+
+def test_growth_limited():
+    batcher = Batcher('FETCH INBOX', 50)
+    batcher.record(50, 50, 0.0)
+    assert batcher.size == 100
+    batcher.record(100, 100, 0.0)
+    assert batcher.size == 200
+
+
+def test_shrink_to_bytes():
+    batcher = Batcher('FETCH INBOX', 50)
+    batcher.record(50, 50 * 100, 0.0)
+    assert batcher.size == 10
+
+
+def test_shrink_to_latency():
+    batcher = Batcher('FETCH INBOX', 50)
+    batcher.record(50, 50, 5.0)
+    assert batcher.size == 10
+
+
+def test_cost_smoothed():
+    batcher = Batcher('FETCH INBOX', 50)
+    batcher.record(50, 50 * 100, 0.0)
+    batcher.record(10, 10 * 300, 0.0)
+    assert batcher.size == 5
+
+
+def test_bounds():
+    batcher = Batcher('FETCH INBOX', MAX_SIZE)
+    batcher.record(MAX_SIZE, 0, 0.0)
+    assert batcher.size == MAX_SIZE
+    batcher.record(1, 1 << 20, 0.0)
+    assert batcher.size == MIN_SIZE
+    batcher.record(0, 1 << 20, 10.0)
+    assert batcher.size == MIN_SIZE
+    assert Batcher('FETCH INBOX', 0).size == MIN_SIZE
+
+
+def test_rounds_resized_after_record():
+    batcher = Batcher('FETCH INBOX', 2)
+    rounds = batcher.rounds(IdSet.parse('1:20'), 3)
+    assert [str(b) for b in next(rounds)] == ['1:2', '3:4', '5:6']
+    batcher.record(6, 6, 0.0, commands=3)
+    assert [str(b) for b in next(rounds)] == ['7:10', '11:14', '15:18']
+    assert [str(b) for b in next(rounds)] == ['19:20']
+    assert next(rounds, None) is None
@@ -0,0 +1,67 @@
+# ------------------------------------------------------------
+# tests/test_changes.py
+#
+# test the detection of mailboxes changed since the last run
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+from imaparchiver.changes import MailboxChanges
+
+
+STATUS = {'UIDVALIDITY': 1, 'UIDNEXT': 10, 'MESSAGES': 9, 'HIGHESTMODSEQ': 100}
+
+
+def test_unchanged_after_save(tmp_path):
+    path = str(tmp_path / 'changes.json')
+    changes = MailboxChanges(path, 'move', ['CONDSTORE'])
+    assert not changes.unchanged('INBOX', STATUS)
+    changes.record('INBOX', STATUS)
+    changes.save()
+
+    changes = MailboxChanges(path, 'move', ['CONDSTORE'])
+    assert changes.unchanged('INBOX', STATUS)
+    assert changes.modseq('INBOX', STATUS) == 100
+    assert not changes.unchanged('INBOX.Sent', STATUS)
+
+
+def test_changed_status(tmp_path):
+    changes = MailboxChanges(str(tmp_path / 'changes.json'), 'move', ['CONDSTORE'])
+    changes.record('INBOX', STATUS)
+    for item, value in (('HIGHESTMODSEQ', 101), ('UIDNEXT', 11), ('MESSAGES', 8)):
+        assert not changes.unchanged('INBOX', dict(STATUS, **{item: value}))
+    assert changes.modseq('INBOX', dict(STATUS, HIGHESTMODSEQ=101)) == 100
+
+
+def test_uidvalidity_changed(tmp_path):
+    changes = MailboxChanges(str(tmp_path / 'changes.json'), 'move', ['CONDSTORE'])
+    changes.record('INBOX', STATUS)
+    status = dict(STATUS, UIDVALIDITY=2)
+    assert not changes.unchanged('INBOX', status)
+    assert changes.modseq('INBOX', status) is None
+
+
+def test_operations_apart(tmp_path):
+    path = str(tmp_path / 'changes.json')
+    changes = MailboxChanges(path, 'move', ['CONDSTORE'])
+    changes.record('INBOX', STATUS)
+    changes.save()
+    assert not MailboxChanges(path, 'clean', ['CONDSTORE']).unchanged('INBOX', STATUS)
+
+
+def test_forget(tmp_path):
+    changes = MailboxChanges(str(tmp_path / 'changes.json'), 'move', ['CONDSTORE'])
+    changes.record('INBOX', STATUS)
+    changes.forget('INBOX')
+    assert not changes.unchanged('INBOX', STATUS)
+
+
+def test_disabled_without_condstore(tmp_path):
+    changes = MailboxChanges(str(tmp_path / 'changes.json'), 'move', ['IMAP4rev1'])
+    changes.record('INBOX', STATUS)
+    assert not changes.unchanged('INBOX', STATUS)
+    assert changes.status_items == ()
+    changes.save()
+    assert not (tmp_path / 'changes.json').exists()
@@ -0,0 +1,133 @@
+# ------------------------------------------------------------
+# tests/test_compress.py
+#
+# test the DEFLATE layer of COMPRESS=DEFLATE
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+import asyncio
+import io
+import os
+import zlib
+
+from imaparchiver.compress import Deflater, DeflateReader, DeflateStreamReader, DeflateStreamWriter
+from imaparchiver.connection import Connection
+
+
+# a literal larger than a chunk read, sent by a server flushing after each piece
+LITERAL = os.urandom(100000) + b'\r\n' + b'x' * 100000
+PIECES = [b'* 1 FETCH (UID 7 BODY[] {%d}\r\n' % len(LITERAL) + LITERAL[:10],
+          LITERAL[10:70000], LITERAL[70000:150000], LITERAL[150000:] + b')\r\n',
+          b'A1 OK FETCH completed\r\n']
+
+
+def _compressed(pieces: list) -> bytes:
+    """Compress the pieces just like the server does, each one flushed."""
+    deflater = Deflater(None)
+    return b''.join(deflater.compress(p) for p in pieces)
+
+
+def _check_fetch(readline, read):
+    assert readline() == PIECES[0][:-10]
+    assert read(len(LITERAL)) == LITERAL
+    assert readline() == b')\r\n'
+    assert readline() == b'A1 OK FETCH completed\r\n'
+    assert readline() == b''
+
+
+def test_deflater_flushed():
+    sent = []
+    deflater = Deflater(sent.append)
+    deflater.send(b'A1 NOOP\r\n')
+    deflater.send(b'A2 LOGOUT\r\n')
+    decompressor = zlib.decompressobj(-15)
+    assert [decompressor.decompress(s) for s in sent] == [b'A1 NOOP\r\n', b'A2 LOGOUT\r\n']
+
+
+def test_reader_round_trip():
+    reader = io.BufferedReader(DeflateReader(io.BytesIO(_compressed(PIECES))))
+    _check_fetch(reader.readline, reader.read)
+
+
+class FakeStreamReader(object):
+
+    """An asyncio.StreamReader handing out the data in small chunks."""
+
+    def __init__(self, data: bytes):
+        self._data = io.BytesIO(data)
+
+    async def read(self, n: int) -> bytes:
+        return self._data.read(min(n, 1000))
+
+
+class FakeStreamWriter(object):
+
+    """An asyncio.StreamWriter collecting the data written."""
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data: bytes) -> None:
+        self.data += data
+
+    async def drain(self) -> None:
+        pass
+
+
+def test_stream_round_trip():
+    async def run():
+        writer = FakeStreamWriter()
+        stream_writer = DeflateStreamWriter(writer)
+        for p in PIECES:
+            stream_writer.write(p)
+            await stream_writer.drain()
+        reader = DeflateStreamReader(FakeStreamReader(writer.data), 1 << 20)
+        assert await reader.readline() == PIECES[0][:-10]
+        assert await reader.readexactly(len(LITERAL)) == LITERAL
+        assert await reader.readline() == b')\r\n'
+        assert await reader.readline() == b'A1 OK FETCH completed\r\n'
+        assert await reader.readline() == b''
+
+    asyncio.run(run())
+
+
+class FakeSocket(object):
+
+    """A socket collecting the data sent."""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data: bytes) -> None:
+        self.sent.append(data)
+
+
+class FakeIMAP4(object):
+
+    """Just enough of imaplib.IMAP4 to switch on COMPRESS=DEFLATE."""
+
+    def __init__(self, data: bytes):
+        self.file = io.BufferedReader(io.BytesIO(data))
+        self.sock = FakeSocket()
+
+    def send(self, data: bytes) -> None:
+        self.sock.sendall(data)
+
+    def xatom(self, name: str, *args) -> (str, list):
+        return 'OK', [b'DEFLATE active']
+
+
+def test_connection_compressed():
+    imap4 = FakeIMAP4(_compressed(PIECES))
+    con = Connection.__new__(Connection)
+    con._connection = imap4
+    con._capabilities = ['IMAP4rev1', 'COMPRESS=DEFLATE']
+    con._recorder = None
+    con._compress()
+    _check_fetch(imap4.file.readline, imap4.file.read)
+
+    imap4.send(b'A2 LOGOUT\r\n')
+    assert zlib.decompressobj(-15).decompress(b''.join(imap4.sock.sent)) == b'A2 LOGOUT\r\n'
@@ -0,0 +1,264 @@
+# ------------------------------------------------------------
+# tests/test_connection.py
+#
+# test the creation of mailboxes, the pipelined commands and the streamed FETCH
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+import imaplib
+import io
+
+import pytest
+
+from imaparchiver.config import Config
+from imaparchiver.connection import Connection
+from imaparchiver.download import FileStore
+
+
+class FakeIMAP4(object):
+
+    """Just enough of imaplib.IMAP4 to create mailboxes, with a failing CREATE for some."""
+
+    def __init__(self, existing=(), subscribed=(), create_fails=None):
+        self.existing = set(existing)
+        self.subscribed = set(subscribed)
+        self.create_fails = create_fails or {}
+        self.commands = []
+
+    def _list(self, names: set, pattern: str) -> (str, list):
+        prefix = pattern.strip('"').rstrip('*')
+        return 'OK', [f'(\\HasNoChildren) "." {n}'.encode() for n in sorted(names) if n.startswith(prefix)] or [None]
+
+    def create(self, name: str) -> (str, list):
+        self.commands.append(('CREATE', name))
+        if name in self.create_fails:
+            return 'NO', [self.create_fails[name]]
+        self.existing.add(name)
+        return 'OK', [b'CREATE completed']
+
+    def list(self, reference: str, pattern: str) -> (str, list):
+        self.commands.append(('LIST', pattern))
+        return self._list(self.existing, pattern)
+
+    def lsub(self, reference: str, pattern: str) -> (str, list):
+        self.commands.append(('LSUB', pattern))
+        return self._list(self.subscribed, pattern)
+
+    def subscribe(self, name: str) -> (str, list):
+        self.commands.append(('SUBSCRIBE', name))
+        self.subscribed.add(name)
+        return 'OK', [b'SUBSCRIBE completed']
+
+
+@pytest.fixture
+def connect():
+    hierarchies = {}
+
+    def connect(imap4: FakeIMAP4, username: str = 'user') -> Connection:
+        """Get a connection of a pool sharing the folders known."""
+        con = Connection.__new__(Connection)
+        con._connection = imap4
+        con._capabilities = []
+        con._account = ('localhost', 143, username)
+        con._hierarchies = hierarchies
+        con.selected = None
+        return con
+    yield connect
+
+
+def test_create_missing_only(connect):
+    imap4 = FakeIMAP4(existing=['Archive'], subscribed=['Archive'])
+    connect(imap4).create_mailbox('Archive.2019.INBOX', '.')
+    assert imap4.commands == [('LIST', '"Archive*"'), ('LSUB', '"Archive*"'),
+                              ('CREATE', 'Archive.2019'), ('SUBSCRIBE', 'Archive.2019'),
+                              ('CREATE', 'Archive.2019.INBOX'), ('SUBSCRIBE', 'Archive.2019.INBOX')]
+
+
+def test_hierarchy_shared_by_connections(connect):
+    imap4 = FakeIMAP4()
+    connect(imap4).create_mailbox('Archive.2019', '.')
+    imap4.commands = []
+    connect(imap4).create_mailbox('Archive.2019', '.')
+    connect(imap4).create_mailbox('Archive.2020', '.')
+    assert imap4.commands == [('CREATE', 'Archive.2020'), ('SUBSCRIBE', 'Archive.2020')]
+
+
+def test_hierarchy_per_account(connect):
+    alice, bob = FakeIMAP4(existing=['Archive', 'Archive.2019']), FakeIMAP4()
+    connect(alice, 'alice').create_mailbox('Archive.2019', '.')
+    connect(bob, 'bob').create_mailbox('Archive.2019', '.')
+    assert ('CREATE', 'Archive.2019') not in alice.commands
+    assert ('CREATE', 'Archive') in bob.commands and ('CREATE', 'Archive.2019') in bob.commands
+
+
+def test_hierarchy_forgets_deleted(connect):
+    imap4 = FakeIMAP4()
+    con = connect(imap4)
+    con.create_mailbox('Archive.2019', '.')
+    imap4.existing.discard('Archive.2019')
+    connect(imap4).forget_mailbox('Archive.2019')
+    imap4.commands = []
+    con.create_mailbox('Archive.2019', '.')
+    assert imap4.commands == [('CREATE', 'Archive.2019'), ('SUBSCRIBE', 'Archive.2019')]
+
+
+def test_create_already_existing(connect):
+    imap4 = FakeIMAP4(create_fails={'Archive': b'[ALREADYEXISTS] Mailbox exists'})
+    connect(imap4).create_mailbox('Archive', '.')
+    assert ('SUBSCRIBE', 'Archive') in imap4.commands
+
+
+def test_create_failed_but_listed(connect):
+    imap4 = FakeIMAP4(create_fails={'Archive': b'Mailbox exists'})
+    con = connect(imap4)
+    con._hierarchy('Archive')
+    imap4.existing.add('Archive')
+    con.create_mailbox('Archive', '.')
+    assert imap4.commands[-2:] == [('LIST', 'Archive'), ('SUBSCRIBE', 'Archive')]
+
+
+def test_create_failed(connect):
+    imap4 = FakeIMAP4(create_fails={'Archive': b'Permission denied'})
+    with pytest.raises(RuntimeError):
+        connect(imap4).create_mailbox('Archive', '.')
+    assert ('SUBSCRIBE', 'Archive') not in imap4.commands
+
+
+class ScriptedIMAP4(object):
+
+    """Just enough of imaplib.IMAP4 to pipeline commands, answering them as scripted.
+
+    The script lists the responses in the order the server sends them: (type, data) for
+    an untagged response and (tag, result, data) for a tagged one. None stands for a lost
+    connection.
+    """
+
+    def __init__(self, script: list):
+        self.script = list(script)
+        self.sent = []
+        self.untagged_responses = {}
+        self.tagged_responses = {}
+        self.closed = False
+
+    def _command(self, name: str, *args) -> str:
+        tag = f'A{len(self.sent) + 1}'
+        self.sent.append((tag, name) + args)
+        return tag
+
+    def _command_complete(self, name: str, tag: str) -> (str, list):
+        while tag not in self.tagged_responses:
+            response = self.script.pop(0)
+            if response is None:
+                raise imaplib.IMAP4.abort('socket error: EOF')
+            if len(response) == 2:
+                self.untagged_responses.setdefault(response[0], []).append(response[1])
+            else:
+                self.tagged_responses[response[0]] = response[1:]
+        res, data = self.tagged_responses.pop(tag)
+        if res == 'BAD':
+            raise imaplib.IMAP4.error(f'{name} command error: {res} {data}')
+        return res, data
+
+    def shutdown(self) -> None:
+        self.closed = True
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    monkeypatch.setattr(Config(), 'pipeline_depth', 2)
+
+    def pipeline(script: list) -> (Connection, ScriptedIMAP4):
+        con = Connection.__new__(Connection)
+        con._connection = ScriptedIMAP4(script)
+        con.selected = None
+        return con, con._connection
+    yield pipeline
+
+
+def _fetched(*uids) -> list:
+    return [f'{u} (UID {u} FLAGS ())'.encode() for u in uids]
+
+
+def test_pipeline_interleaved_fetch(pipeline):
+    con, imap4 = pipeline([('FETCH', _fetched(3)[0]), ('FETCH', _fetched(1)[0]), ('A1', 'OK', [b'done']),
+                           ('FETCH', _fetched(5)[0]), ('FETCH', _fetched(4)[0]), ('A2', 'OK', [b'done']),
+                           ('A3', 'OK', [b'done'])])
+    results = con.pipeline([('FETCH', '1:2', '(FLAGS)'), ('FETCH', '3:4', '(FLAGS)'), ('FETCH', '5', '(FLAGS)')])
+    assert results == [('OK', _fetched(1)), ('OK', _fetched(3, 4)), ('OK', _fetched(5))]
+
+
+def test_pipeline_fetch_owned_by_commands_in_flight(pipeline):
+    con, imap4 = pipeline([('FETCH', _fetched(5)[0]), ('A1', 'OK', [b'done']),
+                           ('A2', 'OK', [b'done']), ('A3', 'OK', [b'done'])])
+    results = con.pipeline([('FETCH', '1:2', '(FLAGS)'), ('FETCH', '3:4', '(FLAGS)'), ('FETCH', '5', '(FLAGS)')])
+    assert results == [('OK', _fetched(5)), ('OK', [None]), ('OK', [None])]
+
+
+def test_pipeline_no(pipeline):
+    con, imap4 = pipeline([('FETCH', _fetched(1)[0]), ('A1', 'OK', [b'done']),
+                           ('A2', 'NO', [b'[EXPUNGEISSUED] gone']), ('FETCH', _fetched(5)[0]),
+                           ('A3', 'OK', [b'done'])])
+    results = con.pipeline([('FETCH', '1:2', '(FLAGS)'), ('FETCH', '3:4', '(FLAGS)'), ('FETCH', '5', '(FLAGS)')])
+    assert results == [('OK', _fetched(1)), ('NO', [b'[EXPUNGEISSUED] gone']), ('OK', _fetched(5))]
+
+
+def test_pipeline_bad(pipeline):
+    con, imap4 = pipeline([('FETCH', _fetched(1)[0]), ('A1', 'OK', [b'done']), ('A2', 'BAD', [b'syntax']),
+                           ('FETCH', _fetched(5)[0]), ('A3', 'OK', [b'done']),
+                           ('A4', 'OK', [b'done'])])
+    with pytest.raises(imaplib.IMAP4.error):
+        con.pipeline([('FETCH', '1:2', '(FLAGS)'), ('FETCH', '3:4', '(FLAGS)'), ('FETCH', '5', '(FLAGS)')])
+    assert [s[0] for s in imap4.sent] == ['A1', 'A2', 'A3']
+    assert imap4.script == [('A4', 'OK', [b'done'])]
+    assert imap4.untagged_responses == {} and imap4.tagged_responses == {}
+
+
+def test_pipeline_connection_lost(pipeline):
+    con, imap4 = pipeline([('A1', 'OK', [b'done']), None])
+    with pytest.raises(imaplib.IMAP4.abort):
+        con.pipeline([('FETCH', '1:2', '(FLAGS)'), ('FETCH', '3:4', '(FLAGS)'), ('FETCH', '5', '(FLAGS)')])
+    assert imap4.closed
+    with pytest.raises(RuntimeError):
+        con.pipeline([('FETCH', '1:2', '(FLAGS)')])
+
+
+class StreamingIMAP4(object):
+
+    """Just enough of imaplib.IMAP4 to stream a FETCH response, read from a bytes buffer."""
+
+    abort = imaplib.IMAP4.abort
+
+    def __init__(self, response: bytes):
+        self.file = io.BytesIO(response)
+        self.tagged_commands = {}
+
+    def _command(self, name: str, *args) -> bytes:
+        self.tagged_commands[b'A1'] = None
+        return b'A1'
+
+    def _get_line(self) -> bytes:
+        line = self.file.readline()
+        if not line:
+            raise self.abort('socket error: EOF')
+        return line[:-2]
+
+    def read(self, size: int) -> bytes:
+        return self.file.read(size)
+
+
+def test_fetch_stream_eof_in_literal(tmp_path):
+    con = Connection.__new__(Connection)
+    con._connection = StreamingIMAP4(b'* 1 FETCH (UID 1 BODY[] {100}\r\nHello')
+    with pytest.raises(imaplib.IMAP4.abort):
+        list(con.fetch_stream('1', '(BODY.PEEK[])', lambda prefix: open(tmp_path / 'mail', 'wb')))
+
+
+def test_fetch_stream_eof_removes_part_file(tmp_path):
+    con = Connection.__new__(Connection)
+    con._connection = StreamingIMAP4(b'* 1 FETCH (UID 1 BODY[] {100}\r\nHello')
+    with pytest.raises(imaplib.IMAP4.abort):
+        list(con.fetch_stream('1', '(BODY.PEEK[])', FileStore(str(tmp_path)).literal_file))
+    assert list(tmp_path.iterdir()) == []
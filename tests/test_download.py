@@ -0,0 +1,132 @@
+# ------------------------------------------------------------
+# tests/test_download.py
+#
+# test the download state and the objects format
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+import hashlib
+import json
+import os
+
+from imaparchiver.download import MANIFEST_FILE, OBJECTS_FOLDER, STATE_FILE, DownloadState, ObjectStore
+from imaparchiver.idset import IdSet
+
+
+def test_search_criteria_without_state(tmp_path):
+    state = DownloadState(str(tmp_path), 42)
+    assert not state.resync
+    assert state.uid == 0
+    assert state.search_criteria() == ('ALL',)
+
+
+def test_commit_in_order_of_uids(tmp_path):
+    state = DownloadState(str(tmp_path), 42)
+    assert str(state.new_mails(IdSet([3, 5, 9]))) == '3,5,9'
+
+    state.commit(5)
+    assert state.uid == 0
+    assert not os.path.exists(tmp_path / STATE_FILE)
+
+    state.commit(3)
+    assert state.uid == 5
+    assert json.loads((tmp_path / STATE_FILE).read_text()) == {'uidvalidity': 42, 'uid': 5}
+    assert DownloadState(str(tmp_path), 42).search_criteria() == ('UID', '6:*')
+
+
+def test_skip_mails_not_fetched(tmp_path):
+    state = DownloadState(str(tmp_path), 42)
+    state.new_mails(IdSet.parse('1:5'))
+    for mail_id in (1, 3, 4, 5):
+        state.fetched(mail_id)
+        state.commit(mail_id)
+    assert state.uid == 1
+
+    state.batch_fetched(IdSet.parse('1:5'))
+    assert state.uid == 5
+    assert json.loads((tmp_path / STATE_FILE).read_text()) == {'uidvalidity': 42, 'uid': 5}
+
+
+def test_skip_mails_not_fetched_before_commit(tmp_path):
+    state = DownloadState(str(tmp_path), 42)
+    state.new_mails(IdSet.parse('1:3'))
+    state.fetched(1)
+    state.fetched(3)
+    state.batch_fetched(IdSet.parse('1:3'))
+    assert state.uid == 0
+
+    state.commit(3)
+    assert state.uid == 0
+    state.commit(1)
+    assert state.uid == 3
+
+
+def test_resume(tmp_path):
+    (tmp_path / STATE_FILE).write_text(json.dumps({'uidvalidity': 42, 'uid': 5}))
+    state = DownloadState(str(tmp_path), 42)
+    assert not state.resync
+    assert state.search_criteria() == ('UID', '6:*')
+    assert str(state.new_mails(IdSet.parse('1:9'))) == '6:9'
+
+
+def test_resync_on_uidvalidity_change(tmp_path):
+    (tmp_path / STATE_FILE).write_text(json.dumps({'uidvalidity': 42, 'uid': 5}))
+    state = DownloadState(str(tmp_path), 43)
+    assert state.resync
+    assert state.uid == 0
+    assert state.search_criteria() == ('ALL',)
+
+    state.new_mails(IdSet([1]))
+    state.commit(1)
+    assert json.loads((tmp_path / STATE_FILE).read_text()) == {'uidvalidity': 43, 'uid': 1}
+
+
+def test_full_ignores_state(tmp_path):
+    (tmp_path / STATE_FILE).write_text(json.dumps({'uidvalidity': 42, 'uid': 5}))
+    state = DownloadState(str(tmp_path), 42, full=True)
+    assert not state.resync
+    assert state.search_criteria() == ('ALL',)
+
+
+def test_broken_state(tmp_path):
+    (tmp_path / STATE_FILE).write_text('{not json')
+    assert DownloadState(str(tmp_path), 42).search_criteria() == ('ALL',)
+
+
+def _object_save(store: ObjectStore, uid: int, body: bytes) -> tuple:
+    prefix = f'1 (UID {uid} INTERNALDATE "01-Jul-2019 12:00:00 +0000" BODY[] {{{len(body)}}}'.encode()
+    f = store.literal_file(prefix)
+    f.write(body)
+    return store.save([(prefix, f), b')'])
+
+
+def test_objects_stored_once(tmp_path):
+    digest = hashlib.sha256(b'hello').hexdigest()
+    inbox = ObjectStore(str(tmp_path), str(tmp_path / 'INBOX'), 42)
+    mail_id, path, written = _object_save(inbox, 17, b'hello')
+    assert (mail_id, written) == (17, True)
+    assert path == str(tmp_path / OBJECTS_FOLDER / digest[:2] / digest)
+    assert inbox.close() == [17]
+
+    sent = ObjectStore(str(tmp_path), str(tmp_path / 'Sent'), 7)
+    assert _object_save(sent, 3, b'hello') == (3, path, False)
+    assert _object_save(sent, 4, b'world')[2] is True
+    sent.close()
+    prefixes = sorted([digest[:2], hashlib.sha256(b'world').hexdigest()[:2]])
+    assert sorted(os.listdir(tmp_path / OBJECTS_FOLDER)) == prefixes
+
+    manifest = [json.loads(line) for line in (tmp_path / 'Sent' / MANIFEST_FILE).read_text().splitlines()]
+    assert [(e['uidvalidity'], e['uid'], e['size']) for e in manifest] == [(7, 3, 5), (7, 4, 5)]
+
+
+def test_objects_listed_once(tmp_path):
+    store = ObjectStore(str(tmp_path), str(tmp_path / 'INBOX'), 42)
+    _object_save(store, 17, b'hello')
+    store.close()
+    store = ObjectStore(str(tmp_path), str(tmp_path / 'INBOX'), 42)
+    assert _object_save(store, 17, b'hello')[2] is False
+    store.close()
+    assert len((tmp_path / 'INBOX' / MANIFEST_FILE).read_text().splitlines()) == 1
@@ -0,0 +1,86 @@
+# ------------------------------------------------------------
+# tests/test_fetch.py
+#
+# test the parser of FETCH responses
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+import email.utils
+
+from imaparchiver.fetch import parse_date, parse_fetch, parse_internal_date, split_fetch
+
+
+# the way imaplib hands over the response to a FETCH of two mails with a header literal each
+# and a third one without any literal
+FETCH_DATA = [
+    (b'1 (UID 17 RFC822.SIZE 1234 FLAGS (\\Seen \\Answered) BODY[HEADER.FIELDS (DATE MESSAGE-ID)] {78}',
+     b'Date: Mon, 1 Jul 2019 12:00:00 +0200\r\nMessage-ID:\r\n <abc@example.com>\r\n\r\n'),
+    b')',
+    (b'2 (UID 18 BODY[HEADER.FIELDS (DATE MESSAGE-ID)] {44}',
+     b'DATE: Tue,\r\n 2 Jul 2019 08:30 +0000\r\n\r\n'),
+    b' INTERNALDATE " 3-Jul-2019 10:11:12 +0000")',
+    b'3 (UID 19 INTERNALDATE "04-Jul-2019 01:02:03 +0000" FLAGS ())',
+]
+
+
+def test_parse_fetch_items():
+    mails = list(parse_fetch(FETCH_DATA))
+    assert [m.uid for m in mails] == [17, 18, 19]
+    assert mails[0].size == 1234
+    assert mails[0].flags == '\\Seen \\Answered'
+    assert mails[1].size is None
+    assert mails[2].flags == ''
+
+
+def test_parse_fetch_header_literal():
+    first, second, third = parse_fetch(FETCH_DATA)
+    assert first.header_date == (2019, 7, 1, 12, 0, 0, 0, 1, -1)
+    assert first.message_id == '<abc@example.com>'
+    assert second.header_date == (2019, 7, 2, 8, 30, 0, 0, 1, -1)
+    assert second.message_id is None
+    assert third.header_date is None
+
+
+def test_parse_fetch_remainder_after_literal():
+    first, second, third = parse_fetch(FETCH_DATA)
+    assert first.internal_date is None
+    assert second.internal_date == (2019, 7, 3, 10, 11, 12, 0, 1, -1)
+    assert third.internal_date == (2019, 7, 4, 1, 2, 3, 0, 1, -1)
+
+
+def test_split_fetch():
+    mails = list(split_fetch(FETCH_DATA))
+    assert [mail_id for mail_id, mail_data in mails] == [17, 18, 19]
+    assert mails[0][1] == FETCH_DATA[0:2]
+    assert mails[1][1] == FETCH_DATA[2:4]
+    assert mails[2][1] == FETCH_DATA[4:5]
+
+
+def test_split_fetch_without_uid():
+    assert list(split_fetch([b'1 (FLAGS (\\Seen))'])) == [(None, [b'1 (FLAGS (\\Seen))'])]
+
+
+def test_parse_date_like_email_utils():
+    for date in (b'Mon, 1 Jul 2019 12:00:00 +0200',
+                 b'1 Jul 2019 12:00 +0200',
+                 b'Mon,\r\n 1 Jul 2019 12:00:00 +0200',
+                 b'Mon, 1 Jul 19 12:00:00 +0200',
+                 b'2019-07-01 12:00:00'):
+        assert parse_date(date) == email.utils.parsedate(date.replace(b'\r\n', b'').decode())
+    assert parse_date(b'no date at all') is None
+
+
+def test_parse_internal_date():
+    assert parse_internal_date(b'01-Jul-2019 12:00:00 +0200') == (2019, 7, 1, 12, 0, 0, 0, 1, -1)
+    assert parse_internal_date(b' 1-Jul-2019 12:00:00 +0200') == (2019, 7, 1, 12, 0, 0, 0, 1, -1)
+    assert parse_internal_date(b'1-Jul-2019 12:00:00 +0200') == (2019, 7, 1, 12, 0, 0, 0, 1, -1)
+    assert parse_internal_date(b'garbage') is None
+
+
+def test_parse_internal_date_bad_month():
+    assert parse_internal_date(b'01-Foo-2019 12:00:00 +0200') is None
+    mails = list(parse_fetch([b'1 (UID 5 INTERNALDATE "01-Foo-2019 12:00:00 +0200")']))
+    assert mails[0].internal_date is None
@@ -0,0 +1,79 @@
+# ------------------------------------------------------------
+# tests/test_idset.py
+#
+# test the IdSet
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+from imaparchiver.idset import IdSet
+
+
+def test_render_ranges():
+    assert str(IdSet(['3', '1', '2', '7'])) == '1:3,7'
+    assert str(IdSet([5, 5, 6, b'8'])) == '5:6,8'
+    assert str(IdSet()) == ''
+
+
+def test_parse_sequence_set():
+    assert str(IdSet.parse('1:3,7')) == '1:3,7'
+    assert str(IdSet.parse(b'7:5,1')) == '1,5:7'
+    assert len(IdSet.parse('1:500,502,510:900')) == 892
+
+
+def test_parse_search_response():
+    assert str(IdSet.parse(b'1 2 3 7')) == '1:3,7'
+    assert str(IdSet.parse(b'')) == ''
+
+
+def test_split_respects_max_length():
+    ids = IdSet([1, 2, 3, 5, 7, 9, 11])
+    parts = list(ids.split(5))
+    assert parts == ['1:3,5', '7,9', '11']
+    assert all(len(p) <= 5 for p in parts)
+    assert IdSet.parse(','.join(parts)) == ids
+
+
+def test_split_never_splits_a_range():
+    assert list(IdSet.parse('1:100000,100002').split(3)) == ['1:100000', '100002']
+
+
+def test_parse_unordered_search_response():
+    assert str(IdSet.parse(b'9 3 4 1 2 10')) == '1:4,9:10'
+    assert str(IdSet.parse(b'5:7 1 6 2')) == '1:2,5:7'
+
+
+def test_parse_in_slices():
+    ids = IdSet.parse(' '.join(str(i) for i in range(1, 200001) if i % 1000 != 0))
+    assert len(ids) == 199800
+    assert len(ids.ranges) == 200
+    assert ids.ranges[0] == (1, 999)
+
+
+def test_set_algebra():
+    a = IdSet.parse('1:10,20:30')
+    b = IdSet.parse('5:25,40')
+    assert str(a | b) == '1:30,40'
+    assert str(a & b) == '5:10,20:25'
+    assert str(a - b) == '1:4,26:30'
+    assert str(b - a) == '11:19,40'
+    assert len(a - a) == 0
+    assert not (a - a)
+
+
+def test_contains_and_iterate():
+    ids = IdSet.parse('1:3,7')
+    assert 2 in ids
+    assert '7' in ids
+    assert 5 not in ids
+    assert list(ids) == [1, 2, 3, 7]
+    assert IdSet(ids) == ids
+
+
+def test_batches():
+    ids = IdSet.parse('1:5,10:12')
+    assert [str(b) for b in ids.batches(3)] == ['1:3', '4:5,10', '11:12']
+    sizes = iter([2, 4, 10])
+    assert [str(b) for b in ids.batches(lambda: next(sizes))] == ['1:2', '3:5,10', '11:12']
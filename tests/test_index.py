@@ -0,0 +1,87 @@
+# ------------------------------------------------------------
+# tests/test_index.py
+#
+# test the local index of the mails on the server
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+from imaparchiver.idset import IdSet
+from imaparchiver.index import METADATA_PARTS, Index, flags_parts
+
+
+class FakeMailbox(object):
+
+    """A mailbox of a CONDSTORE server, answering the commands Index.sync runs."""
+
+    def __init__(self, mails: dict, status: dict):
+        self.name = 'INBOX'
+        self.capabilities = ['CONDSTORE']
+        self.mails = mails
+        self.status_items = status
+        self.fetched = []
+
+    def fetch(self, mail_ids: IdSet, message_parts: str) -> (str, list):
+        self.fetched.append((str(mail_ids), message_parts))
+        data = []
+        for i in mail_ids:
+            flags, year = self.mails[i]
+            data.append(f'{i} (UID {i} FLAGS ({flags}) RFC822.SIZE 100 '
+                        f'INTERNALDATE "01-Jul-{year} 12:00:00 +0000")'.encode())
+        return 'OK', data
+
+    def search(self, *criteria) -> (str, list):
+        return 'OK', [' '.join(str(i) for i in self.mails).encode()]
+
+    def select(self, readonly: bool = False) -> int:
+        return len(self.mails)
+
+    def status(self, *items) -> dict:
+        return dict(self.status_items)
+
+
+def test_sync_adds_new_mails():
+    index = Index(':memory:')
+    mb = FakeMailbox({1: ('\\Seen', 2018), 2: ('', 2019)}, {'UIDVALIDITY': 7, 'UIDNEXT': 3, 'HIGHESTMODSEQ': 10})
+    index.sync(mb)
+    assert mb.fetched == [('1:2', METADATA_PARTS)]
+    assert index.counts('INBOX') == (2, 1, 0, 200)
+    assert index.recorded('INBOX') == {'UIDVALIDITY': 7, 'UIDNEXT': 3, 'HIGHESTMODSEQ': 10}
+
+
+def test_sync_unchanged_mailbox():
+    index = Index(':memory:')
+    mb = FakeMailbox({1: ('\\Seen', 2018)}, {'UIDVALIDITY': 7, 'UIDNEXT': 2, 'HIGHESTMODSEQ': 10})
+    index.sync(mb)
+    mb.fetched = []
+    index.sync(mb)
+    assert mb.fetched == []
+    assert index.sync_plan('INBOX', mb.status(), 1) is None
+
+
+def test_sync_changed_mailbox():
+    index = Index(':memory:')
+    mb = FakeMailbox({1: ('\\Seen', 2018), 2: ('', 2019)}, {'UIDVALIDITY': 7, 'UIDNEXT': 3, 'HIGHESTMODSEQ': 10})
+    index.sync(mb)
+
+    mb.mails = {2: ('\\Seen \\Deleted', 2019), 3: ('\\Seen', 2020)}
+    mb.status_items = {'UIDVALIDITY': 7, 'UIDNEXT': 4, 'HIGHESTMODSEQ': 12}
+    mb.fetched = []
+    index.sync(mb)
+    assert mb.fetched == [('2', flags_parts(10)), ('3', METADATA_PARTS)]
+    mails_all, mails_seen, mails_deleted, mails_per_year = index.inspect('INBOX')
+    assert (str(mails_all), str(mails_seen), str(mails_deleted)) == ('2:3', '2:3', '2')
+
+
+def test_sync_fetches_after_uidvalidity_change():
+    index = Index(':memory:')
+    mb = FakeMailbox({1: ('\\Seen', 2018)}, {'UIDVALIDITY': 7, 'UIDNEXT': 2, 'HIGHESTMODSEQ': 10})
+    index.sync(mb)
+
+    status = {'UIDVALIDITY': 8, 'UIDNEXT': 2, 'HIGHESTMODSEQ': 1}
+    plan = index.sync_plan('INBOX', status, 1)
+    assert plan == (IdSet(), None)
+    fetches = index.sync_fetches('INBOX', status, IdSet([1]), plan)
+    assert [(str(ids), parts) for ids, parts, apply in fetches] == [('1', METADATA_PARTS)]
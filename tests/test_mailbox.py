@@ -0,0 +1,122 @@
+# ------------------------------------------------------------
+# tests/test_mailbox.py
+#
+# test the mailbox response parsers and decisions
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+import pytest
+
+from imaparchiver.config import Config
+from imaparchiver.idset import IdSet
+from imaparchiver.mailbox import (
+    Mailbox,
+    bisect_years,
+    inspect_criteria,
+    merge_years,
+    parse_esearch_count,
+    parse_status,
+    undated_mails,
+    years_from_dates
+)
+
+
+class FakeConnection(object):
+
+    """A connection to a server answering any command OK but the ones failing, recording the commands pipelined."""
+
+    def __init__(self, capabilities=(), failing=()):
+        self.capabilities = list(capabilities)
+        self.failing = set(failing)
+        self.selected = None
+        self.commands = []
+
+    def pipeline(self, commands: list) -> list:
+        self.commands.append(commands)
+        return [('NO' if c[0] in self.failing else 'OK', [f'{c[1]} done'.encode()]) for c in commands]
+
+
+def test_parse_esearch_count():
+    assert parse_esearch_count([b'(TAG "A5") UID COUNT 17']) == 17
+    assert parse_esearch_count([None, b'(TAG "A5") UID MIN 3 COUNT 2 MAX 9']) == 2
+
+
+def test_parse_esearch_count_nothing_found():
+    assert parse_esearch_count([b'(TAG "A5") UID']) == 0
+    assert parse_esearch_count([]) == 0
+
+
+def test_parse_status():
+    assert parse_status(b'"INBOX.Folder with Spaces" (MESSAGES 231 UNSEEN 4)') == \
+        ('INBOX.Folder with Spaces', {'MESSAGES': 231, 'UNSEEN': 4})
+    assert parse_status(b'INBOX (messages 3 uidnext 12 uidvalidity 1577836800)') == \
+        ('INBOX', {'MESSAGES': 3, 'UIDNEXT': 12, 'UIDVALIDITY': 1577836800})
+
+
+def test_parse_status_quoted_name():
+    assert parse_status(b'"say \\"hi\\"" (MESSAGES 1)') == ('say "hi"', {'MESSAGES': 1})
+
+
+def test_parse_status_malformed():
+    with pytest.raises(RuntimeError):
+        parse_status(b'INBOX MESSAGES 1')
+
+
+def test_bisect_years():
+    assert bisect_years(2000, 2010, 'NO', [None]) == ({}, None)
+    assert bisect_years(2000, 2010, 'OK', [b'']) == ({}, None)
+    assert bisect_years(2000, 2010, 'OK', [b'1 2']) == ({}, 2005)
+    assert bisect_years(2009, 2010, 'OK', [b'1 2']) == ({2009: IdSet([1, 2])}, None)
+
+
+def test_inspect_criteria():
+    assert inspect_criteria(()) == [('ALL',), ('SEEN',), ('DELETED',)]
+    assert inspect_criteria(('MODSEQ', '12')) == [('MODSEQ', '12'), ('SEEN', 'MODSEQ', '12'),
+                                                   ('DELETED', 'MODSEQ', '12')]
+
+
+def test_years_merged_and_undated():
+    mails_per_year = {2018: IdSet([1, 2])}
+    mails_seen = IdSet.parse('1:5')
+    assert undated_mails(mails_seen, mails_per_year) == IdSet.parse('3:5')
+
+    more = years_from_dates(IdSet.parse('3:5'), {3: (2018, 1, 1), 4: (2019, 1, 1)}, 'INBOX')
+    assert more == {2018: IdSet([3]), 2019: IdSet([4])}
+    assert merge_years(mails_per_year, more) == {2018: IdSet.parse('1:3'), 2019: IdSet([4])}
+
+
+def test_years_from_dates_reports_undated(capsys):
+    assert years_from_dates(IdSet([1]), {}, 'INBOX') == {}
+    assert 'mail 1 in INBOX' in capsys.readouterr().err
+
+
+def test_uid_split_and_pipelined(monkeypatch):
+    monkeypatch.setattr(Config(), 'max_line_length', len('A000 UID STORE  +FLAGS (\\Seen)') + 3)
+    con = FakeConnection()
+    mb = Mailbox(con, '(\\HasNoChildren) "." INBOX')
+    res, data = mb._uid('STORE', IdSet([1, 3, 5, 7]), '+FLAGS', '(\\Seen)')
+    assert res == 'OK'
+    assert [c[1] for commands in con.commands for c in commands] == ['1,3', '5,7']
+    assert data == [b'1,3 done', b'5,7 done']
+
+
+@pytest.mark.parametrize('capabilities, command', [((), 'COPY'), (('MOVE',), 'MOVE')])
+def test_move_failed(capabilities, command):
+    con = FakeConnection(capabilities, failing=[command])
+    mb = Mailbox(con, '(\\HasNoChildren) "." INBOX')
+    con.selected = (mb.path, False)
+    with pytest.raises(RuntimeError):
+        mb.move(IdSet.parse('1:3'), 'Archive')
+    assert [c[0] for commands in con.commands for c in commands] == [command]
+
+
+def test_move_command():
+    mb = Mailbox(FakeConnection(['MOVE']), '(\\HasNoChildren) "." INBOX')
+    assert mb._move_command(IdSet([1]), 'Archive') == 'MOVE'
+    assert mb._move_command(IdSet(), 'Archive') is None
+    assert mb._move_command(IdSet([1]), '') is None
+    mb = Mailbox(FakeConnection(), '(\\HasNoChildren) "." INBOX')
+    assert mb._move_command(IdSet([1]), 'Archive') == 'COPY'
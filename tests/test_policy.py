@@ -0,0 +1,119 @@
+# ------------------------------------------------------------
+# tests/test_policy.py
+#
+# test the mailbox hierarchy and the clean command
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+from imaparchiver import command_line
+from imaparchiver.config import Config
+from imaparchiver.mailbox import Mailbox
+from imaparchiver.policy import mailbox_children, mailbox_levels
+
+
+class FakeIMAP4(object):
+
+    """Just enough of imaplib.IMAP4 to delete mailboxes."""
+
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, path: str) -> (str, list):
+        self.deleted.append(path)
+        return 'OK', [b'DELETE completed']
+
+    def select(self, *args) -> (str, list):
+        return 'OK', [b'0']
+
+
+class FakeConnection(object):
+
+    """A connection to an IMAP4rev2 server holding mailboxes with a number of mails each."""
+
+    def __init__(self, mail_counts: dict):
+        self.capabilities = ['IMAP4rev2']
+        self.imap4 = FakeIMAP4()
+        self.selected = None
+        self.mail_counts = mail_counts
+        self.forgotten = []
+
+    def forget_mailbox(self, name: str) -> None:
+        self.forgotten.append(name)
+
+    def mailboxes(self, root: str, status: tuple) -> dict:
+        mbs = {}
+        for name, count in self.mail_counts.items():
+            mbs[name] = Mailbox(self, f'(\\HasNoChildren) "." {name}')
+            mbs[name]._status = {'MESSAGES': count, 'DELETED': 0}
+        return mbs
+
+    def status(self, mbs: list, items: tuple) -> None:
+        pass
+
+
+class FakePool(object):
+
+    """A pool of a single connection, running the tasks one after the other."""
+
+    connection = None
+
+    def __init__(self, *args):
+        pass
+
+    def acquire(self) -> FakeConnection:
+        return self.connection
+
+    def close(self) -> None:
+        pass
+
+    def map(self, task, items) -> None:
+        for item in items:
+            task(self.connection, item)
+
+    def release(self, con: FakeConnection) -> None:
+        pass
+
+
+def _mailboxes(*names) -> list:
+    return [Mailbox(None, f'(\\HasNoChildren) "." {name}') for name in names]
+
+
+def test_mailbox_levels():
+    levels = mailbox_levels(_mailboxes('INBOX', 'INBOX.a', 'Sent', 'INBOX.a.b', 'INBOX.c'))
+    assert [[mb.name for mb in level] for level in levels] == [['INBOX.a.b'], ['INBOX.a', 'INBOX.c'],
+                                                               ['INBOX', 'Sent']]
+
+
+def test_mailbox_children():
+    children = mailbox_children(_mailboxes('INBOX', 'INBOX.a', 'INBOX.a.b', 'INBOX.x.y', 'Sent'))
+    assert children == {'INBOX': ['INBOX.a', 'INBOX.x.y'], 'INBOX.a': ['INBOX.a.b'], 'INBOX.a.b': [],
+                        'INBOX.x.y': [], 'Sent': []}
+
+
+def test_clean_parent_emptied_by_children(monkeypatch):
+    for name in ('ssl', 'jobs', 'dry_run', 'verbose'):
+        monkeypatch.setattr(Config(), name, getattr(Config(), name))
+    con = FakeConnection({'Old': 0, 'Old.2018': 0, 'Old.2018.INBOX': 0, 'Old.2019': 0,
+                          'Keep': 0, 'Keep.Mails': 3})
+    monkeypatch.setattr(FakePool, 'connection', con)
+    monkeypatch.setattr(command_line, 'ConnectionPool', FakePool)
+    command_line.clean.main(['user:password@localhost', 'INBOX'], standalone_mode=False)
+    assert con.imap4.deleted == ['Old.2018.INBOX', 'Old.2018', 'Old.2019', 'Old']
+    assert con.forgotten == con.imap4.deleted
+
+
+def test_clean_dry_run(monkeypatch):
+    monkeypatch.setattr(Config(), 'dry_run', True)
+    con = FakeConnection({'Old': 0, 'Old.2018': 0})
+    mbs = mailbox_levels(con.mailboxes('INBOX', ()).values())
+    children = mailbox_children(mb for level in mbs for mb in level)
+    deleted = set()
+    changes = command_line.MailboxChanges(None, 'clean', con.capabilities)
+    for level in mbs:
+        for mb in level:
+            command_line._clean_mailbox(changes, children, deleted, con, mb)
+    assert deleted == {'Old', 'Old.2018'}
+    assert con.imap4.deleted == []
@@ -0,0 +1,175 @@
+# ------------------------------------------------------------
+# tests/test_pool.py
+#
+# test the connection pools of both engines
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+import asyncio
+import sys
+import threading
+
+import pytest
+
+from imaparchiver import aio
+from imaparchiver import pool
+
+
+class FakeConnection(object):
+
+    """A connection logged in right away, remembering whether it has been logged out."""
+
+    def __init__(self, *args):
+        self.imap4 = object()
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FakeAsyncConnection(FakeConnection):
+
+    """The asyncio counterpart of FakeConnection."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._writer = object()
+
+    @classmethod
+    async def open(cls, *args) -> 'FakeAsyncConnection':
+        return cls()
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+def _lose(con: FakeConnection) -> None:
+    """Drop the connection to the server as a pipeline aborted does."""
+    con.imap4 = con._writer = None
+
+
+@pytest.fixture
+def blocking_pool(monkeypatch):
+    monkeypatch.setattr(pool, 'Connection', FakeConnection)
+    yield pool.ConnectionPool('localhost', 0, 'user', 'password', 2)
+
+
+@pytest.fixture
+def async_pool(monkeypatch):
+    monkeypatch.setattr(aio, 'Connection', FakeAsyncConnection)
+    yield aio.ConnectionPool('localhost', 0, 'user', 'password', 2)
+
+
+def test_release_after_close(blocking_pool):
+    idle, busy = blocking_pool.acquire(), blocking_pool.acquire()
+    blocking_pool.release(idle)
+    blocking_pool.close()
+    assert idle.closed and not busy.closed
+
+    blocking_pool.release(busy)
+    assert busy.closed
+    assert blocking_pool.acquire() not in (idle, busy)
+
+
+def test_release_after_close_async(async_pool):
+    async def run():
+        idle, busy = await async_pool.acquire(), await async_pool.acquire()
+        async_pool.release(idle)
+        await async_pool.close()
+        assert idle.closed and not busy.closed
+
+        async_pool.release(busy)
+        await async_pool.close()
+        assert busy.closed
+        assert await async_pool.acquire() not in (idle, busy)
+
+    asyncio.run(run())
+
+
+def test_release_lost(blocking_pool):
+    alive, lost = blocking_pool.acquire(), blocking_pool.acquire()
+    blocking_pool.release(alive)
+    _lose(lost)
+    blocking_pool.release(lost)
+    assert blocking_pool.acquire() is alive
+    assert blocking_pool.acquire() not in (alive, lost)
+
+
+def test_release_lost_async(async_pool):
+    async def run():
+        alive, lost = await async_pool.acquire(), await async_pool.acquire()
+        async_pool.release(alive)
+        _lose(lost)
+        async_pool.release(lost)
+        assert await async_pool.acquire() is alive
+        assert await async_pool.acquire() not in (alive, lost)
+        await async_pool.close()
+
+    asyncio.run(run())
+
+
+def _tasks(wait, done):
+    """Tasks printing their item, with 'a' waiting for 'b' to finish and 'fail' raising."""
+    def task(con, item):
+        if item == 'a':
+            wait()
+        print(item)
+        sys.stderr.write(f'{item} done\n')
+        if item == 'b':
+            done()
+        if item == 'fail':
+            raise RuntimeError(item)
+    return task
+
+
+def test_output_in_order(blocking_pool, capsys):
+    b_done = threading.Event()
+    blocking_pool.map(_tasks(lambda: b_done.wait(5), b_done.set), ['a', 'b', 'c'])
+    out, err = capsys.readouterr()
+    assert out == 'a\nb\nc\n'
+    assert err == 'a done\nb done\nc done\n'
+
+
+def test_exception_after_output(blocking_pool, capsys):
+    with pytest.raises(RuntimeError):
+        blocking_pool.map(_tasks(lambda: None, lambda: None), ['a', 'fail', 'c'])
+    out, err = capsys.readouterr()
+    assert out.startswith('a\nfail\n') and 'c' not in out
+
+
+def _async_tasks(wait, done):
+    """The asyncio counterpart of _tasks."""
+    async def task(con, item):
+        if item == 'a':
+            await wait()
+        print(item)
+        sys.stderr.write(f'{item} done\n')
+        if item == 'b':
+            done()
+        if item == 'fail':
+            raise RuntimeError(item)
+    return task
+
+
+def test_output_in_order_async(async_pool, capsys):
+    async def run():
+        b_done = asyncio.Event()
+        await async_pool.map(_async_tasks(b_done.wait, b_done.set), ['a', 'b', 'c'])
+
+    asyncio.run(run())
+    out, err = capsys.readouterr()
+    assert out == 'a\nb\nc\n'
+    assert err == 'a done\nb done\nc done\n'
+
+
+def test_exception_after_output_async(async_pool, capsys):
+    async def nothing():
+        pass
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(async_pool.map(_async_tasks(nothing, lambda: None), ['a', 'fail', 'c']))
+    out, err = capsys.readouterr()
+    assert out.startswith('a\nfail\n') and 'c' not in out
@@ -0,0 +1,63 @@
+# ------------------------------------------------------------
+# tests/test_steps.py
+#
+# test running the steps of an operation on both engines
+#
+# This file is part of imaparchiver.
+# See the LICENSE file for the software license.
+# (C) Copyright 2015-2019, Oliver Maurhart, dyle71@gmail.com
+# ------------------------------------------------------------
+
+import asyncio
+import sys
+
+import pytest
+
+from imaparchiver import aio
+from imaparchiver import steps
+
+
+def _fail(message: str) -> None:
+    raise RuntimeError(message)
+
+
+def _operation(log: list, calls: dict):
+    """An operation yielding the calls given, logging the results, errors and items streamed."""
+    try:
+        log.append((yield calls['first'], 'a'))
+        try:
+            yield _fail, 'failed'
+        except RuntimeError as e:
+            log.append(str(e))
+        yield steps.each, calls['stream'], log.append
+        return 'done'
+    finally:
+        log.append('closed')
+
+
+def test_run():
+    log = []
+    calls = {'first': str.upper, 'stream': iter([1, 2])}
+    assert steps.run(_operation(log, calls)) == 'done'
+    assert log == ['A', 'failed', 1, 2, 'closed']
+
+
+def test_run_exit_closes():
+    log = []
+    calls = {'first': str.upper, 'stream': iter([1, 2])}
+    with pytest.raises(SystemExit):
+        steps.run(_operation(log, dict(calls, first=lambda a: sys.exit(1))))
+    assert log == ['closed']
+
+
+def test_run_async():
+    async def upper(s):
+        return s.upper()
+
+    async def stream():
+        for i in (1, 2):
+            yield i
+
+    log = []
+    assert asyncio.run(aio.run_steps(_operation(log, {'first': upper, 'stream': stream()}))) == 'done'
+    assert log == ['A', 'failed', 1, 2, 'closed']